@@ -0,0 +1,10 @@
+"""
+Офлайн-бенчмарки бота: ни сети, ни токена не нужно.
+
+  * datagen.py - генератор синтетической базы (юзеры по всем таймзонам клавиатуры + история трат);
+  * harness.py - фейковый Bot API и прогон апдейтов через настоящие хендлеры и диалоги;
+  * recalc_bench.py - пропускная способность ночного пересчета на 1k/10k/100k юзеров.
+
+Запуск: python -m bench handlers|recalc --out results.json
+Результаты пишутся в JSON, чтобы сравнивать прогоны между коммитами.
+"""
@@ -0,0 +1,65 @@
+"""
+python -m bench handlers --users 500 --out handlers.json
+python -m bench recalc --sizes 1000,10000,100000 --out recalc.json
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+
+from .harness import run_handler_benchmark
+from .recalc_bench import DEFAULT_ENGINES, DEFAULT_SIZES, run_recalc_benchmark
+from .report import write_report
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--out", default=None, help="куда записать JSON с результатами")
+    common.add_argument("--workdir", default=None, help="папка под временные базы (по умолчанию временная)")
+    common.add_argument("--seed", type=int, default=42)
+    common.add_argument("-v", "--verbose", action="store_true", help="логи бота на уровне INFO")
+
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Офлайн-бенчмарки бота")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    handlers = sub.add_parser("handlers", parents=[common], help="задержка хендлеров и запросы на апдейт")
+    handlers.add_argument("--users", type=int, default=500)
+    handlers.add_argument("--transactions", type=int, default=10, help="трат на юзера")
+    handlers.add_argument("--concurrency", type=int, default=50, help="сколько юзеров пишут одновременно")
+
+    recalc = sub.add_parser("recalc", parents=[common], help="пропускная способность ночного пересчета")
+    recalc.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="размеры через запятую")
+    recalc.add_argument("--engines", default=",".join(DEFAULT_ENGINES), help="движки через запятую")
+    recalc.add_argument("--history-days", type=int, default=14)
+    recalc.add_argument("--gap-days", type=int, default=3, help="на сколько дней максимум отстал пересчет")
+    recalc.add_argument("--workers", type=int, default=None, help="процессов для parallel")
+
+    args = parser.parse_args()
+    # recalc_job при импорте включает INFO для всех - приглушаем, на 100k юзеров логи дороже самого пересчета
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger("bench").setLevel(logging.INFO)
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        workdir = args.workdir or tmp
+        # Свою папку можно указать еще не созданной - заводим ее сами, как recalc_bench
+        os.makedirs(workdir, exist_ok=True)
+        if args.command == "handlers":
+            params = {"users": args.users, "transactions": args.transactions, "concurrency": args.concurrency}
+            results = asyncio.run(run_handler_benchmark(
+                os.path.join(workdir, "handlers.db"), seed=args.seed, **params
+            ))
+        else:
+            params = {
+                "sizes": [int(size) for size in args.sizes.split(",")],
+                "engines": args.engines.split(","),
+                "history_days": args.history_days,
+                "gap_days": args.gap_days,
+                "workers": args.workers,
+            }
+            results = run_recalc_benchmark(workdir, seed=args.seed, **params)
+        write_report(args.out, args.command, {**params, "seed": args.seed}, results)
+
+
+if __name__ == "__main__":
+    main()
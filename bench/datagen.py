@@ -0,0 +1,122 @@
+"""
+Генератор синтетической базы для бенчмарков.
+
+Юзеры раскиданы по всем таймзонам из клавиатуры регистрации, у каждого своя
+норма, день сброса и история трат за history_days дней. Пересчет у юзеров
+отстал на 1..gap_days дней - как будто бот полежал или ночной пересчет пропустили.
+daily_spend заполняется сразу, в том же проходе, что и сырые транзакции.
+"""
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+
+from bot import db, money, tzcalendar
+from bot.keyboards import TIMEZONE_KEYBOARD
+
+logger = logging.getLogger(__name__)
+
+# IANA-зоны прямо из callback_data кнопок, чтобы бенчмарк жил с тем же набором, что и юзеры
+TIMEZONES = [
+    button.callback_data.split(":", 1)[1]
+    for row in TIMEZONE_KEYBOARD.inline_keyboard
+    for button in row
+]
+DAILY_NORMS = [300, 500, 700, 1000, 1500, 2000, 3000, 5000]
+
+# Сколько юзеров пишем за одну транзакцию
+_CHUNK = 2000
+
+
+def use_database(path: str, fresh: bool = False):
+    """Переключает bot/db.py на другой файл базы (и удаляет старый файл, если fresh)."""
+    db.close_db_connections()
+    db.clear_user_cache()
+    db.DB_NAME = path
+    if fresh:
+        # Архив рядом с базой тоже сносим, иначе в новую базу подтянутся чужие старые траты
+        for shard in db.all_shards():
+            shard_path = db.shard_path(shard)
+            for base in (shard_path, db.archive_path(shard_path)):
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(base + suffix):
+                        os.remove(base + suffix)
+    db.init_db()
+
+
+def _user_history(rnd: random.Random, user_id: int, norm: int, timezone: str, now_utc: datetime, history_days: int,
+                  max_tx_per_day: int):
+    """Транзакции юзера и его дневные сводки за history_days дней до сегодня включительно. Суммы - в копейках."""
+    transactions, daily = [], []
+    today = tzcalendar.today(timezone, now_utc)
+    for back in range(history_days, -1, -1):
+        day = today - timedelta(days=back)
+        count = rnd.randint(0, max_tx_per_day)
+        if not count:
+            continue
+        midnight = tzcalendar.day_window(timezone, day).start
+        total = 0
+        for _ in range(count):
+            # Чеки в основном небольшие, изредка крупные - логнормальное распределение вокруг трети нормы
+            amount = max(round(min(rnd.lognormvariate(0, 0.8) * norm / 3, norm * 10)), 1)
+            moment = midnight + timedelta(seconds=rnd.randint(7 * 3600, 23 * 3600))
+            # Сегодняшние траты - не из будущего
+            moment = min(moment, now_utc)
+            transactions.append((user_id, amount, db.to_epoch_ms(moment)))
+            total += amount
+        daily.append((user_id, day.isoformat(), total, count))
+    return transactions, daily
+
+
+def generate(path: str, users: int, history_days: int = 14, gap_days: int = 3, max_tx_per_day: int = 5,
+             seed: int = 42, first_user_id: int = 100_000_000) -> dict:
+    """
+    Создает с нуля базу path на users юзеров. Возвращает сводку: сколько юзеров,
+    транзакций и строк daily_spend получилось.
+    """
+    use_database(path, fresh=True)
+    rnd = random.Random(seed)
+    now_utc = datetime.now(db._UTC)
+    totals = {"users": 0, "transactions": 0, "daily_spend_rows": 0}
+
+    for chunk_start in range(0, users, _CHUNK):
+        user_rows, tx_rows, daily_rows = [], [], []
+        for offset in range(chunk_start, min(chunk_start + _CHUNK, users)):
+            user_id = first_user_id + offset
+            timezone = TIMEZONES[offset % len(TIMEZONES)]
+            today = tzcalendar.today(timezone, now_utc)
+            norm = rnd.choice(DAILY_NORMS) * money.KOPECKS_PER_RUBLE
+            last_recalc = today - timedelta(days=rnd.randint(1, gap_days) if gap_days else 0)
+            balance = round(rnd.uniform(-3, 5) * norm)
+            balance_since = (today - timedelta(days=history_days)).isoformat()
+            user_rows.append((user_id, norm, rnd.randint(1, 28), timezone, balance, last_recalc.isoformat(), balance_since))
+            transactions, daily = _user_history(rnd, user_id, norm, timezone, now_utc, history_days, max_tx_per_day)
+            tx_rows.extend(transactions)
+            daily_rows.extend(daily)
+
+        # С шардами базы каждая строка едет в шард своего юзера (в первой колонке у всех - user_id)
+        for shard in db.all_shards():
+            with db.get_db_connection(shard=shard) as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO users
+                        (user_id, daily_norm, reset_day, timezone, accumulated_balance, last_recalc_date, balance_since)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [row for row in user_rows if db.shard_of(row[0]) == shard]
+                )
+                conn.executemany(
+                    "INSERT INTO transactions (user_id, amount, created_at_epoch) VALUES (?, ?, ?)",
+                    [row for row in tx_rows if db.shard_of(row[0]) == shard]
+                )
+                conn.executemany(
+                    "INSERT INTO daily_spend (user_id, local_date, total, count) VALUES (?, ?, ?, ?)",
+                    [row for row in daily_rows if db.shard_of(row[0]) == shard]
+                )
+                conn.commit()
+        totals["users"] += len(user_rows)
+        totals["transactions"] += len(tx_rows)
+        totals["daily_spend_rows"] += len(daily_rows)
+
+    logger.info(f"Сгенерирована база {path}: {totals}")
+    return totals
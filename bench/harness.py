@@ -0,0 +1,196 @@
+"""
+Прогон апдейтов через настоящие хендлеры без сети.
+
+Bot API подменяется FakeRequest: getMe и все send*/edit* отвечают заглушками,
+а сами вызовы складываются в список, чтобы можно было проверить ответы бота.
+Апдейты собираются из JSON так же, как их присылает Телеграм, и идут через
+application.process_update - то есть через ConversationHandler'ы, фильтры и
+очередь группового коммита, как в бою.
+
+Юзеры гоняются параллельно (concurrency штук одновременно), но апдейты одного
+юзера - строго по порядку, как в PerChatUpdateProcessor.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+from bot.handlers import register_handlers
+from bot.keyboards import CONFIRM_DELETE_CALLBACK_PREFIX, TIMEZONE_CALLBACK_PREFIX
+from bot.write_queue import transaction_queue
+from .datagen import TIMEZONES, use_database
+from .report import QueryCounter, percentiles
+
+logger = logging.getLogger(__name__)
+
+_BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+class FakeRequest(BaseRequest):
+    """Bot API без сети: на любой метод отвечает ok и запоминает вызов."""
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = _BOT_USER
+        elif api_method == "answerCallbackQuery":
+            result = True
+        else:
+            self.calls.append((api_method, params))
+            result = {
+                "message_id": len(self.calls),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+class UpdateFactory:
+    """Собирает JSON апдейтов в том виде, в каком их шлет Телеграм."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _base(self, user_id: int) -> tuple[int, dict, dict]:
+        update_id = next(self._ids)
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        chat = {"id": user_id, "type": "private", "first_name": user["first_name"]}
+        return update_id, user, chat
+
+    def message(self, user_id: int, text: str) -> dict:
+        update_id, user, chat = self._base(user_id)
+        message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id, user, chat = self._base(user_id)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "chat_instance": str(user_id),
+                "from": user,
+                "data": data,
+                "message": {"message_id": 1, "date": int(time.time()), "chat": chat,
+                            "from": _BOT_USER, "text": "..."},
+            },
+        }
+
+
+def build_application() -> tuple[Application, FakeRequest]:
+    """Приложение с теми же хендлерами, что и в main.py, но с Bot API на заглушках."""
+    request = FakeRequest()
+    application = (
+        Application.builder()
+        .token("1:bench")
+        .request(request)
+        .get_updates_request(FakeRequest())
+        .build()
+    )
+    register_handlers(application)
+    return application, request
+
+
+def user_scenarios(factory: UpdateFactory, user_id: int, rnd: random.Random, transactions: int) -> dict[str, list]:
+    """Фазы жизни одного юзера: регистрация, траты, статус, смена нормы, удаление."""
+    timezone = TIMEZONES[user_id % len(TIMEZONES)]
+    return {
+        "registration": [
+            factory.message(user_id, "/start"),
+            factory.message(user_id, str(rnd.choice([500, 1000, 1500]))),
+            factory.callback(user_id, f"{TIMEZONE_CALLBACK_PREFIX}:{timezone}"),
+        ],
+        "transaction": [
+            factory.message(user_id, f"{rnd.randint(50, 2000)},{rnd.randint(0, 99):02d}") for _ in range(transactions)
+        ],
+        "status": [factory.message(user_id, "/status")],
+        # День сброса ставится при регистрации (по дате сервера), так что смена нормы обычно доступна.
+        # У кого локальная дата уже другая, "1200" уйдет обычной тратой - так же, как у живого юзера.
+        "settings": [factory.message(user_id, "/settings"), factory.message(user_id, "1200")],
+        "delete": [
+            factory.message(user_id, "/delete_me"),
+            factory.callback(user_id, f"{CONFIRM_DELETE_CALLBACK_PREFIX}:yes"),
+        ],
+    }
+
+
+async def _drive(application: Application, per_user: list[list[dict]], concurrency: int) -> list[float]:
+    """Прогоняет апдейты: юзеры параллельно, внутри юзера по порядку. Возвращает задержки в мс."""
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_user(updates: list[dict]):
+        async with semaphore:
+            for payload in updates:
+                update = Update.de_json(payload, application.bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(run_user(updates) for updates in per_user))
+    return latencies
+
+
+async def run_handler_benchmark(path: str, users: int = 500, transactions: int = 10,
+                                concurrency: int = 50, seed: int = 42) -> dict:
+    """
+    Гоняет фазы сценария по очереди для всех юзеров и меряет задержку обработки апдейта
+    и число SQL-запросов на апдейт в каждой фазе.
+    """
+    use_database(path, fresh=True)
+    rnd = random.Random(seed)
+    factory = UpdateFactory()
+    scenarios = [user_scenarios(factory, 100_000_000 + i, rnd, transactions) for i in range(users)]
+
+    counter = QueryCounter()
+    counter.install()
+    application, request = build_application()
+    results = {}
+    try:
+        await application.initialize()
+        transaction_queue.start()
+        for phase in scenarios[0]:
+            per_user = [scenario[phase] for scenario in scenarios]
+            counter.take()
+            replies_before = len(request.calls)
+            started = time.perf_counter()
+            latencies = await _drive(application, per_user, concurrency)
+            elapsed = time.perf_counter() - started
+            queries = counter.take()
+            results[phase] = {
+                **percentiles(latencies),
+                "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+                "queries_per_update": round(queries / len(latencies), 2) if latencies else None,
+                "replies": len(request.calls) - replies_before,
+            }
+            logger.info(f"Фаза {phase}: {results[phase]}")
+        results["write_queue"] = {"batches": transaction_queue.batches, "rows": transaction_queue.rows}
+    finally:
+        await transaction_queue.stop()
+        await application.shutdown()
+        counter.uninstall()
+    return results
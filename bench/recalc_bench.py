@@ -0,0 +1,101 @@
+"""
+Пропускная способность ночного пересчета.
+
+Для каждого размера генерируется база с отставанием пересчета на несколько дней,
+а каждый движок recalc_job.run_recalculations запускается на своей копии этой базы,
+так что все стартуют с одинакового состояния.
+"""
+import logging
+import os
+import shutil
+import time
+
+from bot import db
+from recalc_job import run_recalculations
+from .datagen import generate, use_database
+from .report import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+DEFAULT_ENGINES = ("bulk", "parallel", "loop")
+
+
+def _recalc_state() -> dict[int, tuple]:
+    state = {}
+    for shard in db.all_shards():
+        with db.get_db_connection(shard=shard) as conn:
+            state.update(
+                (row[0], (row[1], row[2]))
+                for row in conn.execute("SELECT user_id, accumulated_balance, last_recalc_date FROM users")
+            )
+    return state
+
+
+def _database_files(path: str) -> list[str]:
+    """Все файлы базы path: шарды (если DB_SHARDS > 1) и их архивы."""
+    files = []
+    for shard in db.all_shards():
+        shard_path = db.shard_path(shard, db_name=path)
+        files += [shard_path, db.archive_path(shard_path)]
+    return files
+
+
+def run_recalc_benchmark(workdir: str, sizes=DEFAULT_SIZES, engines=DEFAULT_ENGINES, history_days: int = 14,
+                         gap_days: int = 3, workers: int | None = None, seed: int = 42) -> list[dict]:
+    """Возвращает по строке результата на каждую пару (размер, движок)."""
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for size in sizes:
+        source = os.path.join(workdir, f"recalc_{size}.db")
+        started = time.perf_counter()
+        dataset = generate(source, size, history_days=history_days, gap_days=gap_days, seed=seed)
+        generate_sec = time.perf_counter() - started
+        # Сколько дней предстоит прокрутить в сумме по всем юзерам
+        due_days = 0
+        for shard in db.all_shards():
+            with db.get_db_connection(shard=shard) as conn:
+                due_days += conn.execute(
+                    "SELECT COALESCE(SUM(julianday('now') - julianday(last_recalc_date)), 0) FROM users"
+                ).fetchone()[0]
+        before = _recalc_state()
+        db.close_db_connections()
+
+        for engine in engines:
+            target = os.path.join(workdir, f"recalc_{size}_{engine}.db")
+            for source_file, target_file in zip(_database_files(source), _database_files(target)):
+                if os.path.exists(source_file):
+                    shutil.copyfile(source_file, target_file)
+            use_database(target)
+            counter = QueryCounter()
+            counter.install()
+            started = time.perf_counter()
+            try:
+                run_recalculations(engine=engine, workers=workers)
+                elapsed = time.perf_counter() - started
+                queries = counter.take()
+            finally:
+                counter.uninstall()
+            use_database(target)
+            after = _recalc_state()
+            updated = sum(1 for user_id, state in after.items() if state != before.get(user_id))
+            row = {
+                "users": size,
+                "engine": engine,
+                **dataset,
+                "generate_sec": round(generate_sec, 2),
+                "due_days_approx": int(due_days),
+                "elapsed_sec": round(elapsed, 3),
+                "users_updated": updated,
+                "rows_per_sec": round(updated / elapsed, 1) if elapsed else None,
+                # Воркеры parallel открывают свои соединения в других процессах - их запросы тут не видны
+                "queries": queries,
+            }
+            results.append(row)
+            logger.info(f"Пересчет {size} юзеров движком {engine}: {elapsed:.2f} сек, обновлено {updated}")
+            db.close_db_connections()
+            for target_file in _database_files(target):
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(target_file + suffix):
+                        os.remove(target_file + suffix)
+    return results
@@ -0,0 +1,98 @@
+"""Общие кусочки для бенчмарков: перцентили, счетчик SQL-запросов и запись отчета."""
+import json
+import platform
+import sqlite3
+import subprocess
+import threading
+from datetime import datetime, timezone
+
+from bot import db
+
+
+def percentiles(samples_ms: list[float]) -> dict:
+    """p50/p95/p99/max по выборке задержек в миллисекундах."""
+    if not samples_ms:
+        return {"count": 0}
+    ordered = sorted(samples_ms)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+class QueryCounter:
+    """
+    Считает SQL-запросы, которые бот отправил в SQLite (включая BEGIN/COMMIT).
+    Цепляется к каждому новому соединению bot/db.py через trace callback.
+    executemany считается по строке на каждый набор параметров - столько раз SQLite и гоняет запрос.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._original_open = None
+
+    def _trace(self, _statement: str):
+        with self._lock:
+            self.count += 1
+
+    def install(self):
+        """Подменяет db._open_connection. Уже открытые соединения закрываем, чтобы переоткрылись с трейсом."""
+        if self._original_open is not None:
+            return
+        original = self._original_open = db._open_connection
+
+        def open_traced(path: str) -> sqlite3.Connection:
+            conn = original(path)
+            conn.set_trace_callback(self._trace)
+            return conn
+
+        db.close_db_connections()
+        db._open_connection = open_traced
+
+    def uninstall(self):
+        if self._original_open is not None:
+            db._open_connection = self._original_open
+            self._original_open = None
+            db.close_db_connections()
+
+    def take(self) -> int:
+        """Сколько запросов набежало с прошлого вызова."""
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(path: str | None, benchmark: str, params: dict, results) -> dict:
+    """Собирает отчет с метаданными прогона и пишет его в JSON (или просто печатает, если path не задан)."""
+    report = {
+        "benchmark": benchmark,
+        "commit": _git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "params": params,
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    return report
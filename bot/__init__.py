@@ -1,2 +1,2 @@
-# Инициализация пакета bot
-# Этот файл позволяет Python распознавать директорию как пакет
+# Инициализация пакета bot
+# Этот файл позволяет Python распознавать директорию как пакет
@@ -0,0 +1,277 @@
+"""
+Допуск апдейтов к хендлерам: защита от флуда и от перегрузки.
+
+Каждое число в чате - это вставка, коммит и пересчет статуса. Без лимитов
+один спамер (или клиент, который залип и шлет одно и то же) занимает пул
+базы и event loop, и все остальные ждут. Поэтому перед хендлерами стоит
+AdmissionControl:
+  * у каждого юзера ведро жетонов: ADMISSION_USER_BURST апдейтов подряд,
+    дальше ADMISSION_USER_RATE_PER_SEC в секунду. Лишнее выкидываем в группе -1,
+    до всех хендлеров, и раз в ADMISSION_NOTICE_INTERVAL_SEC пишем юзеру, что он частит;
+  * одновременно в хендлерах не больше ADMISSION_MAX_IN_FLIGHT апдейтов. Остальные
+    ждут места в очереди до ADMISSION_QUEUE_TIMEOUT_SEC, а если очередь длиннее
+    ADMISSION_MAX_QUEUED или место так и не появилось - апдейт сбрасываем с короткой
+    отпиской: лучше честно сказать "перегружен", чем отвечать всем через минуту;
+  * /status подряд от одного юзера считается один раз: кто пришел, пока расчет идет,
+    ждет его же, а в течение ADMISSION_STATUS_COALESCE_SEC после него получает готовый
+    ответ. Любой другой апдейт из того же чата (трата, /settings, ...) ответ забывает.
+
+Ноль в любой из настроек - это "без ограничения". Сколько отбито и сброшено -
+в метриках bot_admission_*.
+"""
+import asyncio
+import functools
+import logging
+import os
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from .async_db import run_in_db
+from .metrics import ADMISSION_THROTTLED, ADMISSION_SHED, ADMISSION_COALESCED, ADMISSION_IN_FLIGHT, ADMISSION_WAITING
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_USER_RATE_PER_SEC = float(os.getenv("ADMISSION_USER_RATE_PER_SEC", "2"))
+ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "20"))
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "256"))
+ADMISSION_QUEUE_TIMEOUT_SEC = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SEC", "5"))
+ADMISSION_NOTICE_INTERVAL_SEC = float(os.getenv("ADMISSION_NOTICE_INTERVAL_SEC", "10"))
+ADMISSION_STATUS_COALESCE_SEC = float(os.getenv("ADMISSION_STATUS_COALESCE_SEC", "2"))
+
+# Когда словари с ведрами и отписками дорастают до такого размера, чистим из них то, что уже не нужно
+_PRUNE_SIZE = 10_000
+
+THROTTLED_TEXT = "Помедленнее, я не успеваю. Подожди пару секунд и повтори."
+SHED_TEXT = "Я сейчас перегружен, повтори через минуту."
+
+
+def _is_status_command(update: Update) -> bool:
+    message = update.effective_message
+    text = message.text if message is not None else None
+    return bool(text) and (text == "/status" or text.startswith(("/status ", "/status@")))
+
+
+class _Bucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens: float, stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+class _Coalescer:
+    """
+    Один расчет на ключ: кто пришел, пока он идет, ждет его же, а еще window
+    секунд после - получает готовый результат. forget() выкидывает и то, и другое.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._running: dict[int, asyncio.Future] = {}
+        self._done: dict[int, tuple[float, object]] = {}
+
+    async def run(self, key: int, func, *args):
+        """Результат func(*args) в пуле базы - свой, чужой идущий или недавний."""
+        cached = self._done.get(key)
+        if cached is not None:
+            if time.monotonic() - cached[0] < self.window:
+                ADMISSION_COALESCED.inc()
+                return cached[1]
+            del self._done[key]
+        future = self._running.get(key)
+        if future is None:
+            future = self._running[key] = asyncio.ensure_future(run_in_db(func, *args))
+            future.add_done_callback(functools.partial(self._finished, key))
+        else:
+            ADMISSION_COALESCED.inc()
+        # shield: если один из ждущих отвалился, расчет для остальных не отменяем
+        return await asyncio.shield(future)
+
+    def _finished(self, key: int, future: asyncio.Future):
+        if self._running.get(key) is not future:
+            # Пока считали, ключ забыли - результат уже мог устареть, не запоминаем
+            return
+        del self._running[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self.window > 0:
+            if len(self._done) >= _PRUNE_SIZE:
+                self._prune()
+            self._done[key] = (time.monotonic(), future.result())
+
+    def forget(self, key: int):
+        self._running.pop(key, None)
+        self._done.pop(key, None)
+
+    def _prune(self):
+        now = time.monotonic()
+        self._done = {key: value for key, value in self._done.items() if now - value[0] < self.window}
+
+
+class AdmissionControl:
+    """Ведра на юзера (admit в группе -1), общий лимит на хендлеры (guard) и склейка /status."""
+
+    def __init__(self, rate_per_sec: float = ADMISSION_USER_RATE_PER_SEC, burst: int = ADMISSION_USER_BURST,
+                 max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_queued: int = ADMISSION_MAX_QUEUED,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SEC,
+                 notice_interval: float = ADMISSION_NOTICE_INTERVAL_SEC,
+                 status_window: float = ADMISSION_STATUS_COALESCE_SEC):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.notice_interval = notice_interval
+        self.status = _Coalescer(status_window)
+        self._buckets: dict[int, _Bucket] = {}
+        self._noticed: dict[int, float] = {}
+        # Ждущие места. Место не возвращается в общий счет, а передается первому живому ждущему,
+        # так что новенькие не обгоняют очередь.
+        self._waiters: deque[asyncio.Future] = deque()
+        self.in_flight = 0
+        self.throttled = 0
+        self.shed = 0
+
+    # --- ВЕДРО НА ЮЗЕРА ---
+
+    def _take_token(self, user_id: int) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= _PRUNE_SIZE:
+                self._prune_buckets(now)
+            bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.stamp) * self.rate_per_sec)
+            bucket.stamp = now
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def _prune_buckets(self, now: float):
+        """Полные ведра ничем не отличаются от отсутствующих - их и выкидываем."""
+        self._buckets = {
+            user_id: bucket for user_id, bucket in self._buckets.items()
+            if bucket.tokens + (now - bucket.stamp) * self.rate_per_sec < self.burst
+        }
+
+    async def admit(self, update: object, _context: ContextTypes.DEFAULT_TYPE):
+        """Колбэк TypeHandler'а в группе -1: пропускает апдейт дальше или обрывает его обработку."""
+        if not isinstance(update, Update):
+            return
+        user = update.effective_user
+        if self.rate_per_sec > 0 and user is not None and not self._take_token(user.id):
+            self.throttled += 1
+            ADMISSION_THROTTLED.inc()
+            logger.debug("Юзер %s частит, апдейт выкидываем.", user.id)
+            await self._notify(update, THROTTLED_TEXT)
+            raise ApplicationHandlerStop
+        chat = update.effective_chat
+        if chat is not None and not _is_status_command(update):
+            # Что-то поменялось (или могло поменяться) - прошлый /status этого чата больше не годится
+            self.status.forget(chat.id)
+
+    async def _notify(self, update: Update, text: str):
+        """Короткая отписка, не чаще раза в notice_interval на юзера. Не вышло - и ладно."""
+        user = update.effective_user
+        if user is None:
+            return
+        now = time.monotonic()
+        if now - self._noticed.get(user.id, float("-inf")) < self.notice_interval:
+            return
+        if len(self._noticed) >= _PRUNE_SIZE:
+            self._noticed = {
+                user_id: at for user_id, at in self._noticed.items() if now - at < self.notice_interval
+            }
+        self._noticed[user.id] = now
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(text)
+            elif update.effective_message is not None:
+                await update.effective_message.reply_text(text)
+        except TelegramError as e:
+            logger.debug("Не удалось отписать юзеру %s: %s", user.id, e)
+
+    # --- ОБЩИЙ ЛИМИТ НА ХЕНДЛЕРЫ ---
+
+    def _set_gauges(self):
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        ADMISSION_WAITING.set(len(self._waiters))
+
+    def _shed(self, reason: str):
+        self.shed += 1
+        ADMISSION_SHED.inc(1, reason)
+
+    async def _enter(self) -> str | None:
+        """Занимает место в хендлерах. Не вышло - возвращает причину."""
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self._set_gauges()
+            return None
+        if len(self._waiters) >= self.max_queued:
+            return "queue_full"
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._set_gauges()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            # Место могли отдать в тот же момент, когда сработал таймаут
+            if waiter.done() and not waiter.cancelled():
+                return None
+            return "timeout"
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._leave()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            self._set_gauges()
+        return None
+
+    def _leave(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._set_gauges()
+                return
+        self.in_flight -= 1
+        self._set_gauges()
+
+    def guard(self, callback):
+        """Оборачивает колбэк хендлера: ждет места в хендлерах, а не дождался - отписывает и выходит."""
+        if self.max_in_flight <= 0:
+            return callback
+
+        @functools.wraps(callback)
+        async def wrapper(update, context, *args, **kwargs):
+            reason = await self._enter()
+            if reason is not None:
+                self._shed(reason)
+                logger.debug("Перегрузка (%s), апдейт сброшен.", reason)
+                if isinstance(update, Update):
+                    await self._notify(update, SHED_TEXT)
+                # None: диалоги остаются в том же состоянии, юзер просто повторит
+                return None
+            try:
+                return await callback(update, context, *args, **kwargs)
+            finally:
+                self._leave()
+        wrapper.__admission__ = True
+        return wrapper
+
+
+# Один на процесс, как и очередь трат: handlers.register_handlers ставит его перед всеми хендлерами
+admission = AdmissionControl()
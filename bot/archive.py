@@ -0,0 +1,165 @@
+"""
+Горячие и холодные траты: перенос старых сырых транзакций в архив.
+
+Таблица transactions только растет - удаляет из нее один /delete_me. А вся
+бюджетная математика давно живет на дневных сводках (daily_spend) и итогах
+периодов (period_rollup), сырые строки нужны только для /export, /import
+и сверки сводок. Поэтому строки старше ARCHIVE_AFTER_DAYS переезжают в
+отдельный файл архива (схема archive, цепляется к каждому соединению в
+bot/db.py), а горячий файл отдает освободившиеся страницы через
+incremental_vacuum. Дневные сводки и итоги периодов остаются в горячей базе,
+так что /status, /report и пересчет архива вообще не касаются, а выгрузка
+и сверка читают обе базы одним запросом (db.all_transactions).
+
+Перенос идет пачками по id: одна пачка - одна транзакция на оба файла,
+так что бот успевает писать траты между пачками. С шардами базы (DB_SHARDS)
+у каждого шарда свой архив, и шарды переносятся параллельно.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from .async_db import run_in_db
+from .db import get_db_connection, for_each_shard, to_epoch_ms, _UTC
+from .metrics import instrumented
+
+logger = logging.getLogger(__name__)
+
+# Траты старше стольких дней уезжают в архив. 0 - не архивировать.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+# Сколько строк переносим одной транзакцией
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "5000"))
+# Как часто бот сам запускает перенос
+ARCHIVE_INTERVAL_SEC = float(os.getenv("ARCHIVE_INTERVAL_SEC", str(24 * 3600)))
+# Сколько свободных страниц горячей базы отдаем системе за одну пачку
+ARCHIVE_VACUUM_PAGES = int(os.getenv("ARCHIVE_VACUUM_PAGES", "2000"))
+
+# Моложе этого не архивируем ни при каких настройках: последние дни еще нужны пересчету
+_MIN_AGE_DAYS = 7
+
+
+def archive_cutoff(now_utc: datetime | None = None, after_days: int = ARCHIVE_AFTER_DAYS) -> datetime:
+    """Момент, старше которого траты уезжают в архив."""
+    now_utc = now_utc or datetime.now(_UTC)
+    return now_utc - timedelta(days=max(after_days, _MIN_AGE_DAYS))
+
+
+def _move_batch(shard: int, cutoff_ms: int, batch: int) -> int:
+    """Переносит в архив до batch самых старых по id строк старше cutoff_ms. Возвращает, сколько перенесли."""
+    with get_db_connection(shard=shard) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM main.transactions WHERE created_at_epoch < ? ORDER BY id LIMIT ?",
+            (cutoff_ms, batch)
+        )]
+        if not ids:
+            conn.rollback()
+            return 0
+        # Копия и удаление берут одни и те же строки: диапазон id под одной блокировкой на запись
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO archive.archived_transactions (user_id, created_at_epoch, id, amount, author_id)
+            SELECT user_id, created_at_epoch, id, amount, author_id FROM main.transactions
+            WHERE id BETWEEN ? AND ? AND created_at_epoch < ?
+            """,
+            (ids[0], ids[-1], cutoff_ms)
+        )
+        conn.execute(
+            "DELETE FROM main.transactions WHERE id BETWEEN ? AND ? AND created_at_epoch < ?",
+            (ids[0], ids[-1], cutoff_ms)
+        )
+        conn.commit()
+    return len(ids)
+
+
+def _incremental_vacuum(shard: int, pages: int) -> bool:
+    """Отдает системе до pages свободных страниц горячей базы. False - если база не в режиме INCREMENTAL."""
+    with get_db_connection(shard=shard) as conn:
+        if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+            return False
+        # Прагма отдает по странице на шаг, а execute() делает только один шаг - гоняем через executescript
+        conn.executescript(f"PRAGMA main.incremental_vacuum({int(pages)})")
+    return True
+
+
+@instrumented
+def archive_old_transactions(now_utc: datetime | None = None, after_days: int = ARCHIVE_AFTER_DAYS,
+                             batch: int = ARCHIVE_BATCH, vacuum_pages: int = ARCHIVE_VACUUM_PAGES) -> int:
+    """Переносит в архив все траты старше after_days дней. Возвращает число перенесенных строк."""
+    if after_days <= 0:
+        return 0
+    cutoff = archive_cutoff(now_utc, after_days)
+    cutoff_ms = to_epoch_ms(cutoff)
+    started = time.monotonic()
+
+    def archive_shard(shard: int) -> tuple[int, bool]:
+        moved = 0
+        vacuumed = True
+        while True:
+            count = _move_batch(shard, cutoff_ms, batch)
+            moved += count
+            if count and vacuumed:
+                vacuumed = _incremental_vacuum(shard, vacuum_pages)
+            if count < batch:
+                return moved, vacuumed
+
+    results = for_each_shard(archive_shard)
+    moved = sum(count for count, _vacuumed in results)
+    if moved:
+        logger.info(
+            f"В архив уехало {moved} трат старше {cutoff.date()} за {time.monotonic() - started:.1f} сек."
+        )
+        if not all(vacuumed for _count, vacuumed in results):
+            logger.info("Горячая база не в режиме auto_vacuum=INCREMENTAL, место вернет только 'python db_tool.py vacuum'.")
+    return moved
+
+
+def archive_stats() -> dict:
+    """Сколько строк и страниц в горячей базе и в архиве (сумма по шардам)."""
+    def shard_stats(shard: int) -> dict:
+        with get_db_connection(shard=shard) as conn:
+            return {
+                "hot_rows": conn.execute("SELECT COUNT(*) FROM main.transactions").fetchone()[0],
+                "archived_rows": conn.execute("SELECT COUNT(*) FROM archive.archived_transactions").fetchone()[0],
+                "hot_pages": conn.execute("PRAGMA main.page_count").fetchone()[0],
+                "hot_free_pages": conn.execute("PRAGMA main.freelist_count").fetchone()[0],
+                "archive_pages": conn.execute("PRAGMA archive.page_count").fetchone()[0],
+            }
+
+    totals: dict[str, int] = {}
+    for stats in for_each_shard(shard_stats):
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+class ArchiveJob:
+    """Раз в ARCHIVE_INTERVAL_SEC переносит старые траты в архив в пуле потоков базы."""
+
+    def __init__(self, interval: float = ARCHIVE_INTERVAL_SEC):
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None and ARCHIVE_AFTER_DAYS > 0:
+            self._task = asyncio.create_task(self._run(), name="archive-job")
+
+    async def stop(self):
+        """Останавливает задачу. Пачка, которая уже идет в пуле базы, доработает сама."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await run_in_db(archive_old_transactions)
+            except Exception:
+                logger.exception("Перенос трат в архив упал, попробуем в следующий раз.")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,76 @@
+"""
+Асинхронный фасад над bot/db.py.
+
+Хендлеры живут в event loop'е python-telegram-bot, а sqlite3 - синхронный.
+Каждый прямой вызов db.* из корутины стопорит весь loop, и пока один юзер
+ждет коммита, остальные апдейты стоят в очереди. Поэтому тут те же функции,
+что и в db.py, но они гоняются в отдельном пуле потоков для базы.
+
+Синхронный API в db.py никуда не делся - им пользуется recalc_job.py.
+"""
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+# Сколько потоков держим под базу. SQLite все равно пишет в один поток,
+# но читать параллельно может спокойно.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Лениво создает пул потоков для базы."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+        logger.info(f"Запущен пул потоков для базы на {DB_EXECUTOR_WORKERS} воркеров.")
+    return _executor
+
+
+async def run_in_db(func, *args, **kwargs):
+    """Выполняет любую синхронную функцию работы с базой в пуле потоков и ждет результат."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executor(wait: bool = True):
+    """Останавливает пул потоков. Вызывается при остановке бота."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+        logger.info("Пул потоков для базы остановлен.")
+
+
+def _to_async(func):
+    """Делает из синхронной функции db.* корутину с тем же именем и сигнатурой."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_db(func, *args, **kwargs)
+    return wrapper
+
+
+# --- ЗЕРКАЛО bot/db.py ---
+get_user = _to_async(db.get_user)
+create_user = _to_async(db.create_user)
+add_transaction = _to_async(db.add_transaction)
+add_transactions = _to_async(db.add_transactions)
+get_spent_today = _to_async(db.get_spent_today)
+get_spent_on_day = _to_async(db.get_spent_on_day)
+get_member_spent_today = _to_async(db.get_member_spent_today)
+get_all_active_users = _to_async(db.get_all_active_users)
+get_active_timezones = _to_async(db.get_active_timezones)
+get_spent_for_period = _to_async(db.get_spent_for_period)
+get_spend_summary = _to_async(db.get_spend_summary)
+get_period_rollups = _to_async(db.get_period_rollups)
+update_user_balance = _to_async(db.update_user_balance)
+update_daily_norm = _to_async(db.update_daily_norm)
+delete_user = _to_async(db.delete_user)
+set_daily_summary = _to_async(db.set_daily_summary)
@@ -1,198 +1,862 @@
-import sqlite3
-import logging
-from contextlib import contextmanager
-from datetime import datetime, date, timedelta
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-
-logger = logging.getLogger(__name__)
-
-DB_NAME = "data/budget_bot.db"
-
-
-@contextmanager
-def get_db_connection():
-    """
-    Устанавливает соединение с базой и ГАРАНТИРОВАННО закрывает его.
-    Теперь это контекстный менеджер.
-    """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    try:
-        # Отдаем соединение наружу для работы в блоке 'with'
-        yield conn
-    finally:
-        # Этот блок выполнится ВСЕГДА, даже если внутри 'with' произошла ошибка.
-        conn.close()
-        # logger.debug("Соединение с базой данных закрыто") # Можно включить для отладки
-
-
-def init_db():
-    """Создает таблицы, если их еще нет. Теперь с 'with'."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                daily_norm REAL NOT NULL,
-                reset_day INTEGER NOT NULL,
-                timezone TEXT NOT NULL,
-                accumulated_balance REAL NOT NULL DEFAULT 0,
-                last_recalc_date TEXT,
-                is_active BOOLEAN NOT NULL DEFAULT 1
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                created_at_utc TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-        conn.commit()
-    logger.info("База данных инициализирована по финальной схеме v3.0.")
-
-
-def get_user(user_id: int):
-    """Ищет пользователя в базе по его ID."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
-    return user
-
-
-def create_user(user_id: int, daily_norm: float, timezone: str):
-    """Создает нового пользователя в базе данных."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        reset_day = date.today().day
-        try:
-            user_tz = ZoneInfo(timezone)
-            last_recalc_date = datetime.now(user_tz).strftime('%Y-%m-%d')
-        except ZoneInfoNotFoundError:
-            logger.warning(f"Неверная таймзона {timezone} для юзера {user_id}. Ставим по МСК.")
-            last_recalc_date = datetime.now(ZoneInfo("Europe/Moscow")).strftime('%Y-%m-%d')
-
-        cursor.execute(
-            """
-            INSERT INTO users (user_id, daily_norm, reset_day, timezone, last_recalc_date)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (user_id, daily_norm, reset_day, timezone, last_recalc_date)
-        )
-        conn.commit()
-    logger.info(f"В базу добавлен новый пользователь: {user_id} с датой пересчета {last_recalc_date}")
-
-
-def add_transaction(user_id: int, amount: float):
-    """Добавляет новую транзакцию в базу."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        created_at_utc = datetime.now(ZoneInfo("UTC")).isoformat()
-        cursor.execute(
-            "INSERT INTO transactions (user_id, amount, created_at_utc) VALUES (?, ?, ?)",
-            (user_id, amount, created_at_utc)
-        )
-        conn.commit()
-    logger.info(f"Добавлена транзакция {amount} для пользователя {user_id}")
-
-
-def get_spent_today(user_id: int) -> float:
-    """Считает, сколько пользователь потратил за СВОЙ сегодняшний день."""
-    user = get_user(user_id)
-    if not user: return 0.0
-
-    try:
-        user_tz = ZoneInfo(user["timezone"])
-    except ZoneInfoNotFoundError:
-        user_tz = ZoneInfo("Europe/Moscow")
-
-    now_local = datetime.now(user_tz)
-    start_of_day_local = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-    end_of_day_local = start_of_day_local + timedelta(days=1)
-
-    start_of_day_utc = start_of_day_local.astimezone(ZoneInfo("UTC")).isoformat()
-    end_of_day_utc = end_of_day_local.astimezone(ZoneInfo("UTC")).isoformat()
-
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT SUM(amount)
-            FROM transactions
-            WHERE user_id = ?
-              AND created_at_utc >= ?
-              AND created_at_utc < ?
-            """,
-            (user_id, start_of_day_utc, end_of_day_utc)
-        )
-        result = cursor.fetchone()
-
-    return result[0] if result and result[0] is not None else 0.0
-
-
-def get_all_active_users():
-    """Возвращает список всех активных пользователей для пересчета."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE is_active = 1")
-        users = cursor.fetchall()
-    return users
-
-
-def get_spent_for_period(user_id: int, start_utc: str, end_utc: str) -> float:
-    """Считает траты за произвольный период времени (в UTC)."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT SUM(amount)
-            FROM transactions
-            WHERE user_id = ?
-              AND created_at_utc >= ?
-              AND created_at_utc < ?
-            """,
-            (user_id, start_utc, end_utc)
-        )
-        result = cursor.fetchone()
-    return result[0] if result and result[0] is not None else 0.0
-
-
-def update_user_balance(user_id: int, new_balance: float, recalc_date: str):
-    """Обновляет накопленный баланс и дату последнего пересчета."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET accumulated_balance = ?, last_recalc_date = ? WHERE user_id = ?",
-            (new_balance, recalc_date, user_id)
-        )
-        conn.commit()
-    logger.info(f"Баланс пользователя {user_id} обновлен на {new_balance}")
-
-def update_daily_norm(user_id: int, new_norm: float):
-    """Обновляет дневную норму для пользователя."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET daily_norm = ? WHERE user_id = ?",
-            (new_norm, user_id)
-        )
-        conn.commit()
-    logger.info(f"Дневная норма для пользователя {user_id} обновлена на {new_norm}")
-
-
-def delete_user(user_id: int):
-    """
-    Удаляет пользователя и все его транзакции из базы данных.
-    Полное уничтожение, блядь.
-    """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        # Сначала удаляем все транзакции, чтобы не нарушать внешние ключи
-        cursor.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
-        # Затем удаляем самого пользователя
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        conn.commit()
-    logger.info(f"Пользователь {user_id} и все его данные были стерты из базы.")
+import json
+import os
+import sqlite3
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
+
+from .metrics import instrumented
+from .profiling import connection_factory
+from . import periods, tzcalendar
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = os.getenv("DB_NAME", "data/budget_bot.db")
+
+# --- НАСТРОЙКИ СОЕДИНЕНИЙ (все крутится через переменные окружения) ---
+# Держать ли соединения открытыми. 0 - старое поведение: коннект на каждый вызов.
+DB_PERSISTENT_CONNECTIONS = os.getenv("DB_PERSISTENT_CONNECTIONS", "1") == "1"
+# WAL позволяет боту читать, пока пересчет пишет, и наоборот.
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+# В WAL режиме NORMAL безопасен для целостности и сильно дешевле FULL по fsync'ам.
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+# Сколько ждать чужую блокировку, прежде чем падать с "database is locked".
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+# Размер кэша подготовленных запросов на каждое соединение.
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+# Файл архива старых транзакций (см. bot/archive.py). Пусто - рядом с базой, с суффиксом -archive.
+ARCHIVE_DB_NAME = os.getenv("ARCHIVE_DB_NAME", "")
+# На сколько файлов разложены юзеры. 1 - все в одном DB_NAME, как раньше.
+# Поменять на живой базе нельзя: сначала "python db_tool.py reshard --shards N" при остановленном боте.
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+
+# У каждого потока свое соединение: sqlite3-соединения нельзя дергать из разных потоков одновременно.
+_local = threading.local()
+# Все открытые соединения (с pid процесса-владельца), чтобы можно было закрыть их разом при остановке.
+_open_connections: list[tuple[int, sqlite3.Connection]] = []
+_open_connections_lock = threading.Lock()
+# Растет при каждом close_db_connections(), чтобы потоки не схватили уже закрытое соединение.
+_pool_generation = 0
+
+
+def _open_connection(path: str) -> sqlite3.Connection:
+    """Открывает новое соединение и настраивает его прагмами."""
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_CACHED_STATEMENTS,
+        # Закрываем соединения из главного потока при остановке, поэтому проверку отключаем.
+        # Одновременного использования нет: каждое соединение живет в своем потоке.
+        check_same_thread=False,
+        # С PROFILE_SLOW_QUERY_MS - соединение, которое пишет медленные запросы в лог (bot/profiling.py)
+        factory=connection_factory(),
+    )
+    conn.row_factory = sqlite3.Row
+    # Свободные страницы после архивации (bot/archive.py) отдаем по кусочку через incremental_vacuum.
+    # Включается только на пустом файле и до перехода в WAL, на старой базе - после "python db_tool.py vacuum".
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    _attach_archive(conn, path)
+    return conn
+
+
+def archive_path(db_path: str | None = None) -> str:
+    """Путь к файлу архива для файла базы db_path (по умолчанию - для DB_NAME). У каждого шарда свой архив."""
+    db_path = db_path or DB_NAME
+    if ARCHIVE_DB_NAME and DB_SHARDS <= 1:
+        return ARCHIVE_DB_NAME
+    root, ext = os.path.splitext(db_path)
+    return f"{root}-archive{ext or '.db'}"
+
+
+# Таблица архива. {name} - с именем схемы: archive.archived_transactions (миграция 12 подставляет временное)
+_ARCHIVE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id INTEGER NOT NULL,
+        created_at_epoch INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        author_id INTEGER,
+        PRIMARY KEY (user_id, created_at_epoch, id)
+    ) STRICT, WITHOUT ROWID
+"""
+
+
+def _attach_archive(conn: sqlite3.Connection, db_path: str):
+    """
+    Цепляет архив к соединению схемой archive. Архив - отдельный файл, так что горячая база
+    не пухнет от многолетней истории, а запросы все равно могут читать обе одним SELECT.
+    Таблица в архиве без rowid и с ключом (user_id, created_at_epoch, id): лежит сразу
+    в порядке выгрузки, отдельный индекс не нужен. Суммы - в копейках, как и в горячей базе.
+    """
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path(db_path),))
+    # Пустой файл архива сразу заводим с инкрементальной очисткой, потом этот режим уже не включить без VACUUM
+    conn.execute("PRAGMA archive.auto_vacuum=INCREMENTAL")
+    conn.execute(f"PRAGMA archive.journal_mode={DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA archive.synchronous={DB_SYNCHRONOUS}")
+    conn.execute(_ARCHIVE_TABLE_SQL.format(name="archive.archived_transactions"))
+
+
+def all_transactions(columns: tuple[str, ...], where: str = "1") -> str:
+    """
+    SELECT по всем тратам - и горячим, и из архива - для запросов по истории
+    (выгрузка, сверка сводок, дубли при загрузке). Это UNION ALL из двух частей,
+    условие where подставляется в обе, так что параметры к нему передаются дважды.
+    Снаружи можно дописать ORDER BY по колонкам из columns: если его покрывают индексы,
+    SQLite сливает обе части на лету, без сортировки. Если перенос в архив упал между
+    коммитами двух файлов, строка лежит в обоих местах: архивную копию тогда не берем,
+    ее доделает следующий перенос.
+    """
+    return f"""
+        SELECT {", ".join(columns)} FROM main.transactions WHERE {where}
+        UNION ALL
+        SELECT {", ".join(f"a.{column}" for column in columns)} FROM archive.archived_transactions a
+        WHERE {where} AND NOT EXISTS (
+            SELECT 1 FROM main.transactions t
+            WHERE t.id = a.id AND t.user_id = a.user_id AND t.created_at_epoch = a.created_at_epoch
+        )
+    """
+
+
+# --- ШАРДЫ ---
+# SQLite пишет в файл строго по одному. Когда писателей много (очередь трат, пересчет,
+# загрузка CSV), они толкутся на одной блокировке. С DB_SHARDS > 1 юзеры разложены
+# по N файлам по стабильному хешу user_id: все данные юзера (users, траты, сводки,
+# периоды, архив) лежат в одном шарде, так что все запросы про одного юзера идут
+# в один файл, а записи разных юзеров в разные файлы друг друга не ждут.
+# Общее для всех (состояния диалогов, bot/persistence.py) живет в шарде 0.
+
+def shard_of(user_id: int, shards: int | None = None) -> int:
+    """
+    Номер шарда юзера (или группового чата). crc32, а не hash(): hash() от int - само число,
+    а id чатов отрицательные и идут кучками. Результат не зависит ни от процесса, ни от версии питона.
+    """
+    shards = shards or DB_SHARDS
+    if shards <= 1:
+        return 0
+    return zlib.crc32(user_id.to_bytes(8, "little", signed=True)) % shards
+
+
+def shard_path(shard: int, shards: int | None = None, db_name: str | None = None) -> str:
+    """Файл шарда. Без шардов - сам DB_NAME, иначе рядом с ним, с числом шардов в имени."""
+    shards = shards or DB_SHARDS
+    db_name = db_name or DB_NAME
+    if shards <= 1:
+        return db_name
+    root, ext = os.path.splitext(db_name)
+    return f"{root}-shard{shard}of{shards}{ext or '.db'}"
+
+
+def all_shards() -> range:
+    return range(max(DB_SHARDS, 1))
+
+
+_shard_executor: ThreadPoolExecutor | None = None
+_shard_executor_lock = threading.Lock()
+
+
+def for_each_shard(func, shards=None) -> list:
+    """
+    Вызывает func(shard) на каждом шарде (или на перечисленных) параллельно и возвращает
+    результаты в том же порядке. Для операций по всем юзерам: пересчет, сверка, архив, статистика.
+    Пул свой, а не пул bot/async_db.py: сюда приходят как раз из его потоков, и ждать
+    в нем же самого себя - верный дедлок. func не должна снова звать for_each_shard.
+    """
+    global _shard_executor
+    shards = list(all_shards() if shards is None else shards)
+    if len(shards) <= 1:
+        return [func(shard) for shard in shards]
+    with _shard_executor_lock:
+        if _shard_executor is None:
+            _shard_executor = ThreadPoolExecutor(max_workers=max(DB_SHARDS, 2), thread_name_prefix="db-shard")
+    return list(_shard_executor.map(func, shards))
+
+
+def _thread_connection(path: str) -> sqlite3.Connection:
+    """
+    Возвращает долгоживущее соединение текущего потока с файлом path.
+    Переоткрывает его, если пул закрыли или мы оказались в дочернем процессе после fork.
+    """
+    key = (os.getpid(), _pool_generation)
+    if getattr(_local, "key", None) != key:
+        _local.conns, _local.key = {}, key
+    conn = _local.conns.get(path)
+    if conn is not None:
+        return conn
+
+    conn = _open_connection(path)
+    _local.conns[path] = conn
+    with _open_connections_lock:
+        _open_connections.append((os.getpid(), conn))
+    logger.debug(f"Открыто соединение с {path} для потока {threading.current_thread().name}")
+    return conn
+
+
+@contextmanager
+def get_db_connection(user_id: int | None = None, shard: int | None = None):
+    """
+    Выдает соединение с базой для работы в блоке 'with'.
+    С user_id - с шардом этого юзера, с shard - с этим шардом, без них - с шардом 0.
+    Без шардов это всегда один и тот же DB_NAME.
+    Соединения живут по одному на поток и файл и переиспользуются между вызовами,
+    так что прагмы и кэш запросов не пропадают после каждого запроса.
+    Незакоммиченное внутри блока откатывается - как было, когда соединение закрывалось.
+    Блоки можно вкладывать друг в друга: откат делает только самый внешний.
+    """
+    if shard is None:
+        shard = shard_of(user_id) if user_id is not None else 0
+    path = shard_path(shard)
+    if not DB_PERSISTENT_CONNECTIONS:
+        conn = _open_connection(path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    conn = _thread_connection(path)
+    depth = getattr(_local, "depth", None)
+    if depth is None:
+        depth = _local.depth = {}
+    depth[path] = depth.get(path, 0) + 1
+    try:
+        yield conn
+    finally:
+        depth[path] -= 1
+        # Этот блок выполнится ВСЕГДА. Если кто-то не закоммитил или упал посреди записи,
+        # не оставляем висящую транзакцию на общем соединении.
+        if depth[path] == 0 and conn.in_transaction:
+            conn.rollback()
+
+
+def close_db_connections():
+    """
+    Закрывает все долгоживущие соединения. Вызывается при остановке процесса.
+    Соединения, унаследованные через fork от родителя, не трогаем: закрыть их в дочернем
+    процессе - значит влезть в WAL родителя.
+    """
+    global _pool_generation
+    pid = os.getpid()
+    with _open_connections_lock:
+        connections = [conn for owner, conn in _open_connections if owner == pid]
+        _open_connections.clear()
+        _pool_generation += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось закрыть соединение с базой: {e}")
+    logger.debug(f"Закрыто соединений с базой: {len(connections)}")
+
+
+def init_db(offline: bool = False):
+    """
+    Приводит схему базы к последней версии, накатывая недостающие миграции.
+    offline=True - только из db_tool.py при остановленном боте: тогда катятся и офлайновые миграции.
+    """
+    from .migrations import run_migrations
+
+    for shard in all_shards():
+        with get_db_connection(shard=shard) as conn:
+            version = run_migrations(conn, shard_path(shard), offline=offline)
+    shards = f", шардов: {DB_SHARDS}" if DB_SHARDS > 1 else ""
+    logger.info(f"База данных инициализирована, версия схемы: {version}{shards}.")
+
+
+# --- ВРЕМЯ В МИЛЛИСЕКУНДАХ ОТ ЭПОХИ ---
+# В transactions время хранится еще и целым числом (created_at_epoch),
+# по нему и работают все выборки за диапазон.
+_UTC = ZoneInfo("UTC")
+_EPOCH = datetime(1970, 1, 1, tzinfo=_UTC)
+
+
+def to_epoch_ms(moment: datetime) -> int:
+    """Переводит aware-datetime в целые миллисекунды от эпохи (с округлением вниз)."""
+    return (moment - _EPOCH) // timedelta(milliseconds=1)
+
+
+def iso_to_epoch_ms(iso_string: str) -> int:
+    """То же самое для ISO-строки, как она лежит в created_at_utc. Без таймзоны считаем UTC."""
+    moment = datetime.fromisoformat(iso_string)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=_UTC)
+    return to_epoch_ms(moment)
+
+
+def epoch_ms_to_local_date(epoch_ms: int, user_tz: ZoneInfo) -> date:
+    """Локальная дата юзера, на которую пришелся момент времени. Через общий календарь bot/tzcalendar.py."""
+    return tzcalendar.local_date_at_ms(user_tz.key, epoch_ms)
+
+
+# --- КЭШ ЮЗЕРОВ ---
+# Один расход дергает get_user трижды (хендлер, calculate_status, get_spent_today).
+# Держим строки users в памяти: LRU с ограниченным размером и временем жизни записи.
+# Свои записи кэш видит сразу. Чужие (пересчет из соседнего процесса) - через счетчик
+# meta.users_generation, который крутят триггеры. Дергать его на каждый get_user дорого,
+# поэтому сначала смотрим PRAGMA data_version: он меняется, только если кто-то
+# ДРУГОЙ закоммитил в базу, и проверяется без чтения таблиц.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))  # 0 - кэш выключен
+USER_CACHE_TTL_SEC = float(os.getenv("USER_CACHE_TTL_SEC", "300"))
+
+
+def _read_users_generation(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'users_generation'").fetchone()
+    return row[0] if row else 0
+
+
+class _UserCache:
+    """Потокобезопасный LRU-кэш строк users с TTL и счетчиками попаданий."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, sqlite3.Row]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Значение meta.users_generation, с которым согласовано содержимое кэша
+        self._generation: int | None = None
+        # Растет при каждой своей записи. Нужен, чтобы не положить в кэш строку,
+        # прочитанную до записи, а вернувшуюся после нее.
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Последний увиденный каждым потоком (соединение, data_version)
+        self._seen = threading.local()
+
+    def sync(self, conn: sqlite3.Connection):
+        """Сбрасывает кэш, если users поменяли из другого соединения или процесса."""
+        if DB_PERSISTENT_CONNECTIONS:
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            seen = getattr(self._seen, "state", None)
+            # data_version сравним только в пределах одного соединения
+            if seen is not None and seen[0] is conn and seen[1] == data_version and self._generation is not None:
+                return
+            self._seen.state = (conn, data_version)
+        generation = _read_users_generation(conn)
+        with self._lock:
+            if generation != self._generation:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._generation = generation
+
+    def get(self, user_id: int):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def write_token(self) -> int:
+        return self._writes
+
+    def put(self, user_id: int, user: sqlite3.Row, token: int):
+        with self._lock:
+            if token != self._writes:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def after_write(self, user_ids, generation_before: int, generation_after: int):
+        """
+        Вызывается после коммита своей записи в users.
+        Если до нашей записи счетчик уже кто-то крутнул - сбрасываем все, иначе только свои ключи.
+        """
+        with self._lock:
+            self._writes += 1
+            self.invalidations += 1
+            if user_ids is None or generation_before != self._generation:
+                self._entries.clear()
+            else:
+                for user_id in user_ids:
+                    self._entries.pop(user_id, None)
+            self._generation = generation_after
+
+    def clear(self):
+        with self._lock:
+            self._writes += 1
+            self._entries.clear()
+            self._generation = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Счетчик users_generation у каждого шарда свой, поэтому и кэш на шард свой. Размер делим поровну.
+_user_caches: dict[int, _UserCache] = {}
+_user_caches_lock = threading.Lock()
+
+
+def _user_cache(shard: int) -> _UserCache:
+    cache = _user_caches.get(shard)
+    if cache is None:
+        with _user_caches_lock:
+            cache = _user_caches.setdefault(
+                shard, _UserCache(-(-USER_CACHE_SIZE // max(DB_SHARDS, 1)), USER_CACHE_TTL_SEC)
+            )
+    return cache
+
+
+def clear_user_cache():
+    """Сбрасывает кэш юзеров всех шардов (например, после переключения DB_NAME)."""
+    with _user_caches_lock:
+        caches = list(_user_caches.values())
+    for cache in caches:
+        cache.clear()
+
+
+def get_user_cache_stats() -> dict:
+    """Счетчики кэша юзеров, сложенные по шардам: размер, попадания, промахи, сбросы."""
+    with _user_caches_lock:
+        caches = list(_user_caches.values())
+    totals = {"size": 0, "hits": 0, "misses": 0, "invalidations": 0}
+    for cache in caches:
+        for key, value in cache.stats().items():
+            if key in totals:
+                totals[key] += value
+    lookups = totals["hits"] + totals["misses"]
+    totals["hit_ratio"] = totals["hits"] / lookups if lookups else 0.0
+    return totals
+
+
+@contextmanager
+def _users_write(user_ids=None, shard: int | None = None):
+    """
+    Транзакция, которая меняет таблицу users. После коммита вычищает из кэша
+    затронутых юзеров (или весь кэш шарда, если user_ids=None).
+    Транзакция не выходит за один шард: шард берется по первому из user_ids (или явный shard),
+    и все user_ids должны лежать в нем.
+    """
+    if shard is None:
+        shard = shard_of(user_ids[0]) if user_ids else 0
+    with get_db_connection(shard=shard) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        generation_before = _read_users_generation(conn)
+        yield conn
+        generation_after = _read_users_generation(conn)
+        conn.commit()
+    _user_cache(shard).after_write(user_ids, generation_before, generation_after)
+
+
+# Публичные функции под @instrumented друг друга не зовут, иначе один вызов попадает в метрики дважды.
+# Общее тело лежит в _приватной функции без декоратора, и обертки зовут уже его.
+
+@instrumented
+def get_user(user_id: int):
+    """Ищет пользователя по его ID. Сначала в кэше, потом в базе."""
+    return _get_user(user_id)
+
+
+def _get_user(user_id: int):
+    shard = shard_of(user_id)
+    with get_db_connection(shard=shard) as conn:
+        if USER_CACHE_SIZE > 0:
+            cache = _user_cache(shard)
+            cache.sync(conn)
+            user = cache.get(user_id)
+            if user is not None:
+                return user
+            token = cache.write_token()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        user = cursor.fetchone()
+    # Отсутствие юзера не кэшируем: он может зарегистрироваться в любой момент
+    if user is not None and USER_CACHE_SIZE > 0:
+        cache.put(user_id, user, token)
+    return user
+
+
+@instrumented
+def create_user(user_id: int, daily_norm: int, timezone: str):
+    """Создает нового пользователя в базе данных. Норма - в копейках."""
+    with _users_write([user_id]) as conn:
+        cursor = conn.cursor()
+        reset_day = date.today().day
+        if not tzcalendar.is_valid(timezone):
+            logger.warning(f"Неверная таймзона {timezone} для юзера {user_id}. Ставим по МСК.")
+        last_recalc_date = tzcalendar.today(timezone).isoformat()
+
+        cursor.execute(
+            """
+            INSERT INTO users (user_id, daily_norm, reset_day, timezone, last_recalc_date, balance_since)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (user_id, daily_norm, reset_day, timezone, last_recalc_date, last_recalc_date)
+        )
+        # Первый бюджетный период юзера начинается с нулевым балансом
+        periods.open_period(
+            conn, user_id, periods.period_start(date.fromisoformat(last_recalc_date), reset_day), reset_day, 0
+        )
+    logger.info(f"В базу добавлен новый пользователь: {user_id} с датой пересчета {last_recalc_date}")
+
+
+def _add_to_daily_spend(cursor: sqlite3.Cursor, user_id: int, local_date: str, total: int, count: int):
+    """
+    Докидывает траты в дневную сводку. Сложение идет прямо в SQL,
+    без чтения-изменения-записи, так что параллельные вставки ничего не теряют.
+    """
+    cursor.execute(
+        """
+        INSERT INTO daily_spend (user_id, local_date, total, count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, local_date) DO UPDATE
+        SET total = total + excluded.total, count = count + excluded.count
+        """,
+        (user_id, local_date, total, count)
+    )
+
+
+@instrumented
+def add_transaction(user_id: int, amount: int, author_id: int | None = None):
+    """
+    Добавляет новую транзакцию в базу. Сумма - в копейках.
+    В том же коммите обновляется дневная сводка daily_spend по локальной дате юзера.
+    """
+    _add_transactions([(user_id, amount, datetime.now(_UTC), author_id)])
+    # Это горячий путь: на INFO тут логов нет, а аргументы форматируются только если DEBUG включен
+    logger.debug("Добавлена транзакция %s для пользователя %s", amount, user_id)
+
+
+@instrumented
+def add_transactions(entries: list[tuple[int, int, datetime, int | None]]):
+    """
+    Пишет пачку транзакций (бюджет, сумма в копейках, момент в UTC, автор) одним коммитом.
+    Бюджет - user_id юзера или id группового чата, автор - кто потратил (None - сам владелец).
+    Дневные сводки по каждой паре (бюджет, локальная дата) обновляются в том же коммите
+    (с шардами - один коммит на шард).
+    Все изменения сумм - сложением прямо в SQL, так что одновременные траты
+    нескольких участников общего бюджета ничего друг у друга не теряют.
+    """
+    _add_transactions(entries)
+
+
+def _add_transactions(entries: list[tuple[int, int, datetime, int | None]]):
+    if not entries:
+        return
+    zones = {}
+    for user_id, _amount, _moment, _author_id in entries:
+        if user_id not in zones:
+            user = _get_user(user_id)
+            zones[user_id] = user["timezone"] if user else tzcalendar.DEFAULT_TIMEZONE
+
+    daily: dict[tuple[int, str], tuple[int, int]] = {}
+    for user_id, amount, moment, _author_id in entries:
+        key = (user_id, tzcalendar.local_date_at(zones[user_id], moment).isoformat())
+        total, count = daily.get(key, (0, 0))
+        daily[key] = (total + amount, count + 1)
+
+    by_shard: dict[int, list] = {}
+    for entry in entries:
+        by_shard.setdefault(shard_of(entry[0]), []).append(entry)
+
+    def write_shard(shard: int):
+        shard_entries = by_shard[shard]
+        with get_db_connection(shard=shard) as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO transactions (user_id, amount, created_at_epoch, author_id)
+                VALUES (?, ?, ?, ?)
+                """,
+                [
+                    (user_id, amount, to_epoch_ms(moment), author_id)
+                    for user_id, amount, moment, author_id in shard_entries
+                ]
+            )
+            for (user_id, local_date), (total, count) in daily.items():
+                if shard_of(user_id) == shard:
+                    _add_to_daily_spend(cursor, user_id, local_date, total, count)
+            conn.commit()
+
+    # С шардами у каждого файла свой коммит, и идут они параллельно
+    for_each_shard(write_shard, by_shard)
+
+
+@instrumented
+def get_spent_today(user_id: int) -> int:
+    """Считает, сколько пользователь потратил за СВОЙ сегодняшний день (в копейках)."""
+    user = _get_user(user_id)
+    if not user: return 0
+
+    return _get_spent_on_day(user_id, tzcalendar.today(user["timezone"]).isoformat())
+
+
+@instrumented
+def get_spent_on_day(user_id: int, local_date: str) -> int:
+    """Траты юзера за его локальный день 'YYYY-MM-DD'. Одно чтение по первичному ключу daily_spend."""
+    return _get_spent_on_day(user_id, local_date)
+
+
+def _get_spent_on_day(user_id: int, local_date: str) -> int:
+    with get_db_connection(user_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT total FROM daily_spend WHERE user_id = ? AND local_date = ?",
+            (user_id, local_date)
+        )
+        result = cursor.fetchone()
+    return result[0] if result else 0
+
+
+@instrumented
+def get_member_spent_today(budget_id: int, author_id: int) -> int:
+    """
+    Сколько конкретный участник потратил сегодня из общего бюджета.
+    Идет по индексу (user_id, created_at_epoch) только по сегодняшним тратам бюджета.
+    """
+    budget = _get_user(budget_id)
+    if not budget:
+        return 0
+    window = tzcalendar.today_window(budget["timezone"])
+    with get_db_connection(budget_id) as conn:
+        result = conn.execute(
+            """
+            SELECT COALESCE(SUM(amount), 0) FROM transactions
+            WHERE user_id = ? AND created_at_epoch >= ? AND created_at_epoch < ? AND author_id = ?
+            """,
+            (budget_id, window.start_ms, window.end_ms, author_id)
+        ).fetchone()
+    return result[0]
+
+
+@instrumented
+def get_all_active_users():
+    """Возвращает список всех активных пользователей для пересчета (со всех шардов)."""
+    def read_shard(shard: int):
+        with get_db_connection(shard=shard) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE is_active = 1")
+            return cursor.fetchall()
+    return [user for users in for_each_shard(read_shard) for user in users]
+
+
+@instrumented
+def get_active_timezones() -> list[str]:
+    """Все таймзоны, в которых есть активные юзеры. Идет по индексу (timezone, last_recalc_date)."""
+    def read_shard(shard: int):
+        with get_db_connection(shard=shard) as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT timezone FROM users WHERE is_active = 1")]
+    return sorted({timezone for timezones in for_each_shard(read_shard) for timezone in timezones})
+
+
+@instrumented
+def get_spent_for_period(user_id: int, start_utc: str, end_utc: str) -> int:
+    """Считает траты за произвольный период времени (границы - ISO-строки в UTC)."""
+    with get_db_connection(user_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT COALESCE(SUM(amount), 0)
+            FROM transactions
+            WHERE user_id = ?
+              AND created_at_epoch >= ?
+              AND created_at_epoch < ?
+            """,
+            (user_id, iso_to_epoch_ms(start_utc), iso_to_epoch_ms(end_utc))
+        )
+        result = cursor.fetchone()
+    return result[0]
+
+
+@instrumented
+def get_spend_summary(user_id: int, start_date: str, end_date: str, daily_norm: int) -> tuple[int, int]:
+    """
+    Траты за локальные дни с start_date по end_date включительно и сколько из этих дней
+    вылезли за daily_norm. Один проход по диапазону первичного ключа daily_spend.
+    """
+    with get_db_connection(user_id) as conn:
+        total, days_over = conn.execute(
+            """
+            SELECT COALESCE(SUM(total), 0), COALESCE(SUM(total > ?), 0)
+            FROM daily_spend
+            WHERE user_id = ? AND local_date BETWEEN ? AND ?
+            """,
+            (daily_norm, user_id, start_date, end_date)
+        ).fetchone()
+    return total, days_over
+
+
+@instrumented
+def get_period_rollups(user_id: int, limit: int = 2) -> list[sqlite3.Row]:
+    """Последние limit бюджетных периодов юзера из period_rollup, свежие первыми."""
+    with get_db_connection(user_id) as conn:
+        return conn.execute(
+            "SELECT * FROM period_rollup WHERE user_id = ? ORDER BY period_start DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+
+
+@instrumented
+def write_period_boundaries(user_id: int, reset_day: int, daily_norm: int, boundaries: list[tuple[date, int]]):
+    """Закрывает пройденные пересчетом бюджетные периоды и открывает новые (см. bot/periods.py)."""
+    with get_db_connection(user_id) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        periods.write_boundaries(conn, user_id, reset_day, daily_norm, boundaries)
+        conn.commit()
+
+
+@instrumented
+def update_user_balance(user_id: int, new_balance: int, recalc_date: str):
+    """Обновляет накопленный баланс и дату последнего пересчета."""
+    with _users_write([user_id]) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET accumulated_balance = ?, last_recalc_date = ? WHERE user_id = ?",
+            (new_balance, recalc_date, user_id)
+        )
+    logger.debug("Баланс пользователя %s обновлен на %s", user_id, new_balance)
+
+@instrumented
+def update_daily_norm(user_id: int, new_norm: int):
+    """Обновляет дневную норму для пользователя."""
+    with _users_write([user_id]) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET daily_norm = ? WHERE user_id = ?",
+            (new_norm, user_id)
+        )
+    logger.info(f"Дневная норма для пользователя {user_id} обновлена на {new_norm}")
+
+
+@instrumented
+def set_daily_summary(user_id: int, enabled: bool):
+    """Включает или выключает юзеру сводку после ночного пересчета."""
+    with _users_write([user_id]) as conn:
+        conn.execute("UPDATE users SET daily_summary = ? WHERE user_id = ?", (int(enabled), user_id))
+    logger.info(f"Сводка после пересчета для {user_id}: {'включена' if enabled else 'выключена'}")
+
+
+@instrumented
+def get_summary_subscribers(user_ids: list[int]) -> set[int]:
+    """Кто из user_ids подписан на сводку. Список уходит в SQLite одним JSON-параметром, без IN на тысячи '?'."""
+    by_shard: dict[int, list[int]] = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_of(user_id), []).append(user_id)
+
+    def read_shard(shard: int) -> list[int]:
+        with get_db_connection(shard=shard) as conn:
+            return [row[0] for row in conn.execute(
+                """
+                SELECT u.user_id FROM json_each(?) j
+                JOIN users u ON u.user_id = j.value
+                WHERE u.daily_summary = 1
+                """,
+                (json.dumps(by_shard[shard]),)
+            )]
+    return {user_id for shard_ids in for_each_shard(read_shard, by_shard) for user_id in shard_ids}
+
+
+@instrumented
+def delete_user(user_id: int):
+    """
+    Удаляет пользователя и все его транзакции из базы данных.
+    Полное уничтожение, блядь.
+    """
+    with _users_write([user_id]) as conn:
+        cursor = conn.cursor()
+        # Сначала удаляем все транзакции и их дневные сводки, чтобы не нарушать внешние ключи
+        cursor.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM daily_spend WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM period_rollup WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM archive.archived_transactions WHERE user_id = ?", (user_id,))
+        # Затем удаляем самого пользователя
+        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+    logger.info(f"Пользователь {user_id} и все его данные были стерты из базы.")
+
+
+# --- ОБСЛУЖИВАНИЕ ДНЕВНЫХ СВОДОК ---
+
+def _compute_daily_spend(conn: sqlite3.Connection) -> dict[tuple[int, str], tuple[int, int]]:
+    """Считает дневные сводки с нуля по сырым транзакциям (с архивом): (user_id, local_date) -> (total, count)."""
+    zones = {
+        row["user_id"]: tzcalendar.zone(row["timezone"])
+        for row in conn.execute("SELECT user_id, timezone FROM users")
+    }
+    totals: dict[tuple[int, str], tuple[int, int]] = {}
+    for user_id, amount, epoch_ms in conn.execute(
+        # Только исходные колонки transactions: сверку зовет еще миграция 5, до author_id
+        all_transactions(("user_id", "amount", "created_at_epoch"))
+    ):
+        user_tz = zones.get(user_id)
+        if user_tz is None:
+            # Сирота без юзера в сводки не попадает
+            continue
+        key = (user_id, epoch_ms_to_local_date(epoch_ms, user_tz).isoformat())
+        total, count = totals.get(key, (0, 0))
+        totals[key] = (total + amount, count + 1)
+    return totals
+
+
+def _rebuild_daily_spend(conn: sqlite3.Connection, dry_run: bool = False) -> list[tuple]:
+    """
+    Сверяет daily_spend с сырыми транзакциями и, если не dry_run, переписывает сводку целиком.
+    Работает внутри уже открытой транзакции вызывающего. Возвращает список расхождений
+    (user_id, local_date, (total, count) в сводке, (total, count) по факту).
+    """
+    actual = _compute_daily_spend(conn)
+    stored = {
+        (row["user_id"], row["local_date"]): (row["total"], row["count"])
+        for row in conn.execute("SELECT user_id, local_date, total, count FROM daily_spend")
+    }
+    mismatches = []
+    for key in sorted(actual.keys() | stored.keys()):
+        want, have = actual.get(key, (0, 0)), stored.get(key, (0, 0))
+        # Копейки целые - сравниваем точно
+        if want != have:
+            mismatches.append((key[0], key[1], have, want))
+
+    if not dry_run:
+        conn.execute("DELETE FROM daily_spend")
+        conn.executemany(
+            "INSERT INTO daily_spend (user_id, local_date, total, count) VALUES (?, ?, ?, ?)",
+            [(user_id, local_date, total, count) for (user_id, local_date), (total, count) in actual.items()]
+        )
+    return mismatches
+
+
+@instrumented
+def rebuild_daily_spend(dry_run: bool = False) -> list[tuple]:
+    """
+    Пересобирает дневные сводки из сырых транзакций одной транзакцией (на каждом шарде своей, параллельно).
+    С dry_run=True ничего не пишет, а только возвращает расхождения.
+    """
+    def rebuild_shard(shard: int) -> list[tuple]:
+        with get_db_connection(shard=shard) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            shard_mismatches = _rebuild_daily_spend(conn, dry_run=dry_run)
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+        return shard_mismatches
+
+    mismatches = sorted(mismatch for shard_mismatches in for_each_shard(rebuild_shard) for mismatch in shard_mismatches)
+    logger.info(f"Сверка daily_spend: расхождений {len(mismatches)}{'' if dry_run else ', сводка пересобрана'}.")
+    return mismatches
@@ -0,0 +1,162 @@
+"""
+Правка и отмена последних трат (/edit и /undo).
+
+Опечатался в сумме - раньше помогал только /delete_me. А пересчитать историю
+после правки в лоб - значит заново прокрутить весь баланс юзера с первого дня.
+Но баланс - линейная цепочка по тратам (bot/recalc.py): если трата в уже
+пересчитанном дне стала больше на delta, баланс на сегодня просто меньше на delta.
+Поэтому правка - это одна строка в transactions, сложение в daily_spend и,
+если день уже вошел в баланс, сдвиг баланса и итогов периодов на -delta.
+Все одной транзакцией на запись, как загрузка CSV в bot/history.py.
+
+Юзер видит номера с конца (1 - самая свежая), но правим по id траты: номер
+съезжает от каждой новой траты (в группе - от трат соседей), и "/edit 1" поправил бы
+не ту строку, что была в списке. Список последних - несколько строк с конца индекса
+(user_id, created_at_epoch), а не вся история, и трату правим, только если она все еще
+в нем. Правятся только траты из горячей базы: в архив уезжают траты старше недели,
+а таких среди последних нет. В общем бюджете группы каждый правит только свои траты.
+
+С пересчетом не конфликтуем: если юзеру уже пора пересчитываться, правка сначала
+пересчитывает его сама (recalc.recalc_user) под той же блокировкой. Пакетный пересчет,
+успевший прочитать юзера до правки, потом увидит сдвинутый last_recalc_date и юзера
+пропустит - так поправка не затрется балансом, посчитанным по старым тратам.
+Такой пересчет заодно забирает в баланс и сегодняшние траты, так что правка
+сегодняшней траты сразу после него тоже сдвигает баланс.
+"""
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from .db import get_db_connection, _users_write, _add_to_daily_spend, epoch_ms_to_local_date, _EPOCH
+from .metrics import instrumented
+from .periods import apply_spend_delta
+from .recalc import recalc_user
+from . import tzcalendar
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних трат показывает /edit и до какого номера можно дотянуться /edit N и /undo N
+EDIT_RECENT_LIMIT = int(os.getenv("EDIT_RECENT_LIMIT", "10"))
+
+
+class RecentTransaction(NamedTuple):
+    # По нему и правим: в отличие от номера, он не съезжает
+    transaction_id: int
+    # Номер с конца: 1 - самая свежая
+    position: int
+    amount: int
+    # Время траты по часам юзера
+    local_time: datetime
+
+
+class EditResult(NamedTuple):
+    # Суммы - в копейках. new_amount=None - трату отменили
+    old_amount: int
+    new_amount: int | None
+    local_time: datetime
+    # Поправка накопленного баланса, если трата была в уже пересчитанном дне
+    balance_delta: int
+
+
+# Свежие траты бюджета с конца индекса (user_id, created_at_epoch). author_id NULL - все траты бюджета
+_RECENT_SQL = """
+    SELECT id, amount, created_at_epoch FROM transactions
+    WHERE user_id = ? AND (? IS NULL OR author_id = ?)
+    ORDER BY created_at_epoch DESC, id DESC
+    LIMIT ?
+"""
+
+
+def _local_time(epoch_ms: int, user_tz) -> datetime:
+    return (_EPOCH + timedelta(milliseconds=epoch_ms)).astimezone(user_tz)
+
+
+@instrumented
+def recent_transactions(user_id: int, author_id: int | None = None,
+                        limit: int = EDIT_RECENT_LIMIT) -> list[RecentTransaction]:
+    """Последние limit трат бюджета (в группе - только трат author_id), самая свежая первой."""
+    with get_db_connection(user_id) as conn:
+        user = conn.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if user is None:
+            return []
+        rows = conn.execute(_RECENT_SQL, (user_id, author_id, author_id, limit)).fetchall()
+    user_tz = tzcalendar.zone(user["timezone"])
+    return [
+        RecentTransaction(transaction_id, position, amount, _local_time(epoch_ms, user_tz))
+        for position, (transaction_id, amount, epoch_ms) in enumerate(rows, start=1)
+    ]
+
+
+@instrumented
+def change_transaction(user_id: int, transaction_id: int, new_amount: int | None,
+                       author_id: int | None = None) -> EditResult | None:
+    """
+    Меняет сумму траты transaction_id на new_amount (в копейках) или, с new_amount=None, удаляет ее.
+    В той же транзакции поправляет daily_spend, а если день уже пересчитан - баланс и итоги периодов.
+    None - траты нет среди EDIT_RECENT_LIMIT последних (в группе - последних трат author_id) или нет юзера.
+    """
+    with _users_write([user_id]) as conn:
+        # Юзеру пора пересчитываться - пересчитываем сейчас, по тратам до правки
+        recalc = recalc_user(conn, user_id)
+        user = conn.execute(
+            "SELECT timezone, daily_norm, last_recalc_date FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if user is None:
+            return None
+        # Под той же блокировкой: трата все еще среди последних и никуда не денется, пока правим
+        recent = conn.execute(_RECENT_SQL, (user_id, author_id, author_id, EDIT_RECENT_LIMIT)).fetchall()
+        row = next((row for row in recent if row[0] == transaction_id), None)
+        if row is None:
+            return None
+        _id, old_amount, epoch_ms = row
+        user_tz = tzcalendar.zone(user["timezone"])
+        local_date = epoch_ms_to_local_date(epoch_ms, user_tz).isoformat()
+        delta = (new_amount or 0) - old_amount
+
+        _change_row(conn, user_id, transaction_id, epoch_ms, new_amount)
+        _add_to_daily_spend(conn.cursor(), user_id, local_date, delta, -1 if new_amount is None else 0)
+        if new_amount is None:
+            # Пустой день выкидываем, как будто трат в нем и не было (так его считает и сверка сводок)
+            conn.execute(
+                "DELETE FROM daily_spend WHERE user_id = ? AND local_date = ? AND count = 0", (user_id, local_date)
+            )
+        balance_delta = 0
+        # Дни до last_recalc_date уже вошли в баланс - сдвигаем его на -delta,
+        # остальные дни пересчет подхватит сам из daily_spend
+        balance_day = None
+        if local_date < user["last_recalc_date"]:
+            balance_day = local_date
+        elif recalc is not None and local_date == recalc.new_recalc_date:
+            # Пересчет выше только что прошел и уже забрал сегодняшние траты (spent_today)
+            # со старой суммой. roll_balance вешает их на первый прокрученный день - от него и сдвигаем
+            balance_day = recalc.last_recalc_date
+        if delta and balance_day is not None:
+            apply_spend_delta(conn, user_id, balance_day, delta, user["daily_norm"])
+            balance_delta = -delta
+            conn.execute(
+                "UPDATE users SET accumulated_balance = accumulated_balance + ? WHERE user_id = ?",
+                (balance_delta, user_id)
+            )
+    logger.debug("Трата %s юзера %s: %s -> %s", transaction_id, user_id, old_amount, new_amount)
+    return EditResult(old_amount, new_amount, _local_time(epoch_ms, user_tz), balance_delta)
+
+
+def _change_row(conn: sqlite3.Connection, user_id: int, transaction_id: int, epoch_ms: int, new_amount: int | None):
+    """
+    Правит или удаляет саму строку. Копию в архиве (если перенос упал между коммитами двух файлов)
+    правим так же, иначе после удаления она всплывет в выгрузке вместо горячей строки.
+    """
+    if new_amount is None:
+        conn.execute("DELETE FROM transactions WHERE id = ?", (transaction_id,))
+        conn.execute(
+            "DELETE FROM archive.archived_transactions WHERE user_id = ? AND created_at_epoch = ? AND id = ?",
+            (user_id, epoch_ms, transaction_id)
+        )
+    else:
+        conn.execute("UPDATE transactions SET amount = ? WHERE id = ?", (new_amount, transaction_id))
+        conn.execute(
+            "UPDATE archive.archived_transactions SET amount = ? WHERE user_id = ? AND created_at_epoch = ? AND id = ?",
+            (new_amount, user_id, epoch_ms, transaction_id)
+        )
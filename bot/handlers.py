@@ -1,240 +1,611 @@
-import logging
-from datetime import datetime
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-from telegram import Update
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    ConversationHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-    filters,
-)
-
-# Импортируем новую клавиатуру
-from .keyboards import (
-    TIMEZONE_KEYBOARD, TIMEZONE_CALLBACK_PREFIX,
-    CONFIRM_DELETE_KEYBOARD, CONFIRM_DELETE_CALLBACK_PREFIX
-)
-# Импортируем новую функцию из db.py
-from .db import create_user, get_user, add_transaction, update_daily_norm, delete_user
-from .logic import calculate_status
-
-logger = logging.getLogger(__name__)
-
-# Определяем состояния для ТРЕХ разных диалогов.
-GET_NORM, GET_TIMEZONE = 0, 1
-CHANGING_NORM = 2
-CONFIRM_DELETION = 3
-
-
-# --- ДИАЛОГ РЕГИСТРАЦИИ ---
-async def start(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = update.effective_user
-    db_user = get_user(user.id)
-    if db_user:
-        await update.message.reply_text("Ты уже в системе, вояка. Вноси траты или жми /status.")
-        return ConversationHandler.END
-    await update.message.reply_text(
-        f"Здарова, {user.first_name}. Вижу тебя впервые.\nДавай определим твою дневную норму трат. Сколько рублей в день ты хочешь тратить? Просто отправь число.")
-    return GET_NORM
-
-
-# ... (код get_norm, get_timezone остается без изменений) ...
-async def get_norm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        daily_norm = float(update.message.text)
-        if daily_norm <= 0:
-            raise ValueError
-    except (ValueError, TypeError):
-        await update.message.reply_text("Это не похоже на положительное число. А ну-ка, введи нормально.")
-        return GET_NORM
-    context.user_data['daily_norm'] = daily_norm
-    await update.message.reply_text("Принято. Теперь выбери свой часовой пояс...", reply_markup=TIMEZONE_KEYBOARD)
-    return GET_TIMEZONE
-
-
-async def get_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    timezone_str = query.data.split(":")[1]
-    daily_norm = context.user_data.get('daily_norm')
-    user = update.effective_user
-    create_user(user_id=user.id, daily_norm=daily_norm, timezone=timezone_str)
-    context.user_data.clear()
-    await query.edit_message_text(
-        text=f"Отлично! Твоя норма: {daily_norm} руб/день.\nТвой часовой пояс: {timezone_str}.\nТеперь просто присылай мне числа, когда что-то потратишь.")
-    return ConversationHandler.END
-
-
-# --- ОБЩАЯ ФУНКЦИЯ ОТМЕНЫ ДЛЯ ВСЕХ ДИАЛОГОВ ---
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data.clear()
-    await update.message.reply_text("Действие отменено.")
-    return ConversationHandler.END
-
-
-# --- ДИАЛОГ ДЛЯ /settings ---
-async def settings_entry(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
-    # ... (код settings_entry и receive_new_norm остается без изменений) ...
-    user_id = update.effective_user.id
-    db_user = get_user(user_id)
-    if not db_user:
-        await update.message.reply_text("Сначала зарегистрируйся через /start, умник.")
-        return ConversationHandler.END
-    try:
-        user_tz = ZoneInfo(db_user["timezone"])
-    except ZoneInfoNotFoundError:
-        user_tz = ZoneInfo("Europe/Moscow")
-    today_day_number = datetime.now(user_tz).day
-    reset_day = db_user["reset_day"]
-    if today_day_number == reset_day:
-        norm_str = str(db_user['daily_norm']).replace('.', ',')
-        await update.message.reply_text(
-            f"Твоя текущая норма: `{norm_str}` руб\\.\n"
-            "Сегодня твой день сброса! Введи новую дневную норму, если хочешь ее поменять\\.",
-            parse_mode='MarkdownV2'
-        )
-        return CHANGING_NORM
-    else:
-        await update.message.reply_text(
-            f"Сегодня не твой день\\. Смена нормы доступна только *{reset_day}* числа каждого месяца\\.\n"
-            "Приходи позже, салага\\.",
-            parse_mode='MarkdownV2'
-        )
-        return ConversationHandler.END
-
-
-async def receive_new_norm(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        new_norm = float(update.message.text.strip().replace(',', '.'))
-        if new_norm <= 0:
-            raise ValueError
-    except (ValueError, TypeError):
-        await update.message.reply_text("Это не похоже на сумму. Введи нормальное число или жми /cancel\\.")
-        return CHANGING_NORM
-    user_id = update.effective_user.id
-    update_daily_norm(user_id, new_norm)
-    norm_str = str(new_norm).replace('.', ',')
-    await update.message.reply_text(f"Принято\\. Твоя новая дневная норма: `{norm_str}` руб\\.",
-                                    parse_mode='MarkdownV2')
-    return ConversationHandler.END
-
-
-# --- НОВЫЙ ДИАЛОГ ДЛЯ /delete_me ---
-
-async def delete_me_entry(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Входная точка для диалога удаления. Спрашивает подтверждение."""
-    user_id = update.effective_user.id
-    if not get_user(user_id):
-        await update.message.reply_text("Тебя и так нет в базе, чего удалять-то?")
-        return ConversationHandler.END
-
-    await update.message.reply_text(
-        "Ты уверен, что хочешь *ПОЛНОСТЬЮ* удалить все свои данные?\n"
-        "Это действие необратимо. Весь твой накопленный баланс и история трат будут стерты к хуям.",
-        reply_markup=CONFIRM_DELETE_KEYBOARD,
-        parse_mode='Markdown'  # Используем обычный Markdown, он проще
-    )
-    return CONFIRM_DELETION
-
-
-async def confirm_deletion(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает нажатие кнопок 'Да' или 'Нет'."""
-    query = update.callback_query
-    await query.answer()
-
-    # Получаем 'yes' или 'no' из callback_data
-    choice = query.data.split(":")[1]
-
-    if choice == "yes":
-        user_id = update.effective_user.id
-        delete_user(user_id)
-        await query.edit_message_text("Все твои данные уничтожены. Можешь начать с чистого листа через /start.")
-    else:
-        await query.edit_message_text("Правильное решение. Удаление отменено.")
-
-    return ConversationHandler.END
-
-
-# --- ОБРАБОТЧИКИ ВНЕ ДИАЛОГОВ ---
-async def status_handler(update: Update, _context: ContextTypes.DEFAULT_TYPE):
-    # ... (код status_handler и transaction_handler остается без изменений) ...
-    user_id = update.effective_user.id
-    user_status = calculate_status(user_id)
-    if not user_status:
-        await update.message.reply_text("Сначала пройди регистрацию через /start.")
-        return
-    norm_str = str(round(user_status['base_norm'], 2)).replace('.', ',')
-    balance_str = str(round(user_status['balance'], 2)).replace('.', ',')
-    available_str = str(round(user_status['available_today'], 2)).replace('.', ',')
-    spent_str = str(round(user_status['spent_today'], 2)).replace('.', ',')
-    remaining_str = str(round(user_status['remaining_today'], 2)).replace('.', ',')
-    text = (
-        f"📊 *Твоя сводка на сегодня:*\n\n"
-        f"Базовая норма: `{norm_str}`\n"
-        f"Накоплено/долг: `{balance_str}`\n\n"
-        f"✅ *Доступно сегодня:* `{available_str}`\n"
-        f" потрачено: `{spent_str}`\n"
-        f" остаток: `{remaining_str}`"
-    )
-    await update.message.reply_text(text, parse_mode='MarkdownV2')
-
-
-async def transaction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if not get_user(user_id):
-        await update.message.reply_text("Не понимаю. Если хочешь начать, жми /start.")
-        return
-    try:
-        amount = float(update.message.text.strip().replace(',', '.'))
-        if amount <= 0: raise ValueError
-    except (ValueError, TypeError):
-        await update.message.reply_text("Это не похоже на сумму\\. Просто пришли число, например `150` или `123\\.45`",
-                                        parse_mode='MarkdownV2')
-        return
-    add_transaction(user_id, amount)
-    await status_handler(update, context)
-
-
-# --- РЕГИСТРАЦИЯ ВСЕХ ОБРАБОТЧИКОВ ---
-def register_handlers(application: Application):
-    """Регистрирует все обработчики в приложении."""
-
-    registration_conv = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            GET_NORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_norm)],
-            GET_TIMEZONE: [CallbackQueryHandler(get_timezone, pattern=f"^{TIMEZONE_CALLBACK_PREFIX}:")],
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        conversation_timeout=600
-    )
-
-    settings_conv = ConversationHandler(
-        entry_points=[CommandHandler("settings", settings_entry)],
-        states={
-            CHANGING_NORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_new_norm)],
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        conversation_timeout=300
-    )
-
-    # Новый диалог удаления
-    delete_conv = ConversationHandler(
-        entry_points=[CommandHandler("delete_me", delete_me_entry)],
-        states={
-            CONFIRM_DELETION: [CallbackQueryHandler(confirm_deletion, pattern=f"^{CONFIRM_DELETE_CALLBACK_PREFIX}:")],
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        conversation_timeout=60
-    )
-
-    application.add_handler(registration_conv)
-    application.add_handler(settings_conv)
-    application.add_handler(delete_conv)  # Добавляем новый диалог
-
-    application.add_handler(CommandHandler("status", status_handler))
-    application.add_handler(
-        MessageHandler(filters.Regex(r'^\d+([.,]\d{1,2})?$') & ~filters.COMMAND, transaction_handler))
+import logging
+import os
+from tempfile import SpooledTemporaryFile
+from telegram import Chat, ChatMember, Update
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    ConversationHandler,
+    MessageHandler,
+    CallbackQueryHandler,
+    TypeHandler,
+    ContextTypes,
+    filters,
+)
+
+# Импортируем новую клавиатуру
+from .keyboards import (
+    TIMEZONE_KEYBOARD, TIMEZONE_CALLBACK_PREFIX,
+    CONFIRM_DELETE_KEYBOARD, CONFIRM_DELETE_CALLBACK_PREFIX
+)
+# Работаем с базой только через асинхронный фасад, чтобы не блокировать event loop
+from .async_db import (
+    create_user, get_user, update_daily_norm, delete_user, get_member_spent_today, set_daily_summary, run_in_db,
+)
+from .logic import calculate_status, build_report, parse_amounts, AMOUNTS_MESSAGE_RE
+from .history import export_transactions_csv, import_transactions_csv
+from .edits import recent_transactions, change_transaction, EDIT_RECENT_LIMIT
+from .metrics import timed_handler
+from .profiling import handler_profiler
+from .write_queue import transaction_queue
+from .admission import admission
+from . import money, tzcalendar
+
+logger = logging.getLogger(__name__)
+
+# Определяем состояния для ТРЕХ разных диалогов.
+GET_NORM, GET_TIMEZONE = 0, 1
+CHANGING_NORM = 2
+CONFIRM_DELETION = 3
+WAITING_IMPORT_FILE = 4
+
+# Файлы для /export и /import держим в памяти до этого размера, дальше они уходят во временный файл на диске
+HISTORY_SPOOL_BYTES = int(os.getenv("HISTORY_SPOOL_BYTES", str(1024 * 1024)))
+# Больше 20 МБ бот все равно не может скачать из Телеграма
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+
+
+# --- ЛИЧНЫЙ ИЛИ ОБЩИЙ БЮДЖЕТ ---
+# В групповом чате бюджет общий: это строка users с id чата (у групп он отрицательный),
+# а кто именно потратил, пишется в transactions.author_id. В личке все как раньше.
+# Чтобы бот видел в группе простые числа, у него должен быть выключен privacy mode
+# (или он должен быть админом чата).
+def _is_group(update: Update) -> bool:
+    chat = update.effective_chat
+    return chat is not None and chat.type in (Chat.GROUP, Chat.SUPERGROUP)
+
+
+def _budget_id(update: Update) -> int:
+    """Чей бюджет трогаем: в группе - общий бюджет чата, в личке - свой."""
+    return update.effective_chat.id if _is_group(update) else update.effective_user.id
+
+
+def _author_id(update: Update) -> int | None:
+    """Кто потратил: в группе - участник, в личке - None (сам владелец)."""
+    return update.effective_user.id if _is_group(update) else None
+
+
+async def _is_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    member = await context.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
+    return member.status in (ChatMember.OWNER, ChatMember.ADMINISTRATOR)
+
+
+# --- ДИАЛОГ РЕГИСТРАЦИИ ---
+async def start(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = update.effective_user
+    db_user = await get_user(_budget_id(update))
+    if db_user:
+        await update.message.reply_text("Ты уже в системе, вояка. Вноси траты или жми /status.")
+        return ConversationHandler.END
+    if _is_group(update):
+        await update.message.reply_text(
+            f"Здарова, {user.first_name}. Заводим общий бюджет на весь чат.\nСколько рублей в день тратите на всех? Просто отправь число.")
+    else:
+        await update.message.reply_text(
+            f"Здарова, {user.first_name}. Вижу тебя впервые.\nДавай определим твою дневную норму трат. Сколько рублей в день ты хочешь тратить? Просто отправь число.")
+    return GET_NORM
+
+
+async def get_norm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        daily_norm = money.parse(update.message.text)
+        if daily_norm <= 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        await update.message.reply_text(
+            f"Это не похоже на положительное число до {money.to_text(money.MAX_AMOUNT)}. А ну-ка, введи нормально.")
+        return GET_NORM
+    # В копейках. Ключ новый: под старым 'daily_norm' из базы может подняться недоконченная регистрация в рублях
+    context.user_data['daily_norm_kopecks'] = daily_norm
+    await update.message.reply_text("Принято. Теперь выбери свой часовой пояс...", reply_markup=TIMEZONE_KEYBOARD)
+    return GET_TIMEZONE
+
+
+async def get_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    timezone_str = query.data.split(":")[1]
+    daily_norm = context.user_data.get('daily_norm_kopecks')
+    if daily_norm is None and context.user_data.get('daily_norm') is not None:
+        daily_norm = money.from_float(context.user_data['daily_norm'])
+    if daily_norm is None:
+        # Шаг диалога поднялся из базы, а user_data уже пустой (/cancel в другом диалоге, clear()) -
+        # норму спрашиваем заново, а не падаем
+        await query.edit_message_text("Норму я уже забыл. Сколько рублей в день тратим? Просто отправь число.")
+        return GET_NORM
+    await create_user(user_id=_budget_id(update), daily_norm=daily_norm, timezone=timezone_str)
+    context.user_data.clear()
+    who = "Общая норма чата" if _is_group(update) else "Твоя норма"
+    await query.edit_message_text(
+        text=f"Отлично! {who}: {money.to_text(daily_norm)} руб/день.\nЧасовой пояс: {timezone_str}.\nТеперь просто присылай мне числа, когда что-то потратишь.")
+    return ConversationHandler.END
+
+
+# --- ОБЩАЯ ФУНКЦИЯ ОТМЕНЫ ДЛЯ ВСЕХ ДИАЛОГОВ ---
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.clear()
+    await update.message.reply_text("Действие отменено.")
+    return ConversationHandler.END
+
+
+# --- ДИАЛОГ ДЛЯ /settings ---
+async def settings_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    db_user = await get_user(_budget_id(update))
+    if not db_user:
+        await update.message.reply_text("Сначала зарегистрируйся через /start, умник.")
+        return ConversationHandler.END
+    if _is_group(update) and not await _is_chat_admin(update, context):
+        await update.message.reply_text("Общую норму чата меняют только админы.")
+        return ConversationHandler.END
+    today_day_number = tzcalendar.today(db_user["timezone"]).day
+    reset_day = db_user["reset_day"]
+    if today_day_number == reset_day:
+        norm_str = money.to_text(db_user['daily_norm'])
+        await update.message.reply_text(
+            f"Твоя текущая норма: `{norm_str}` руб\\.\n"
+            "Сегодня твой день сброса! Введи новую дневную норму, если хочешь ее поменять\\.",
+            parse_mode='MarkdownV2'
+        )
+        return CHANGING_NORM
+    else:
+        await update.message.reply_text(
+            f"Сегодня не твой день\\. Смена нормы доступна только *{reset_day}* числа каждого месяца\\.\n"
+            "Приходи позже, салага\\.",
+            parse_mode='MarkdownV2'
+        )
+        return ConversationHandler.END
+
+
+async def receive_new_norm(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        new_norm = money.parse(update.message.text)
+        if new_norm <= 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        await update.message.reply_text(
+            f"Это не похоже на сумму\\. Введи нормальное число до {money.to_text(money.MAX_AMOUNT)} или жми /cancel\\.",
+            parse_mode='MarkdownV2'
+        )
+        return CHANGING_NORM
+    await update_daily_norm(_budget_id(update), new_norm)
+    norm_str = money.to_text(new_norm)
+    await update.message.reply_text(f"Принято\\. Твоя новая дневная норма: `{norm_str}` руб\\.",
+                                    parse_mode='MarkdownV2')
+    return ConversationHandler.END
+
+
+# --- НОВЫЙ ДИАЛОГ ДЛЯ /delete_me ---
+
+async def delete_me_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Входная точка для диалога удаления. Спрашивает подтверждение."""
+    if not await get_user(_budget_id(update)):
+        await update.message.reply_text("Тебя и так нет в базе, чего удалять-то?")
+        return ConversationHandler.END
+    if _is_group(update) and not await _is_chat_admin(update, context):
+        await update.message.reply_text("Общий бюджет чата сносят только админы.")
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        "Ты уверен, что хочешь *ПОЛНОСТЬЮ* удалить все свои данные?\n"
+        "Это действие необратимо. Весь твой накопленный баланс и история трат будут стерты к хуям.",
+        reply_markup=CONFIRM_DELETE_KEYBOARD,
+        parse_mode='Markdown'  # Используем обычный Markdown, он проще
+    )
+    return CONFIRM_DELETION
+
+
+async def confirm_deletion(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обрабатывает нажатие кнопок 'Да' или 'Нет'."""
+    query = update.callback_query
+    await query.answer()
+
+    # Получаем 'yes' или 'no' из callback_data
+    choice = query.data.split(":")[1]
+
+    if choice == "yes":
+        await delete_user(_budget_id(update))
+        await query.edit_message_text("Все твои данные уничтожены. Можешь начать с чистого листа через /start.")
+    else:
+        await query.edit_message_text("Правильное решение. Удаление отменено.")
+
+    return ConversationHandler.END
+
+
+# --- ВЫГРУЗКА И ЗАГРУЗКА ИСТОРИИ ---
+async def export_handler(update: Update, _context: ContextTypes.DEFAULT_TYPE):
+    """/export - вся история трат CSV-файлом."""
+    user_id = _budget_id(update)
+    if not await get_user(user_id):
+        await update.message.reply_text("Сначала пройди регистрацию через /start.")
+        return
+    with SpooledTemporaryFile(max_size=HISTORY_SPOOL_BYTES) as buffer:
+        count = await run_in_db(export_transactions_csv, user_id, buffer)
+        if not count:
+            await update.message.reply_text("Выгружать нечего, ты еще ничего не потратил.")
+            return
+        buffer.seek(0)
+        await update.message.reply_document(
+            document=buffer,
+            filename=f"transactions_{user_id}.csv",
+            caption=f"Вся твоя история: {count} трат. Этот же файл можно потом скормить /import."
+        )
+
+
+async def import_entry(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
+    """/import - ждем CSV-файл."""
+    if not await get_user(_budget_id(update)):
+        await update.message.reply_text("Сначала пройди регистрацию через /start.")
+        return ConversationHandler.END
+    await update.message.reply_text(
+        "Пришли CSV-файлом. Нужны колонки created_at_utc (или created_at) и amount, как в /export.\n"
+        "Время без таймзоны считаю твоим местным. Повторы не задвоятся.\n"
+        "Траты раньше твоей регистрации в боте лягут в историю и отчеты, но баланс не тронут. Передумал - /cancel."
+    )
+    return WAITING_IMPORT_FILE
+
+
+async def receive_import_file(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(f"Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ, такое не переварю.")
+        return ConversationHandler.END
+
+    telegram_file = await document.get_file()
+    with SpooledTemporaryFile(max_size=HISTORY_SPOOL_BYTES) as buffer:
+        await telegram_file.download_to_memory(out=buffer)
+        buffer.seek(0)
+        result = await run_in_db(import_transactions_csv, _budget_id(update), buffer)
+
+    lines = [f"Загружено трат: {result.imported}", f"Повторов пропущено: {result.duplicates}"]
+    if result.invalid:
+        lines.append(f"Битых строк: {result.invalid}")
+    if result.balance_delta:
+        lines.append(f"Накопленный баланс поправлен на {money.to_text(result.balance_delta)}")
+    if result.before_balance:
+        lines.append(f"Из них до твоей регистрации в боте: {result.before_balance} - "
+                     "они только в истории, баланс их не считает")
+    if result.errors:
+        lines.append("")
+        lines.extend(result.errors)
+    await update.message.reply_text("\n".join(lines))
+    return ConversationHandler.END
+
+
+# --- ОБРАБОТЧИКИ ВНЕ ДИАЛОГОВ ---
+async def status_handler(update: Update, _context: ContextTypes.DEFAULT_TYPE, header: str = "",
+                         fresh: bool = False):
+    # header - уже экранированный под MarkdownV2 текст перед сводкой (что только что записали)
+    # fresh - только что писали в базу, чужой (склеенный) расчет не годится
+    user_id = _budget_id(update)
+    # Вся арифметика со статусом - два запроса в базу, гоняем их одним заходом в пул.
+    # /status подряд от одного юзера считаем один раз (bot/admission.py)
+    if fresh:
+        user_status = await run_in_db(calculate_status, user_id)
+    else:
+        user_status = await admission.status.run(user_id, calculate_status, user_id)
+    if not user_status:
+        await update.message.reply_text("Сначала пройди регистрацию через /start.")
+        return
+    norm_str = money.to_text(user_status['base_norm'])
+    balance_str = money.to_text(user_status['balance'])
+    available_str = money.to_text(user_status['available_today'])
+    spent_str = money.to_text(user_status['spent_today'])
+    remaining_str = money.to_text(user_status['remaining_today'])
+    text = header + (
+        f"📊 *Твоя сводка на сегодня:*\n\n"
+        f"Базовая норма: `{norm_str}`\n"
+        f"Накоплено/долг: `{balance_str}`\n\n"
+        f"✅ *Доступно сегодня:* `{available_str}`\n"
+        f" потрачено: `{spent_str}`\n"
+        f" остаток: `{remaining_str}`"
+    )
+    if _is_group(update):
+        member_spent = await get_member_spent_today(user_id, update.effective_user.id)
+        text += f"\n\nИз них твои: `{money.to_text(member_spent)}`"
+    await update.message.reply_text(text, parse_mode='MarkdownV2')
+
+
+# /summary on|off - сводка после ночного пересчета (шлет bot/scheduler.py). Без аргумента - переключает.
+async def summary_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    budget_id = _budget_id(update)
+    db_user = await get_user(budget_id)
+    if not db_user:
+        await update.message.reply_text("Сначала пройди регистрацию через /start.")
+        return
+    arg = context.args[0].lower() if context.args else ""
+    if arg in ("on", "вкл"):
+        enabled = True
+    elif arg in ("off", "выкл"):
+        enabled = False
+    else:
+        enabled = not db_user["daily_summary"]
+    await set_daily_summary(budget_id, enabled)
+    if enabled:
+        await update.message.reply_text(
+            "Ок, каждую ночь после пересчета буду присылать итоги дня и сколько можно тратить сегодня. "
+            "Выключить: /summary off")
+    else:
+        await update.message.reply_text("Ок, итоги дня больше не шлю. Включить обратно: /summary on")
+
+
+# Больше года назад /report не заглядывает
+REPORT_MAX_DAYS = 366
+
+
+def _format_period(title: str, period: dict, base_norm: int) -> str:
+    start, end = period["start"].strftime("%d.%m"), period["end"].strftime("%d.%m")
+    budget = base_norm * period["days_passed"]
+    lines = [
+        f"{title} ({start} - {end}, прошло дней {period['days_passed']} из {period['days']}):",
+        f"  потрачено: {money.to_text(period['total'])} из {money.to_text(budget)} по норме",
+        f"  дней сверх нормы: {period['days_over']}",
+    ]
+    if period["start_balance"] is not None:
+        lines.append(f"  баланс на начало: {money.to_text(period['start_balance'])}")
+    if period["end_balance"] is not None:
+        lines.append(f"  баланс на конец: {money.to_text(period['end_balance'])}")
+    return "\n".join(lines)
+
+
+async def report_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/report - текущий и прошлый бюджетный период, /report N - последние N дней."""
+    user_id = _budget_id(update)
+    last_days = None
+    if context.args:
+        try:
+            last_days = int(context.args[0])
+            if not 1 <= last_days <= REPORT_MAX_DAYS:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text(f"Пиши /report или /report N, где N - число дней от 1 до {REPORT_MAX_DAYS}.")
+            return
+
+    report = await run_in_db(build_report, user_id, last_days)
+    if not report:
+        await update.message.reply_text("Сначала пройди регистрацию через /start.")
+        return
+
+    if last_days:
+        period = report["last_days"]
+        text = (
+            f"📈 Последние {period['days']} дн. ({period['start'].strftime('%d.%m')} - {period['end'].strftime('%d.%m')}):\n"
+            f"  потрачено: {money.to_text(period['total'])} из {money.to_text(report['base_norm'] * period['days'])} по норме\n"
+            f"  в среднем за день: {money.to_text(round(period['total'] / period['days']))}\n"
+            f"  дней сверх нормы: {period['days_over']}"
+        )
+    else:
+        parts = [
+            _format_period("📈 Текущий период", report["current"], report["base_norm"])
+            + f"\n  накоплено/долг сейчас: {money.to_text(report['balance'])}"
+        ]
+        previous = report["previous"]
+        if previous["finalized"] or previous["total"]:
+            parts.append(_format_period("Прошлый период", previous, report["base_norm"]))
+        text = "\n\n".join(parts)
+    await update.message.reply_text(text)
+
+
+async def transaction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = _budget_id(update)
+    if not await get_user(user_id):
+        await update.message.reply_text("Не понимаю. Если хочешь начать, жми /start.")
+        return
+    amounts = parse_amounts(update.message.text)
+    if not amounts:
+        await update.message.reply_text("Это не похоже на сумму\\. Просто пришли число, например `150` или `123\\.45`\n"
+                                        "Можно несколько через пробел или столбиком: `150 200,50 35`",
+                                        parse_mode='MarkdownV2')
+        return
+    # Через очередь группового коммита: все суммы сообщения одним куском, вернемся, когда они уже в базе
+    await transaction_queue.submit_many(user_id, amounts, author_id=_author_id(update))
+    admission.status.forget(user_id)
+    header = ""
+    if len(amounts) > 1:
+        items = ", ".join(f"`{money.to_text(amount)}`" for amount in amounts)
+        header = f"✍️ Записано трат: {len(amounts)}, всего `{money.to_text(sum(amounts))}`: {items}\n\n"
+    # Одна сводка на все сообщение, сколько бы сумм в нем ни было
+    await status_handler(update, context, header=header, fresh=True)
+
+
+# --- ПРАВКА И ОТМЕНА ТРАТ ---
+# Номера - с конца: 1 - последняя трата. В группе - последние СВОИ траты.
+# Номер съезжает от каждой новой траты, поэтому /edit запоминает, какие траты показал
+# под какими номерами, и /edit N, /undo N правят ровно их, а не то, что стало N-м с тех пор
+_EDIT_LIST_KEY = 'edit_list'
+
+
+def _remember_listed(context: ContextTypes.DEFAULT_TYPE, budget_id: int, recent):
+    context.user_data[_EDIT_LIST_KEY] = {"budget": budget_id, "ids": [t.transaction_id for t in recent]}
+
+
+def _listed_id(context: ContextTypes.DEFAULT_TYPE, budget_id: int, position: int) -> int | None:
+    """id траты, показанной в последнем /edit под номером position. Список от другого бюджета не в счет."""
+    listed = context.user_data.get(_EDIT_LIST_KEY)
+    if not listed or listed["budget"] != budget_id or position > len(listed["ids"]):
+        return None
+    return listed["ids"][position - 1]
+
+
+def _parse_position(arg: str) -> int | None:
+    try:
+        position = int(arg)
+    except ValueError:
+        return None
+    return position if 1 <= position <= EDIT_RECENT_LIMIT else None
+
+
+async def _reply_changed(update: Update, context: ContextTypes.DEFAULT_TYPE, result):
+    """Что поменяли - шапкой к свежей сводке, как после новой траты."""
+    when = result.local_time.strftime("%d.%m %H:%M")
+    if result.new_amount is None:
+        header = f"↩️ Отменена трата `{money.to_text(result.old_amount)}` от `{when}`\n"
+    else:
+        header = (f"✏️ Трата от `{when}`: было `{money.to_text(result.old_amount)}`, "
+                  f"стало `{money.to_text(result.new_amount)}`\n")
+    if result.balance_delta:
+        sign = "+" if result.balance_delta > 0 else ""
+        header += f"День уже пересчитан, накопленное поправлено на `{sign}{money.to_text(result.balance_delta)}`\n"
+    admission.status.forget(_budget_id(update))
+    await status_handler(update, context, header=header + "\n", fresh=True)
+
+
+async def undo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/undo - отменить последнюю трату, /undo N - трату под номером N из последнего /edit."""
+    user_id = _budget_id(update)
+    if not await get_user(user_id):
+        await update.message.reply_text("Сначала пройди регистрацию через /start.")
+        return
+    if not context.args:
+        recent = await run_in_db(recent_transactions, user_id, _author_id(update), 1)
+        if not recent:
+            await update.message.reply_text("Отменять нечего, трат еще нет.")
+            return
+        transaction_id = recent[0].transaction_id
+    else:
+        position = _parse_position(context.args[0])
+        if position is None:
+            await update.message.reply_text(
+                f"Пиши /undo или /undo N, где N - номер траты в /edit, от 1 до {EDIT_RECENT_LIMIT}.")
+            return
+        transaction_id = _listed_id(context, user_id, position)
+        if transaction_id is None:
+            await update.message.reply_text("Номера берутся из списка /edit - глянь его сначала.")
+            return
+    result = await run_in_db(change_transaction, user_id, transaction_id, None, author_id=_author_id(update))
+    if result is None:
+        await update.message.reply_text("Этой траты уже нет среди последних. Свежий список - в /edit.")
+        return
+    await _reply_changed(update, context, result)
+
+
+async def edit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/edit - последние траты с номерами, /edit N сумма - поправить трату под номером N из этого списка."""
+    user_id = _budget_id(update)
+    if not await get_user(user_id):
+        await update.message.reply_text("Сначала пройди регистрацию через /start.")
+        return
+    if not context.args:
+        recent = await run_in_db(recent_transactions, user_id, _author_id(update))
+        if not recent:
+            await update.message.reply_text("Править нечего, трат еще нет.")
+            return
+        _remember_listed(context, user_id, recent)
+        lines = ["Последние траты:"]
+        lines.extend(
+            f"{t.position}. {t.local_time.strftime('%d.%m %H:%M')} - {money.to_text(t.amount)}" for t in recent
+        )
+        lines.append("")
+        lines.append("Поправить: /edit N сумма. Отменить: /undo N.")
+        await update.message.reply_text("\n".join(lines))
+        return
+
+    position = _parse_position(context.args[0])
+    try:
+        new_amount = money.parse(context.args[1]) if len(context.args) == 2 else 0
+    except ValueError:
+        new_amount = 0
+    if position is None or new_amount <= 0:
+        await update.message.reply_text(
+            f"Пиши /edit N сумма, где N - номер траты из /edit (от 1 до {EDIT_RECENT_LIMIT}), например /edit 1 150. "
+            f"Сумма - не больше {money.to_text(money.MAX_AMOUNT)}. Убрать трату совсем - /undo N.")
+        return
+    transaction_id = _listed_id(context, user_id, position)
+    if transaction_id is None:
+        await update.message.reply_text("Номера берутся из списка /edit - глянь его сначала.")
+        return
+    result = await run_in_db(change_transaction, user_id, transaction_id, new_amount, author_id=_author_id(update))
+    if result is None:
+        await update.message.reply_text("Этой траты уже нет среди последних. Свежий список - в /edit.")
+        return
+    await _reply_changed(update, context, result)
+
+
+# --- РЕГИСТРАЦИЯ ВСЕХ ОБРАБОТЧИКОВ ---
+def _instrument(handlers, wrap=timed_handler, marker: str = "__instrumented__"):
+    """Оборачивает колбэки хендлеров (и все шаги диалогов) в wrap, по умолчанию - в метрики времени обработки."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            _instrument(handler.entry_points, wrap, marker)
+            for state_handlers in handler.states.values():
+                _instrument(state_handlers, wrap, marker)
+            _instrument(handler.fallbacks, wrap, marker)
+        elif not getattr(handler.callback, marker, False):
+            handler.callback = wrap(handler.callback)
+
+
+def register_handlers(application: Application):
+    """Регистрирует все обработчики в приложении."""
+    # Состояния диалогов переживают рестарт, только если у приложения есть персистентность (bot/persistence.py)
+    persistent = application.persistence is not None
+
+    registration_conv = ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            GET_NORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_norm)],
+            GET_TIMEZONE: [CallbackQueryHandler(get_timezone, pattern=f"^{TIMEZONE_CALLBACK_PREFIX}:")],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=600,
+        name="registration",
+        persistent=persistent,
+    )
+
+    settings_conv = ConversationHandler(
+        entry_points=[CommandHandler("settings", settings_entry)],
+        states={
+            CHANGING_NORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_new_norm)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=300,
+        name="settings",
+        persistent=persistent,
+    )
+
+    # Новый диалог удаления
+    delete_conv = ConversationHandler(
+        entry_points=[CommandHandler("delete_me", delete_me_entry)],
+        states={
+            CONFIRM_DELETION: [CallbackQueryHandler(confirm_deletion, pattern=f"^{CONFIRM_DELETE_CALLBACK_PREFIX}:")],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=60,
+        name="delete_me",
+        persistent=persistent,
+    )
+
+    application.add_handler(registration_conv)
+    application.add_handler(settings_conv)
+    import_conv = ConversationHandler(
+        entry_points=[CommandHandler("import", import_entry)],
+        states={
+            WAITING_IMPORT_FILE: [MessageHandler(filters.Document.ALL, receive_import_file)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=300,
+        name="import",
+        persistent=persistent,
+    )
+
+    application.add_handler(delete_conv)  # Добавляем новый диалог
+    application.add_handler(import_conv)
+
+    application.add_handler(CommandHandler("status", status_handler))
+    application.add_handler(CommandHandler("report", report_handler))
+    application.add_handler(CommandHandler("export", export_handler))
+    application.add_handler(CommandHandler("summary", summary_handler))
+    application.add_handler(CommandHandler("undo", undo_handler))
+    application.add_handler(CommandHandler("edit", edit_handler))
+    application.add_handler(
+        MessageHandler(filters.Regex(AMOUNTS_MESSAGE_RE) & ~filters.COMMAND, transaction_handler))
+
+    # Метрики на все, что зарегистрировали выше, а поверх - общий лимит на хендлеры,
+    # чтобы время в очереди за местом не попадало во время обработки
+    for group_handlers in application.handlers.values():
+        if handler_profiler.enabled:
+            # Профиль - внутри метрик, чтобы ожидание места в хендлерах в него не попадало
+            _instrument(group_handlers, handler_profiler.wrap, "__profiled__")
+        _instrument(group_handlers)
+        _instrument(group_handlers, admission.guard, "__admission__")
+
+    # Лимит на юзера - в группе -1, раньше всех хендлеров: лишний апдейт дальше не идет
+    application.add_handler(TypeHandler(Update, admission.admit), group=-1)
@@ -0,0 +1,261 @@
+"""
+Выгрузка и загрузка истории трат в CSV (/export и /import).
+
+Выгрузка идет курсором по индексу (user_id, created_at_epoch) пачками через
+генератор прямо в файл, вся история в память не поднимается. Старые траты,
+уехавшие в архив (bot/archive.py), читаются тем же запросом.
+
+Загрузка читает CSV кусками по IMPORT_CHUNK строк, каждый кусок - одна
+транзакция: executemany в transactions, сложение в daily_spend и, если
+траты попали в уже пересчитанные дни, поправка баланса и итогов периодов.
+Баланс копится с users.balance_since (день регистрации, у старых юзеров -
+см. миграцию 13), так что траты раньше него - история из другой жизни:
+они ложатся в transactions и daily_spend для /export и отчетов, а баланс
+и периоды не трогают. Иначе загрузка экспорта из старой таблички за пару
+лет списала бы с баланса все, что потрачено до бота.
+Дубли (то же время с точностью до миллисекунды и та же сумма) отбрасываются -
+и внутри файла, и против того, что уже лежит в базе. Так что один и тот же
+экспорт можно загрузить повторно, и ничего не задвоится.
+
+У общих бюджетов групп в колонке author_id - кто из участников потратил,
+у личных она пустая. Суммы в файле - в рублях с копейками через точку ("150.00"),
+в базе - в копейках (bot/money.py).
+"""
+import csv
+import io
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import IO, Iterator, NamedTuple
+
+from .db import (
+    get_db_connection, _users_write, _add_to_daily_spend, to_epoch_ms, epoch_ms_to_local_date,
+    _UTC, _EPOCH, all_transactions,
+)
+from .metrics import instrumented
+from .periods import apply_spend_delta
+from . import money, tzcalendar
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк читаем из курсора за раз при выгрузке
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
+# Сколько строк CSV пишем в базу одной транзакцией при загрузке
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", "1000"))
+# Больше этого за одну загрузку не берем
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "100000"))
+# Одна трата больше этого - почти наверняка опечатка или кривой файл. Потолок общий с ручным вводом
+IMPORT_MAX_AMOUNT = money.MAX_AMOUNT
+
+CSV_HEADER = ("created_at_utc", "local_date", "amount", "author_id")
+# Сколько ошибок по строкам показываем юзеру
+_MAX_REPORTED_ERRORS = 5
+
+
+def iter_transactions(user_id: int, fetch_size: int = EXPORT_FETCH_SIZE) -> Iterator[tuple[int, int, int | None]]:
+    """(created_at_epoch, сумма в копейках, author_id) всех трат юзера по времени. Читает курсором по fetch_size строк."""
+    with get_db_connection(user_id) as conn:
+        # Горячая часть и архив сливаются по своим индексам на лету, без сортировки всей истории
+        cursor = conn.execute(
+            all_transactions(("created_at_epoch", "id", "amount", "author_id"), "user_id = ?")
+            + " ORDER BY created_at_epoch, id",
+            (user_id, user_id)
+        )
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for epoch_ms, _id, amount, author_id in rows:
+                yield epoch_ms, amount, author_id
+
+
+@instrumented
+def export_transactions_csv(user_id: int, out: IO[bytes]) -> int:
+    """Пишет историю трат юзера в out как CSV (UTF-8). Возвращает число строк."""
+    with get_db_connection(user_id) as conn:
+        user = conn.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    user_tz = tzcalendar.zone(user["timezone"] if user else tzcalendar.DEFAULT_TIMEZONE)
+
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(CSV_HEADER)
+    count = 0
+    for epoch_ms, amount, author_id in iter_transactions(user_id):
+        moment = _EPOCH + timedelta(milliseconds=epoch_ms)
+        writer.writerow((
+            moment.isoformat(timespec="milliseconds"),
+            epoch_ms_to_local_date(epoch_ms, user_tz).isoformat(),
+            money.to_text(amount, sep=".", always_fraction=True),
+            "" if author_id is None else author_id,
+        ))
+        count += 1
+    # Отцепляем обертку, чтобы она не закрыла out вместе с собой
+    text.detach()
+    return count
+
+
+class ImportResult(NamedTuple):
+    imported: int
+    duplicates: int
+    invalid: int
+    # Поправка накопленного баланса за траты в уже пересчитанные дни, в копейках
+    balance_delta: int
+    # Сколько загруженных трат раньше users.balance_since - на баланс они не влияют
+    before_balance: int
+    errors: list[str]
+
+
+def _parse_row(row: dict, user_tz) -> tuple[datetime, int, int | None]:
+    """Разбирает строку CSV в (момент в UTC, сумма в копейках, автор) или падает с ValueError и человеческим текстом."""
+    raw_moment = (row.get("created_at_utc") or row.get("created_at") or "").strip()
+    raw_amount = (row.get("amount") or "").strip()
+    raw_author = (row.get("author_id") or "").strip()
+    if not raw_moment or not raw_amount:
+        raise ValueError("нет времени или суммы")
+    try:
+        moment = datetime.fromisoformat(raw_moment)
+    except ValueError:
+        raise ValueError(f"непонятное время '{raw_moment}'") from None
+    if moment.tzinfo is None:
+        # Время без зоны - это время юзера, так вбивают руками
+        moment = moment.replace(tzinfo=user_tz)
+    moment = moment.astimezone(_UTC)
+    if moment > datetime.now(_UTC) + timedelta(minutes=5):
+        raise ValueError(f"время из будущего '{raw_moment}'")
+    try:
+        amount = money.parse(raw_amount)
+    except ValueError:
+        raise ValueError(f"непонятная или слишком большая сумма '{raw_amount}'") from None
+    if not 0 < amount <= IMPORT_MAX_AMOUNT:
+        raise ValueError(f"сумма вне диапазона '{raw_amount}'")
+    try:
+        author_id = int(raw_author) if raw_author else None
+    except ValueError:
+        raise ValueError(f"непонятный author_id '{raw_author}'") from None
+    return moment, amount, author_id
+
+
+def _insert_chunk(user_id: int, rows: list[tuple[int, int, int | None]], seen: set) -> tuple[int, int, int, int]:
+    """
+    Пишет кусок (epoch_ms, сумма в копейках, author_id) одной транзакцией, выкидывая дубли.
+    Возвращает (вставлено, дублей, поправка баланса, вставлено раньше balance_since).
+    """
+    with _users_write([user_id]) as conn:
+        # Под блокировкой на запись: юзер и его дата пересчета не поменяются, пока пишем
+        user = conn.execute(
+            "SELECT timezone, daily_norm, last_recalc_date, balance_since FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if user is None:
+            return 0, 0, 0, 0
+        # С этого дня траты входят в баланс. Не знаем с какого - считаем, что с начала времен
+        balance_from = user["balance_since"] or ""
+        user_tz = tzcalendar.zone(user["timezone"])
+
+        # Что уже лежит в базе и в архиве в этом диапазоне времени - по (user_id, created_at_epoch)
+        existing = {
+            (epoch_ms, amount)
+            for epoch_ms, amount in conn.execute(
+                all_transactions(("created_at_epoch", "amount"), "user_id = ? AND created_at_epoch BETWEEN ? AND ?"),
+                (user_id, min(r[0] for r in rows), max(r[0] for r in rows)) * 2
+            )
+        }
+        fresh, duplicates = [], 0
+        for row in rows:
+            key = (row[0], row[1])
+            if key in existing or key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            fresh.append(row)
+        if not fresh:
+            return 0, duplicates, 0, 0
+
+        conn.executemany(
+            "INSERT INTO transactions (user_id, amount, created_at_epoch, author_id) VALUES (?, ?, ?, ?)",
+            [(user_id, amount, epoch_ms, author_id) for epoch_ms, amount, author_id in fresh]
+        )
+        daily: dict[str, tuple[int, int]] = {}
+        for epoch_ms, amount, _author_id in fresh:
+            local_date = epoch_ms_to_local_date(epoch_ms, user_tz).isoformat()
+            total, count = daily.get(local_date, (0, 0))
+            daily[local_date] = (total + amount, count + 1)
+        cursor = conn.cursor()
+        balance_delta = before_balance = 0
+        for local_date, (total, count) in daily.items():
+            _add_to_daily_spend(cursor, user_id, local_date, total, count)
+            if local_date < balance_from:
+                before_balance += count
+                continue
+            # Дни с начала баланса до last_recalc_date уже вошли в него - поправляем сразу,
+            # остальные дни пересчет подхватит сам из daily_spend
+            if local_date < user["last_recalc_date"]:
+                apply_spend_delta(conn, user_id, local_date, total, user["daily_norm"])
+                balance_delta -= total
+        if balance_delta:
+            conn.execute(
+                "UPDATE users SET accumulated_balance = accumulated_balance + ? WHERE user_id = ?",
+                (balance_delta, user_id)
+            )
+    return len(fresh), duplicates, balance_delta, before_balance
+
+
+@instrumented
+def import_transactions_csv(user_id: int, source: IO[bytes]) -> ImportResult:
+    """Загружает траты юзера из CSV (created_at_utc или created_at, amount, необязательный author_id). Пишет кусками по IMPORT_CHUNK строк."""
+    with get_db_connection(user_id) as conn:
+        user = conn.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    if user is None:
+        return ImportResult(0, 0, 0, 0, 0, ["юзер не найден"])
+    user_tz = tzcalendar.zone(user["timezone"])
+
+    imported = duplicates = invalid = total_rows = 0
+    balance_delta = before_balance = 0
+    errors: list[str] = []
+    seen: set = set()
+    chunk: list[tuple[int, int, int | None]] = []
+
+    def flush():
+        nonlocal imported, duplicates, balance_delta, before_balance, chunk
+        if chunk:
+            added, skipped, delta, early = _insert_chunk(user_id, chunk, seen)
+            imported += added
+            duplicates += skipped
+            balance_delta += delta
+            before_balance += early
+            chunk = []
+
+    text = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.DictReader(text)
+        columns = set(reader.fieldnames or [])
+        if "amount" not in columns or not columns & {"created_at_utc", "created_at"}:
+            return ImportResult(0, 0, 0, 0, 0, ["в первой строке нужны колонки created_at_utc и amount"])
+
+        for row in reader:
+            total_rows += 1
+            if total_rows > IMPORT_MAX_ROWS:
+                errors.append(f"больше {IMPORT_MAX_ROWS} строк, остальное не загружено")
+                break
+            try:
+                moment, amount, author_id = _parse_row(row, user_tz)
+            except ValueError as e:
+                invalid += 1
+                if len(errors) < _MAX_REPORTED_ERRORS:
+                    errors.append(f"строка {reader.line_num}: {e}")
+                continue
+            chunk.append((to_epoch_ms(moment), amount, author_id))
+            if len(chunk) >= IMPORT_CHUNK:
+                flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        # То, что успели разобрать до кривого места, все равно загружаем
+        errors.append(f"файл не читается как CSV в UTF-8: {e}")
+    finally:
+        text.detach()
+    flush()
+
+    logger.info(
+        f"Импорт для юзера {user_id}: загружено {imported}, дублей {duplicates}, "
+        f"битых строк {invalid}, поправка баланса {money.to_text(balance_delta, sep='.')}, "
+        f"до начала баланса {before_balance}"
+    )
+    return ImportResult(imported, duplicates, invalid, balance_delta, before_balance, errors)
@@ -1,27 +1,132 @@
-
-from .db import get_user, get_spent_today
-
-
-def calculate_status(user_id: int) -> dict:
-    """
-    Собирает всю инфу о состоянии пользователя и возвращает в виде словаря.
-    """
-    user = get_user(user_id)
-    if not user:
-        return None
-
-    spent_today = get_spent_today(user_id)
-
-    base_norm = user['daily_norm']
-    balance = user['accumulated_balance']
-
-    available_today = base_norm + balance
-    remaining_today = available_today - spent_today
-
-    return {
-        "base_norm": base_norm,
-        "balance": balance,
-        "available_today": available_today,
-        "spent_today": spent_today,
-        "remaining_today": remaining_today,
-    }
\ No newline at end of file
+
+import re
+from datetime import date, timedelta
+
+from .db import get_user, get_spent_today, get_spend_summary, get_period_rollups, get_summary_subscribers
+from .periods import period_bounds, previous_period_start
+from . import money, tzcalendar
+
+
+# Одна или несколько сумм через пробелы или переносы строк: "150", "150 200,50 35", чек столбиком.
+# Цифр в рублях не больше, чем у money.MAX_AMOUNT: простыню из тысячи цифр не разбираем вовсе
+AMOUNT_RE = rf"\d{{1,{money.MAX_AMOUNT_DIGITS}}}(?:[.,]\d{{1,2}})?"
+AMOUNTS_MESSAGE_RE = rf"^\s*{AMOUNT_RE}(?:\s+{AMOUNT_RE})*\s*$"
+# Больше сумм в одном сообщении не принимаем - это уже не чек, а чей-то дамп
+MAX_AMOUNTS_PER_MESSAGE = 50
+
+
+def parse_amounts(text: str) -> list[int] | None:
+    """
+    Достает все суммы из сообщения, в копейках. None - если сообщение не про суммы,
+    какая-то сумма не положительная или больше money.MAX_AMOUNT, или сумм слишком много.
+    """
+    if not re.fullmatch(AMOUNTS_MESSAGE_RE, text):
+        return None
+    try:
+        amounts = [money.parse(token) for token in text.split()]
+    except ValueError:
+        return None
+    if not amounts or len(amounts) > MAX_AMOUNTS_PER_MESSAGE or any(amount <= 0 for amount in amounts):
+        return None
+    return amounts
+
+
+def calculate_status(user_id: int) -> dict:
+    """
+    Собирает всю инфу о состоянии пользователя и возвращает в виде словаря. Суммы - в копейках.
+    """
+    user = get_user(user_id)
+    if not user:
+        return None
+
+    spent_today = get_spent_today(user_id)
+
+    base_norm = user['daily_norm']
+    balance = user['accumulated_balance']
+
+    available_today = base_norm + balance
+    remaining_today = available_today - spent_today
+
+    return {
+        "base_norm": base_norm,
+        "balance": balance,
+        "available_today": available_today,
+        "spent_today": spent_today,
+        "remaining_today": remaining_today,
+    }
+
+
+def _period_summary(user, start: date, end: date, today: date, rollup) -> dict:
+    """Итоги одного периода. Закрытый период берем из period_rollup как есть, открытый досчитываем по daily_spend."""
+    if rollup is not None and rollup["finalized"]:
+        total, days_over = rollup["total"], rollup["days_over"]
+    else:
+        total, days_over = get_spend_summary(user["user_id"], start.isoformat(), min(end, today).isoformat(),
+                                             user["daily_norm"])
+    return {
+        "start": start,
+        "end": end,
+        "days": (end - start).days + 1,
+        "days_passed": (min(end, today) - start).days + 1,
+        "total": total,
+        "days_over": days_over,
+        "start_balance": rollup["start_balance"] if rollup is not None else None,
+        "end_balance": rollup["end_balance"] if rollup is not None else None,
+        "finalized": bool(rollup is not None and rollup["finalized"]),
+    }
+
+
+def build_report(user_id: int, last_days: int | None = None) -> dict:
+    """
+    Отчет для /report. Без last_days - текущий и прошлый бюджетный период (от reset_day до reset_day),
+    с last_days - траты за последние N дней, включая сегодня. Читает пару строк period_rollup
+    и диапазоны daily_spend, сырые транзакции не трогает.
+    """
+    user = get_user(user_id)
+    if not user:
+        return None
+    today = tzcalendar.today(user["timezone"])
+
+    if last_days:
+        start = today - timedelta(days=last_days - 1)
+        total, days_over = get_spend_summary(user_id, start.isoformat(), today.isoformat(), user["daily_norm"])
+        return {
+            "base_norm": user["daily_norm"],
+            "last_days": {"start": start, "end": today, "days": last_days, "total": total, "days_over": days_over},
+        }
+
+    start, end = period_bounds(today, user["reset_day"])
+    previous_start = previous_period_start(start, user["reset_day"])
+    rollups = {row["period_start"]: row for row in get_period_rollups(user_id, 2)}
+    return {
+        "base_norm": user["daily_norm"],
+        "balance": user["accumulated_balance"],
+        "current": _period_summary(user, start, end, today, rollups.get(start.isoformat())),
+        "previous": _period_summary(user, previous_start, start - timedelta(days=1), today,
+                                    rollups.get(previous_start.isoformat())),
+    }
+
+
+def format_day_summary(result) -> str:
+    """Текст сводки после пересчета: сколько потрачено вчера, новый баланс и сколько можно сегодня."""
+    today = date.fromisoformat(result.new_recalc_date)
+    yesterday = today - timedelta(days=1)
+    spent = result.spent_by_day.get(yesterday.isoformat(), 0)
+    lines = [
+        f"🌙 Итоги {yesterday.strftime('%d.%m')}: потрачено {money.to_text(spent)} "
+        f"при норме {money.to_text(result.daily_norm)}.",
+        f"Накоплено/долг: {money.to_text(result.new_balance)}",
+        "",
+        f"✅ Доступно сегодня: {money.to_text(result.daily_norm + result.new_balance)}",
+        "",
+        "Отключить эти сообщения: /summary off",
+    ]
+    return "\n".join(lines)
+
+
+def build_day_summaries(results) -> list[tuple[int, str]]:
+    """(chat_id, текст) сводок для тех пересчитанных юзеров (RecalcResult), кто на них подписан."""
+    if not results:
+        return []
+    subscribers = get_summary_subscribers([r.user_id for r in results])
+    return [(r.user_id, format_day_summary(r)) for r in results if r.user_id in subscribers]
@@ -0,0 +1,281 @@
+"""
+Метрики бота в формате Prometheus.
+
+Раньше единственным способом понять, что происходит, были logger.info на
+каждую трату - и они же жрали время. Тут простые счетчики и гистограммы
+в памяти процесса, которые отдаются по HTTP на /metrics:
+  * bot_db_* - вызовы функций bot/db.py (декоратор @instrumented);
+  * bot_handler_* - обработка апдейтов хендлерами (обертка в register_handlers);
+  * bot_recalc_* - пересчеты балансов: юзеры, прокрученные дни, длительность;
+  * bot_admission_* - отбитые и сброшенные апдейты (bot/admission.py);
+  * bot_db_slow_queries_total, bot_loop_* - медленные запросы и лаг event loop'а,
+    если они включены (bot/profiling.py).
+
+Запись метрики - пара perf_counter, bisect и инкремент под локом, так что
+держать включенным можно всегда. Никаких внешних зависимостей.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+# Порт, на котором отдаем /metrics. 0 - не поднимать сервер (метрики все равно копятся).
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+
+# Границы корзин гистограмм в секундах: от сотни микросекунд (кэш, PK-чтение) до минут (пересчет)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Монотонный счетчик."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Текущее значение. С fn значение читается в момент отдачи метрик (для чужих счетчиков)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), fn=None):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+        self._fn = fn
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def _samples(self) -> list[str]:
+        if self._fn is not None:
+            try:
+                return [f"{self.name} {_format_value(self._fn())}"]
+            except Exception:
+                logger.exception(f"Не удалось снять метрику {self.name}")
+                return []
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными корзинами, как в Prometheus."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label_values -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return series[2] if series else 0
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = [(key, (list(series[0]), series[1], series[2])) for key, series in self._series.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+_REGISTRY: list[_Metric] = []
+
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus."""
+    return "\n".join(metric.render() for metric in _REGISTRY) + "\n"
+
+
+# --- МЕТРИКИ БОТА ---
+
+DB_ERRORS = Counter("bot_db_errors_total", "Вызовы функций bot/db.py, упавшие с исключением", ("function",))
+# Число вызовов - это bot_db_call_seconds_count, отдельный счетчик не заводим
+DB_SECONDS = Histogram("bot_db_call_seconds", "Время выполнения функций bot/db.py", ("function",))
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта хендлером", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Хендлеры, упавшие с исключением", ("handler",))
+
+RECALC_RUNS = Counter("bot_recalc_runs_total", "Запуски пересчета балансов", ("engine",))
+RECALC_USERS = Counter("bot_recalc_users_total", "Юзеры, которым пересчитан баланс", ("engine",))
+RECALC_DAYS = Counter("bot_recalc_days_total", "Прокрученные при пересчете дни (сумма по юзерам)", ("engine",))
+RECALC_SECONDS = Histogram("bot_recalc_seconds", "Длительность пересчета", ("engine",))
+OUTBOUND_MESSAGES = Counter("bot_outbound_messages_total", "Сообщения рассылок по итогу отправки", ("result",))
+OUTBOUND_RETRIES = Counter("bot_outbound_retries_total", "Повторы отправки в рассылках по причине", ("reason",))
+ADMISSION_THROTTLED = Counter("bot_admission_throttled_total", "Апдейты, выкинутые лимитом на юзера")
+ADMISSION_SHED = Counter("bot_admission_shed_total", "Апдейты, сброшенные из-за перегрузки", ("reason",))
+ADMISSION_COALESCED = Counter("bot_admission_coalesced_total", "Запросы /status, обслуженные чужим расчетом")
+ADMISSION_IN_FLIGHT = Gauge("bot_admission_in_flight", "Апдейты, которые сейчас в хендлерах")
+ADMISSION_WAITING = Gauge("bot_admission_waiting", "Апдейты, ждущие места в хендлерах")
+DB_SLOW_QUERIES = Counter("bot_db_slow_queries_total", "SQL-запросы дольше PROFILE_SLOW_QUERY_MS по месту вызова",
+                          ("caller",))
+LOOP_LAG_SECONDS = Histogram("bot_loop_lag_seconds", "Насколько позже положенного просыпается event loop")
+LOOP_STALLS = Counter("bot_loop_stalls_total", "Затыки event loop'а дольше PROFILE_LOOP_LAG_MS")
+RECALC_LAST_SUCCESS = Gauge("bot_recalc_last_success_timestamp_seconds", "Когда последний пересчет закончился успешно",
+                            ("engine",))
+
+
+def instrumented(func):
+    """Декоратор для функций bot/db.py: число вызовов, ошибки и время."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(1, name)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+def timed_handler(callback, name: str | None = None):
+    """Оборачивает корутину-хендлер: время обработки апдейта и ошибки. Возвращаемое значение не трогает."""
+    name = name or getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(1, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    wrapper.__instrumented__ = True
+    return wrapper
+
+
+def observe_recalc(engine: str, users: int, days: int, seconds: float):
+    """Отмечает завершенный пересчет."""
+    RECALC_RUNS.inc(1, engine)
+    RECALC_USERS.inc(users, engine)
+    RECALC_DAYS.inc(days, engine)
+    RECALC_SECONDS.observe(seconds, engine)
+    RECALC_LAST_SUCCESS.set(time.time(), engine)
+
+
+class MetricsServer:
+    """Крошечный HTTP-сервер на asyncio: GET /metrics -> render()."""
+
+    def __init__(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.listen = listen
+        self.port = port
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logger.info(f"Метрики отдаются на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Заголовки нам не нужны, но дочитать их надо
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                status, body = HTTPStatus.METHOD_NOT_ALLOWED, b""
+            elif parts[1].split("?", 1)[0] != "/metrics":
+                status, body = HTTPStatus.NOT_FOUND, b""
+            else:
+                status, body = HTTPStatus.OK, render().encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1")
+            )
+            if parts and parts[0] != "HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,505 @@
+"""
+Версионные миграции схемы базы.
+
+Номер версии схемы хранится прямо в файле базы (PRAGMA user_version).
+Каждая миграция применяется ровно один раз и в порядке номеров.
+Старые базы, созданные еще по "схеме v3.0" без номера версии, имеют
+user_version = 0. Первая миграция для них ничего не ломает, потому что
+создает таблицы через IF NOT EXISTS.
+
+Правила, чтобы миграции были безопасны на боевой базе:
+  * обычная миграция и запись нового номера версии идут в ОДНОЙ транзакции
+    BEGIN IMMEDIATE, так что упасть посередине не получится;
+  * номер версии перечитывается уже под блокировкой, так что бот и
+    пересчет могут стартовать одновременно и не накатят миграцию дважды;
+  * тяжелые миграции (chunked=True) коммитят пачками, чтобы не держать
+    блокировку на запись минутами, и обязаны быть идемпотентными:
+    если процесс убьют посередине, следующий запуск просто продолжит;
+  * миграции, которые пачками не сделать (offline=True), на непустой базе
+    бот сам не катит и не стартует: только python db_tool.py migrate
+    при остановленном боте;
+  * перед накатом на непустую базу делается бэкап файла.
+"""
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from typing import Callable, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# Делать ли копию базы перед накатом миграций на непустую базу.
+DB_BACKUP_BEFORE_MIGRATE = os.getenv("DB_BACKUP_BEFORE_MIGRATE", "1") == "1"
+# Сколько строк обрабатываем за одну транзакцию в тяжелых миграциях.
+DB_MIGRATION_CHUNK = int(os.getenv("DB_MIGRATION_CHUNK", "5000"))
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[sqlite3.Connection], None]
+    # True - миграция сама управляет транзакциями и коммитит пачками.
+    chunked: bool = False
+    # True - только при остановленном боте, через python db_tool.py migrate (см. run_migrations).
+    offline: bool = False
+
+
+# --- САМИ МИГРАЦИИ ---
+
+def _m001_base_schema(conn: sqlite3.Connection):
+    """Та самая схема v3.0, на которой бот жил до появления миграций."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            daily_norm REAL NOT NULL,
+            reset_day INTEGER NOT NULL,
+            timezone TEXT NOT NULL,
+            accumulated_balance REAL NOT NULL DEFAULT 0,
+            last_recalc_date TEXT,
+            is_active BOOLEAN NOT NULL DEFAULT 1
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            created_at_utc TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+
+def _m002_add_epoch_column(conn: sqlite3.Connection):
+    """
+    Время транзакции целым числом миллисекунд от эпохи.
+    Сравнивать целые числа по индексу сильно дешевле, чем ISO-строки.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(transactions)")}
+    if "created_at_epoch" not in columns:
+        conn.execute("ALTER TABLE transactions ADD COLUMN created_at_epoch INTEGER")
+    # Страховка на время выкатки: если строку вставил еще старый код без эпохи,
+    # триггер досчитает ее сам из created_at_utc.
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_fill_epoch
+        AFTER INSERT ON transactions
+        WHEN NEW.created_at_epoch IS NULL
+        BEGIN
+            UPDATE transactions
+            SET created_at_epoch = CAST(strftime('%s', NEW.created_at_utc) AS INTEGER) * 1000
+                                 + CAST(substr(strftime('%f', NEW.created_at_utc), 4) AS INTEGER)
+            WHERE id = NEW.id;
+        END
+    """)
+
+
+def _m003_backfill_epoch(conn: sqlite3.Connection):
+    """Заполняет created_at_epoch для старых строк пачками по DB_MIGRATION_CHUNK."""
+    from .db import iso_to_epoch_ms
+
+    total = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, created_at_utc FROM transactions WHERE created_at_epoch IS NULL ORDER BY id LIMIT ?",
+            (DB_MIGRATION_CHUNK,)
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            "UPDATE transactions SET created_at_epoch = ? WHERE id = ?",
+            [(iso_to_epoch_ms(row[1]), row[0]) for row in rows]
+        )
+        conn.commit()
+        total += len(rows)
+        logger.info(f"  - created_at_epoch заполнен для {total} транзакций...")
+
+
+def _m004_index_user_epoch(conn: sqlite3.Connection):
+    """Индекс под выборки трат пользователя за диапазон времени."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_epoch ON transactions (user_id, created_at_epoch)"
+    )
+
+
+def _m005_daily_spend(conn: sqlite3.Connection):
+    """
+    Материализованные дневные траты юзера по его локальной дате.
+    "Потрачено сегодня" и пересчет читают отсюда одну строку вместо SUM по сырым транзакциям.
+    """
+    from .db import _rebuild_daily_spend
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS daily_spend (
+            user_id INTEGER NOT NULL,
+            local_date TEXT NOT NULL,
+            total REAL NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, local_date)
+        ) WITHOUT ROWID
+    """)
+    # Заполняем по уже накопленной истории в той же транзакции, что и создание таблицы
+    _rebuild_daily_spend(conn)
+
+
+def _m006_users_generation(conn: sqlite3.Connection):
+    """
+    Счетчик изменений таблицы users для кэша юзеров в bot/db.py.
+    Триггеры крутят его при любом UPDATE/DELETE, кто бы ни писал - бот или пересчет
+    из соседнего процесса. Кэш сверяется с ним и понимает, что пора сброситься.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('users_generation', 0)")
+    for event in ("UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_users_generation_{event.lower()}
+            AFTER {event} ON users
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'users_generation';
+            END
+        """)
+
+
+def _m007_index_users_tz_recalc(conn: sqlite3.Connection):
+    """Индекс, по которому планировщик выбирает юзеров одной таймзоны, у кого наступил новый день."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_tz_recalc ON users (timezone, last_recalc_date)"
+    )
+
+
+def _m008_period_rollup(conn: sqlite3.Connection):
+    """
+    Итоги бюджетных периодов (от reset_day до reset_day) для /report.
+    Открывает и закрывает периоды ночной пересчет, см. bot/periods.py.
+    Для уже прошедших периодов балансов не знаем, так что история не заполняется -
+    /report досчитает траты по daily_spend сам.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS period_rollup (
+            user_id INTEGER NOT NULL,
+            period_start TEXT NOT NULL,
+            period_end TEXT NOT NULL,
+            total REAL NOT NULL DEFAULT 0,
+            days_over INTEGER NOT NULL DEFAULT 0,
+            start_balance REAL,
+            end_balance REAL,
+            finalized INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, period_start)
+        ) WITHOUT ROWID
+    """)
+
+
+def _m009_transaction_author(conn: sqlite3.Connection):
+    """
+    Кто из участников записал трату. Нужно для общих бюджетов групповых чатов:
+    бюджет - это строка users с id чата, а author_id - Telegram id того, кто потратил.
+    У старых и личных трат NULL - значит, автор сам владелец бюджета.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(transactions)")}
+    if "author_id" not in columns:
+        conn.execute("ALTER TABLE transactions ADD COLUMN author_id INTEGER")
+
+
+def _m010_persistence(conn: sqlite3.Connection):
+    """
+    Состояния диалогов и user_data для bot/persistence.py. Храним только живое:
+    закончился диалог или опустел user_data - строка удаляется.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT NOT NULL,
+            conv_key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (name, conv_key)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+
+
+def _m011_daily_summary(conn: sqlite3.Connection):
+    """Подписка на вечернюю сводку после ночного пересчета (bot/outbound.py). По умолчанию выключена."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    if "daily_summary" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN daily_summary INTEGER NOT NULL DEFAULT 0")
+
+
+def _is_strict(conn: sqlite3.Connection, schema: str, table: str) -> bool:
+    row = conn.execute("SELECT strict FROM pragma_table_list WHERE schema = ? AND name = ?", (schema, table)).fetchone()
+    return bool(row and row[0])
+
+
+def _rebuild_table(conn: sqlite3.Connection, schema: str, table: str, create_sql: str, columns: dict[str, str]):
+    """
+    Переливает таблицу в новую с другой схемой: CREATE под временным именем, INSERT ... SELECT,
+    DROP старой и RENAME новой. create_sql - CREATE TABLE с {name} вместо имени,
+    columns - колонка новой таблицы -> выражение над старой. Индексы и триггеры старой
+    таблицы пропадают вместе с ней, их заводит вызывающий.
+    """
+    temp = f"{table}_new"
+    conn.execute(create_sql.format(name=f"{schema}.{temp}"))
+    conn.execute(
+        f"INSERT INTO {schema}.{temp} ({', '.join(columns)}) "
+        f"SELECT {', '.join(columns.values())} FROM {schema}.{table}"
+    )
+    conn.execute(f"DROP TABLE {schema}.{table}")
+    conn.execute(f"ALTER TABLE {schema}.{temp} RENAME TO {table}")
+
+
+def _kopecks(column: str) -> str:
+    return f"CAST(ROUND({column} * 100) AS INTEGER)"
+
+
+def _m012_money_in_kopecks(conn: sqlite3.Connection):
+    """
+    Все суммы - целыми копейками в STRICT-таблицах (см. bot/money.py): users, transactions,
+    daily_spend, period_rollup и архив. Заодно из transactions уходит created_at_utc -
+    его никто не читает, время давно берется из created_at_epoch (в архиве его и не было),
+    а вместе с ним и триггер, который досчитывал эпоху из строки.
+    Уже переложенные таблицы (STRICT) не трогаем: архив - отдельный файл, его коммит
+    не атомарен с основным, и при повторе миграции копейки не должны умножиться на 100 еще раз.
+
+    Офлайновая: одна транзакция на весь файл, блокировка на запись - на все время переливки.
+    Пачками нельзя - новый код пишет копейки, и пока половина таблицы еще в рублях,
+    живой бот намешал бы в нее копеек. Так что на непустой базе - только
+    python db_tool.py migrate при остановленном боте (с каждым DB_SHARDS, на котором он жил).
+    """
+    from .db import _ARCHIVE_TABLE_SQL
+
+    if not _is_strict(conn, "main", "users"):
+        _rebuild_table(conn, "main", "users", """
+            CREATE TABLE {name} (
+                user_id INTEGER PRIMARY KEY,
+                daily_norm INTEGER NOT NULL,
+                reset_day INTEGER NOT NULL,
+                timezone TEXT NOT NULL,
+                accumulated_balance INTEGER NOT NULL DEFAULT 0,
+                last_recalc_date TEXT,
+                is_active INTEGER NOT NULL DEFAULT 1,
+                daily_summary INTEGER NOT NULL DEFAULT 0
+            ) STRICT
+        """, {
+            "user_id": "user_id",
+            "daily_norm": _kopecks("daily_norm"),
+            "reset_day": "reset_day",
+            "timezone": "timezone",
+            "accumulated_balance": _kopecks("accumulated_balance"),
+            "last_recalc_date": "last_recalc_date",
+            "is_active": "is_active",
+            "daily_summary": "daily_summary",
+        })
+        # Индекс планировщика и триггеры счетчика для кэша юзеров ушли вместе со старой таблицей
+        _m006_users_generation(conn)
+        _m007_index_users_tz_recalc(conn)
+
+    if not _is_strict(conn, "main", "transactions"):
+        # AUTOINCREMENT обещает не выдавать id повторно, даже id трат, уехавших в архив
+        sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'").fetchone()
+        _rebuild_table(conn, "main", "transactions", """
+            CREATE TABLE {name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                created_at_epoch INTEGER NOT NULL,
+                author_id INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            ) STRICT
+        """, {
+            "id": "id",
+            "user_id": "user_id",
+            "amount": _kopecks("amount"),
+            "created_at_epoch": "created_at_epoch",
+            "author_id": "author_id",
+        })
+        if sequence is not None:
+            cursor = conn.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'transactions'", (sequence[0],)
+            )
+            if cursor.rowcount == 0:
+                # Таблица была пустой, своей строки в sqlite_sequence у новой еще нет
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', ?)", (sequence[0],))
+        _m004_index_user_epoch(conn)
+
+    if not _is_strict(conn, "main", "daily_spend"):
+        _rebuild_table(conn, "main", "daily_spend", """
+            CREATE TABLE {name} (
+                user_id INTEGER NOT NULL,
+                local_date TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, local_date)
+            ) STRICT, WITHOUT ROWID
+        """, {"user_id": "user_id", "local_date": "local_date", "total": _kopecks("total"), "count": "count"})
+
+    if not _is_strict(conn, "main", "period_rollup"):
+        _rebuild_table(conn, "main", "period_rollup", """
+            CREATE TABLE {name} (
+                user_id INTEGER NOT NULL,
+                period_start TEXT NOT NULL,
+                period_end TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                days_over INTEGER NOT NULL DEFAULT 0,
+                start_balance INTEGER,
+                end_balance INTEGER,
+                finalized INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, period_start)
+            ) STRICT, WITHOUT ROWID
+        """, {
+            "user_id": "user_id",
+            "period_start": "period_start",
+            "period_end": "period_end",
+            "total": _kopecks("total"),
+            "days_over": "days_over",
+            "start_balance": _kopecks("start_balance"),
+            "end_balance": _kopecks("end_balance"),
+            "finalized": "finalized",
+        })
+
+    if not _is_strict(conn, "archive", "archived_transactions"):
+        _rebuild_table(conn, "archive", "archived_transactions", _ARCHIVE_TABLE_SQL.replace("IF NOT EXISTS ", ""), {
+            "user_id": "user_id",
+            "created_at_epoch": "created_at_epoch",
+            "id": "id",
+            "amount": _kopecks("amount"),
+            "author_id": "author_id",
+        })
+
+
+def _m013_balance_since(conn: sqlite3.Connection):
+    """
+    С какой локальной даты юзеру копится баланс: /import (bot/history.py) траты раньше нее
+    в баланс не пускает. Новым юзерам ее ставит регистрация. У старых даты регистрации нет,
+    берем самое раннее из первой траты в боте (горячей или в архиве), первого периода
+    в period_rollup и last_recalc_date. До первой траты баланс только рос на норму,
+    так что для поправок трат это та же дата регистрации.
+    """
+    from .tzcalendar import local_date_at_ms
+
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    if "balance_since" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN balance_since TEXT")
+    # Обе выборки - по индексам (user_id, created_at_epoch), без сортировки
+    first_spend: dict[int, int] = {}
+    for user_id, epoch_ms in conn.execute(
+        "SELECT user_id, MIN(created_at_epoch) FROM main.transactions GROUP BY user_id "
+        "UNION ALL SELECT user_id, MIN(created_at_epoch) FROM archive.archived_transactions GROUP BY user_id"
+    ):
+        first_spend[user_id] = min(epoch_ms, first_spend.get(user_id, epoch_ms))
+    first_period = dict(conn.execute("SELECT user_id, MIN(period_start) FROM period_rollup GROUP BY user_id"))
+    updates = []
+    for user_id, timezone, last_recalc_date in conn.execute(
+        "SELECT user_id, timezone, last_recalc_date FROM users WHERE balance_since IS NULL"
+    ).fetchall():
+        candidates = [day for day in (last_recalc_date, first_period.get(user_id)) if day]
+        if user_id in first_spend:
+            candidates.append(local_date_at_ms(timezone, first_spend[user_id]).isoformat())
+        if candidates:
+            updates.append((min(candidates), user_id))
+    conn.executemany("UPDATE users SET balance_since = ? WHERE user_id = ?", updates)
+    logger.info(f"  - balance_since проставлен {len(updates)} юзерам")
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "Базовая схема v3.0: users и transactions", _m001_base_schema),
+    Migration(2, "Колонка transactions.created_at_epoch", _m002_add_epoch_column),
+    Migration(3, "Заполнение created_at_epoch у старых транзакций", _m003_backfill_epoch, chunked=True),
+    Migration(4, "Индекс transactions (user_id, created_at_epoch)", _m004_index_user_epoch),
+    Migration(5, "Дневные сводки трат daily_spend", _m005_daily_spend),
+    Migration(6, "Счетчик изменений users для кэша", _m006_users_generation),
+    Migration(7, "Индекс users (timezone, last_recalc_date)", _m007_index_users_tz_recalc),
+    Migration(8, "Итоги бюджетных периодов period_rollup", _m008_period_rollup),
+    Migration(9, "Колонка transactions.author_id для общих бюджетов", _m009_transaction_author),
+    Migration(10, "Таблицы bot_conversations и bot_user_data для персистентности диалогов", _m010_persistence),
+    Migration(11, "Колонка users.daily_summary для сводок после пересчета", _m011_daily_summary),
+    Migration(12, "Суммы в копейках и STRICT-таблицы", _m012_money_in_kopecks, offline=True),
+    Migration(13, "Колонка users.balance_since - с какого дня копится баланс", _m013_balance_since),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+# --- ДВИЖОК ---
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы в файле базы."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _set_schema_version(conn: sqlite3.Connection, version: int):
+    # PRAGMA не умеет в параметры, но version у нас всегда int из кода.
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def _backup(conn: sqlite3.Connection, db_path: str, version: int):
+    """Делает онлайн-копию базы рядом с оригиналом перед миграцией."""
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    backup_path = f"{db_path}.bak-v{version}-{stamp}"
+    target = sqlite3.connect(backup_path)
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+    logger.info(f"Перед миграцией сделан бэкап базы: {backup_path}")
+
+
+def run_migrations(conn: sqlite3.Connection, db_path: str, offline: bool = False) -> int:
+    """
+    Накатывает все недостающие миграции и возвращает итоговую версию схемы.
+    db_path нужен для бэкапа и сообщений. offline=True - зовут из db_tool.py при остановленном боте,
+    можно катить и офлайновые миграции. Без него на непустой базе с такой миграцией в очереди
+    падает с RuntimeError, ничего не накатив. Пустой базе нечего переливать, ей можно все.
+    """
+    current = get_schema_version(conn)
+    pending = [m for m in MIGRATIONS if m.version > current]
+    if not pending:
+        return current
+
+    has_tables = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0] > 0
+    blocking = [m for m in pending if m.offline]
+    if blocking and has_tables and not offline:
+        raise RuntimeError(
+            f"{db_path}: версия схемы {current}, дальше офлайновая миграция {blocking[0].version} "
+            f"({blocking[0].description}). Остановите бота и запустите python db_tool.py migrate."
+        )
+    if has_tables and DB_BACKUP_BEFORE_MIGRATE and db_path != ":memory:":
+        _backup(conn, db_path, current)
+
+    for migration in pending:
+        if migration.chunked:
+            # Сама коммитит пачками и идемпотентна, версию ставим отдельной транзакцией после.
+            if get_schema_version(conn) >= migration.version:
+                continue
+            logger.info(f"Миграция {migration.version}: {migration.description}...")
+            migration.apply(conn)
+            conn.execute("BEGIN IMMEDIATE")
+            if get_schema_version(conn) < migration.version:
+                _set_schema_version(conn, migration.version)
+            conn.commit()
+            continue
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Перечитываем под блокировкой: вдруг соседний процесс уже накатил.
+            if get_schema_version(conn) >= migration.version:
+                conn.rollback()
+                continue
+            logger.info(f"Миграция {migration.version}: {migration.description}...")
+            migration.apply(conn)
+            _set_schema_version(conn, migration.version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception(f"Миграция {migration.version} упала, база осталась на версии {get_schema_version(conn)}")
+            raise
+
+    return get_schema_version(conn)
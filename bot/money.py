@@ -0,0 +1,58 @@
+"""
+Деньги в копейках.
+
+В базе все суммы (нормы, балансы, траты, сводки) - целые копейки в STRICT-таблицах.
+Во float'ах 0,1 + 0,2 не равно 0,3, и раньше каждую цифру приходилось
+прогонять через round() перед показом, а SUM по тысяче трат копил ошибку.
+С целыми копейками все суммы точные, а SQLite хранит их в 1-4 байтах вместо 8.
+
+Рубли остаются только на границе: parse() - из того, что прислал юзер (или
+из CSV), to_text() - для ответа. Между ними - только int, float сюда не ходит.
+"""
+import os
+
+KOPECKS_PER_RUBLE = 100
+# Одна сумма (трата, норма) больше этого (в рублях) - почти наверняка опечатка.
+# Заодно без потолка '99999999999999999999' валит INSERT в STRICT-таблицу (OverflowError),
+# а пара таких в SUM - весь отчет
+MAX_AMOUNT_RUBLES = int(os.getenv("MAX_AMOUNT", "10000000"))
+MAX_AMOUNT = MAX_AMOUNT_RUBLES * KOPECKS_PER_RUBLE
+# Столько цифр в рублях у самой большой суммы - длиннее даже не разбираем
+MAX_AMOUNT_DIGITS = len(str(MAX_AMOUNT_RUBLES))
+
+
+def parse(text: str) -> int:
+    """
+    '150', '123,45', '123.4' -> копейки. Без знака, не больше двух знаков после запятой
+    и не больше MAX_AMOUNT. Все остальное - ValueError. Разбор по строке, без float: '0.29' - ровно 29 копеек.
+    """
+    whole, sep, fraction = text.strip().replace(",", ".").partition(".")
+    if not (whole.isascii() and whole.isdigit()):
+        raise ValueError(f"не сумма: {text!r}")
+    if len(whole.lstrip("0")) > MAX_AMOUNT_DIGITS:
+        raise ValueError(f"слишком большая сумма: {text!r}")
+    if sep and (not (fraction.isascii() and fraction.isdigit()) or len(fraction) > 2):
+        raise ValueError(f"не сумма: {text!r}")
+    kopecks = int(whole) * KOPECKS_PER_RUBLE + (int(fraction.ljust(2, "0")) if sep else 0)
+    if kopecks > MAX_AMOUNT:
+        raise ValueError(f"слишком большая сумма: {text!r}")
+    return kopecks
+
+
+def to_text(kopecks: int, sep: str = ",", always_fraction: bool = False) -> str:
+    """
+    Копейки -> '150', '123,45', '-12,30'. Целые рубли - без копеек,
+    если не попросили always_fraction (для CSV: '150.00').
+    """
+    sign = "-" if kopecks < 0 else ""
+    rubles, fraction = divmod(abs(kopecks), KOPECKS_PER_RUBLE)
+    if fraction or always_fraction:
+        return f"{sign}{rubles}{sep}{fraction:02d}"
+    return f"{sign}{rubles}"
+
+
+def from_float(value: float) -> int:
+    """Рубли float'ом (старые данные) -> копейки, половина копейки - от нуля, как ROUND в SQLite."""
+    scaled = abs(value) * KOPECKS_PER_RUBLE
+    kopecks = int(scaled + 0.5)
+    return -kopecks if value < 0 else kopecks
@@ -0,0 +1,247 @@
+"""
+Исходящие рассылки: бот сам пишет юзерам, а не отвечает на апдейт.
+
+Ответы на апдейты идут по одному на сообщение юзера, и лимиты Телеграма
+их не волнуют. А вечерняя сводка после ночного пересчета - это десятки тысяч
+сообщений за раз, и если просто вывалить их в send_message, Телеграм
+быстро начнет отвечать 429 (RetryAfter) на ВСЕ запросы бота, включая ответы
+живым юзерам. Поэтому рассылки идут через OutboundSender:
+  * общий темп не выше OUTBOUND_RATE_PER_SEC (у Телеграма потолок ~30 в секунду
+    на бота, часть оставляем под ответы на апдейты);
+  * в один чат не чаще раза в OUTBOUND_CHAT_INTERVAL_SEC, в группу - раз в
+    OUTBOUND_GROUP_INTERVAL_SEC (20 в минуту);
+  * одновременно в полете не больше OUTBOUND_CONCURRENCY запросов (семафор),
+    так что рассылка не съедает пул HTTP-соединений бота;
+  * на RetryAfter вся рассылка замирает на сколько сказали и повторяет
+    сообщение, на сетевые ошибки - повтор с паузой, всего до OUTBOUND_MAX_RETRIES раз;
+  * юзер заблокировал бота (Forbidden) - не повторяем, зовем on_blocked.
+
+Рассылки приходят пачками (у нас - по таймзоне), пачки идут по очереди
+в фоновой задаче, так что тот, кто их отправил, ничего не ждет.
+При 25 сообщениях в секунду 100k сводок уходят примерно за час и семь минут.
+
+Бот - любой объект с корутиной send_message(chat_id=..., text=..., parse_mode=...),
+так что рассылку можно гонять на заглушке без сети.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable, NamedTuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from .metrics import OUTBOUND_MESSAGES, OUTBOUND_RETRIES
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_RATE_PER_SEC = float(os.getenv("OUTBOUND_RATE_PER_SEC", "25"))
+OUTBOUND_CHAT_INTERVAL_SEC = float(os.getenv("OUTBOUND_CHAT_INTERVAL_SEC", "1"))
+OUTBOUND_GROUP_INTERVAL_SEC = float(os.getenv("OUTBOUND_GROUP_INTERVAL_SEC", "3"))
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "16"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+# Пауза перед повтором после сетевой ошибки, дальше удваивается
+_NETWORK_RETRY_SEC = 1.0
+
+
+class OutboundMessage(NamedTuple):
+    chat_id: int
+    text: str
+    parse_mode: str | None = None
+
+
+class _Pacer:
+    """
+    Темп "не чаще раза в interval": каждый вызов бронирует себе следующий слот и спит до него.
+    Бронь делается без await, так что в одном event loop'е слоты не достаются двоим.
+    Впрок слоты не копятся: после простоя первый уходит сразу, дальше - строго по interval.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    def reserve(self) -> float:
+        """Бронирует слот и возвращает, сколько до него ждать."""
+        now = time.monotonic()
+        slot = max(self._next, self._paused_until, now)
+        self._next = slot + self.interval
+        return max(slot - now, 0.0)
+
+    async def wait(self):
+        """Ждет своего слота. Если пока ждали, объявили паузу, - ждем ее конца и бронируем заново."""
+        await asyncio.sleep(self.reserve())
+        while time.monotonic() < self._paused_until:
+            await asyncio.sleep(self._paused_until - time.monotonic())
+            await asyncio.sleep(self.reserve())
+
+    def pause(self, seconds: float):
+        """Ничего не выдавать ближайшие seconds секунд."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    # python-telegram-bot 22 отдает тут int или timedelta в зависимости от PTB_TIMEDELTA
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class OutboundSender:
+    """Очередь пачек исходящих сообщений с лимитами Телеграма. Запускается в event loop'е бота."""
+
+    def __init__(self, rate_per_sec: float = OUTBOUND_RATE_PER_SEC, concurrency: int = OUTBOUND_CONCURRENCY,
+                 chat_interval: float = OUTBOUND_CHAT_INTERVAL_SEC, group_interval: float = OUTBOUND_GROUP_INTERVAL_SEC,
+                 max_retries: int = OUTBOUND_MAX_RETRIES,
+                 on_blocked: Callable[[int], Awaitable[None]] | None = None):
+        self.rate_per_sec = rate_per_sec
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        # Зовется с chat_id, когда юзер заблокировал бота или чата больше нет
+        self.on_blocked = on_blocked
+        self._bot = None
+        self._global = _Pacer(1 / rate_per_sec)
+        self._chats: dict[int, _Pacer] = {}
+        self._queue: asyncio.Queue[tuple[str, list[OutboundMessage]]] | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._task: asyncio.Task | None = None
+        # Все живые задачи отправки и дожидания пачек - чтобы погасить их при остановке
+        self._tasks: set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot):
+        """Запускает фоновую задачу в текущем event loop."""
+        if self._task is None:
+            self._bot = bot
+            self._queue = asyncio.Queue()
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.create_task(self._run(), name="outbound-sender")
+
+    async def stop(self):
+        """Останавливает рассылку. Что не успело уйти - теряется, об этом пишем в лог."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(self._task, *self._tasks, return_exceptions=True)
+        self._task = None
+        dropped = 0
+        while not self._queue.empty():
+            dropped += len(self._queue.get_nowait()[1])
+        if dropped:
+            logger.warning(f"Рассылка остановлена, не отправлено {dropped} сообщений.")
+
+    def submit_batch(self, name: str, messages: list[OutboundMessage]):
+        """Ставит пачку в очередь и сразу возвращается. name - для логов (у сводок - таймзона)."""
+        if self._queue is None:
+            raise RuntimeError("OutboundSender не запущен")
+        if messages:
+            self._queue.put_nowait((name, messages))
+
+    def pending_batches(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def join(self):
+        """Ждет, пока уйдут все пачки из очереди (для бенчей и проверок)."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self):
+        while True:
+            name, messages = await self._queue.get()
+            started = time.monotonic()
+            tasks = []
+            for message in messages:
+                # Задачу создаем, только получив место в семафоре: в памяти не больше concurrency задач, а не 100k
+                await self._semaphore.acquire()
+                task = self._spawn(self._send_one(message))
+                task.add_done_callback(lambda _task: self._semaphore.release())
+                tasks.append(task)
+            # Хвост пачки (повторы после сетевых ошибок, паузы групп) дожидаемся отдельно,
+            # а следующая пачка начинает уходить сразу
+            self._spawn(self._finish_batch(name, tasks, started))
+
+    async def _finish_batch(self, name: str, tasks: list[asyncio.Task], started: float):
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            sent = sum(1 for result in results if result is True)
+            self._prune_chats()
+            logger.info(
+                f"Рассылка '{name}': отправлено {sent}, не ушло {len(results) - sent} "
+                f"за {time.monotonic() - started:.1f} сек."
+            )
+        finally:
+            self._queue.task_done()
+
+    def _chat_pacer(self, chat_id: int) -> _Pacer:
+        pacer = self._chats.get(chat_id)
+        if pacer is None:
+            # У групп id отрицательные, им Телеграм разрешает 20 сообщений в минуту
+            pacer = self._chats[chat_id] = _Pacer(self.group_interval if chat_id < 0 else self.chat_interval)
+        return pacer
+
+    def _prune_chats(self):
+        """Забывает чаты, которым уже можно писать без ожидания."""
+        now = time.monotonic()
+        self._chats = {chat_id: pacer for chat_id, pacer in self._chats.items() if pacer._next > now}
+
+    async def _send_one(self, message: OutboundMessage) -> bool:
+        """Отправляет одно сообщение с повторами. True - ушло."""
+        network_delay = _NETWORK_RETRY_SEC
+        for attempt in range(self.max_retries + 1):
+            # Сначала очередь в чат, потом общий слот: иначе общий слот сгорает, пока ждем чат
+            await self._chat_pacer(message.chat_id).wait()
+            await self._global.wait()
+            try:
+                await self._bot.send_message(chat_id=message.chat_id, text=message.text, parse_mode=message.parse_mode)
+                self.sent += 1
+                OUTBOUND_MESSAGES.inc(1, "sent")
+                return True
+            except RetryAfter as e:
+                # Флуд-контроль у Телеграма на весь бот - тормозим всю рассылку, а не только этот чат
+                delay = _retry_after_seconds(e)
+                self._global.pause(delay)
+                OUTBOUND_RETRIES.inc(1, "retry_after")
+                logger.warning(f"Телеграм просит подождать {delay:.0f} сек., рассылка на паузе.")
+            except Forbidden:
+                self.failed += 1
+                OUTBOUND_MESSAGES.inc(1, "blocked")
+                if self.on_blocked is not None:
+                    try:
+                        await self.on_blocked(message.chat_id)
+                    except Exception:
+                        logger.exception(f"Не удалось отписать {message.chat_id} от рассылки.")
+                return False
+            except BadRequest as e:
+                self.failed += 1
+                OUTBOUND_MESSAGES.inc(1, "bad_request")
+                logger.warning(f"Сообщение в {message.chat_id} не ушло: {e}")
+                return False
+            except NetworkError as e:
+                OUTBOUND_RETRIES.inc(1, "network")
+                logger.debug("Сетевая ошибка при отправке в %s: %s", message.chat_id, e)
+                await asyncio.sleep(network_delay)
+                network_delay *= 2
+            except Exception as e:
+                # Одно кривое сообщение не должно ронять всю пачку
+                self.failed += 1
+                OUTBOUND_MESSAGES.inc(1, "error")
+                logger.warning(f"Сообщение в {message.chat_id} не ушло: {e!r}")
+                return False
+            self.retried += 1
+        self.failed += 1
+        OUTBOUND_MESSAGES.inc(1, "gave_up")
+        logger.warning(f"Сообщение в {message.chat_id} не ушло за {self.max_retries + 1} попыток.")
+        return False
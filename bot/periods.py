@@ -0,0 +1,143 @@
+"""
+Бюджетные периоды юзера.
+
+Период начинается в reset_day каждого месяца (по локальной дате юзера) и
+длится до дня перед следующим reset_day. Если в месяце нет такого числа
+(reset_day = 31 в феврале), период начинается в последний день месяца.
+
+Итоги периода лежат в period_rollup: сколько потрачено, сколько дней
+вылезли за норму, баланс на начало и на конец. Строку периода открывает
+(баланс на начало) и закрывает (все остальное) ночной пересчет, когда
+прокручивает день смены периода. /report читает эти строки и не лезет
+в сырые транзакции. Все суммы - в копейках.
+"""
+import calendar
+import sqlite3
+from datetime import date, timedelta
+
+
+def _clamped(year: int, month: int, reset_day: int) -> date:
+    """reset_day в данном месяце, а если такого числа нет - последний день месяца."""
+    return date(year, month, min(reset_day, calendar.monthrange(year, month)[1]))
+
+
+def _shift_month(year: int, month: int, delta: int) -> tuple[int, int]:
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+
+def period_start(day: date, reset_day: int) -> date:
+    """Первый день периода, в который попадает day."""
+    candidate = _clamped(day.year, day.month, reset_day)
+    if candidate <= day:
+        return candidate
+    return _clamped(*_shift_month(day.year, day.month, -1), reset_day)
+
+
+def next_period_start(start: date, reset_day: int) -> date:
+    """Первый день следующего периода."""
+    return _clamped(*_shift_month(start.year, start.month, 1), reset_day)
+
+
+def previous_period_start(start: date, reset_day: int) -> date:
+    """Первый день предыдущего периода."""
+    return _clamped(*_shift_month(start.year, start.month, -1), reset_day)
+
+
+def period_bounds(day: date, reset_day: int) -> tuple[date, date]:
+    """(первый, последний) день периода, в который попадает day."""
+    start = period_start(day, reset_day)
+    return start, next_period_start(start, reset_day) - timedelta(days=1)
+
+
+def boundaries_between(from_day: date, today: date, reset_day: int) -> list[date]:
+    """
+    Начала периодов, которые пересчет проходит, прокручивая дни с from_day до today:
+    все B, где from_day < B <= today.
+    """
+    result = []
+    start = next_period_start(period_start(from_day, reset_day), reset_day)
+    while start <= today:
+        result.append(start)
+        start = next_period_start(start, reset_day)
+    return result
+
+
+def write_boundaries(conn: sqlite3.Connection, user_id: int, reset_day: int, daily_norm: int,
+                     boundaries: list[tuple[date, int]]):
+    """
+    Закрывает прошедшие периоды и открывает новые. boundaries - пары
+    (начало нового периода, баланс на начало этого дня) в порядке дат.
+    Работает внутри транзакции вызывающего. Повторный вызов с теми же данными ничего не меняет,
+    так что два пересчета, наперегонки дошедшие до одной даты, друг другу не мешают.
+    """
+    for start, balance in boundaries:
+        previous = previous_period_start(start, reset_day)
+        last_day = (start - timedelta(days=1)).isoformat()
+        # Закрываем предыдущий период: суммы - одним диапазоном по первичному ключу daily_spend
+        conn.execute(
+            """
+            INSERT INTO period_rollup
+                (user_id, period_start, period_end, total, days_over, start_balance, end_balance, finalized)
+            SELECT ?, ?, ?, COALESCE(SUM(total), 0), COALESCE(SUM(total > ?), 0), NULL, ?, 1
+            FROM daily_spend
+            WHERE user_id = ? AND local_date BETWEEN ? AND ?
+            ON CONFLICT (user_id, period_start) DO UPDATE
+            SET period_end = excluded.period_end, total = excluded.total, days_over = excluded.days_over,
+                end_balance = excluded.end_balance, finalized = 1
+            """,
+            (user_id, previous.isoformat(), last_day, daily_norm, balance, user_id, previous.isoformat(), last_day)
+        )
+        open_period(conn, user_id, start, reset_day, balance)
+
+
+def open_period(conn: sqlite3.Connection, user_id: int, start: date, reset_day: int, start_balance: int):
+    """Заводит строку периода с балансом на начало. Если строка уже есть, обновляет только баланс на начало."""
+    end = next_period_start(start, reset_day) - timedelta(days=1)
+    conn.execute(
+        """
+        INSERT INTO period_rollup
+            (user_id, period_start, period_end, total, days_over, start_balance, end_balance, finalized)
+        VALUES (?, ?, ?, 0, 0, ?, NULL, 0)
+        ON CONFLICT (user_id, period_start) DO UPDATE
+        SET start_balance = excluded.start_balance
+        """,
+        (user_id, start.isoformat(), end.isoformat(), start_balance)
+    )
+
+
+def apply_spend_delta(conn: sqlite3.Connection, user_id: int, local_date: str, amount: int, daily_norm: int):
+    """
+    Поправляет итоги периодов, когда трату задним числом добавили (amount > 0) или убрали (amount < 0)
+    в уже пересчитанный день local_date. Баланс на начало всех следующих периодов и на конец
+    закрытых периодов с этим днем и позже сдвигается на -amount, траты закрытого периода
+    с этим днем досчитываются из daily_spend (daily_spend к этому моменту уже поправлен).
+    Работает внутри транзакции вызывающего.
+    """
+    conn.execute(
+        """
+        UPDATE period_rollup SET start_balance = start_balance - ?
+        WHERE user_id = ? AND period_start > ? AND start_balance IS NOT NULL
+        """,
+        (amount, user_id, local_date)
+    )
+    conn.execute(
+        """
+        UPDATE period_rollup SET end_balance = end_balance - ?
+        WHERE user_id = ? AND period_end >= ? AND end_balance IS NOT NULL
+        """,
+        (amount, user_id, local_date)
+    )
+    conn.execute(
+        """
+        UPDATE period_rollup
+        SET (total, days_over) = (
+            SELECT COALESCE(SUM(d.total), 0), COALESCE(SUM(d.total > ?), 0)
+            FROM daily_spend d
+            WHERE d.user_id = period_rollup.user_id
+              AND d.local_date BETWEEN period_rollup.period_start AND period_rollup.period_end
+        )
+        WHERE user_id = ? AND finalized = 1 AND period_start <= ? AND period_end >= ?
+        """,
+        (daily_norm, user_id, local_date, local_date)
+    )
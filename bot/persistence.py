@@ -0,0 +1,221 @@
+"""
+Персистентность диалогов и user_data в той же SQLite.
+
+Без нее состояния ConversationHandler'ов (регистрация, /settings, /delete_me,
+/import) и context.user_data['daily_norm'] живут только в памяти, и каждый
+деплой или падение выкидывает юзера посреди регистрации. PicklePersistence
+на каждый сброс переписывает весь файл целиком - нам это не подходит.
+
+Тут каждое состояние диалога и каждый user_data - отдельная строка:
+  * при старте читаем только живое: законченные диалоги и пустой user_data
+    из базы удаляются, так что старт не зависит от числа юзеров, а только
+    от того, сколько человек прямо сейчас посреди диалога;
+  * python-telegram-bot сам помнит, какие ключи менялись, и раз в
+    update_interval отдает их сюда. Мы их не пишем по одному, а копим и
+    сбрасываем одной транзакцией (write-behind), в пуле потоков базы;
+  * при остановке бот вызывает flush() - дописываем то, что осталось.
+
+Данные хранятся в JSON, так что в user_data должно лежать то, что в JSON
+влезает (у нас там только число).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from .async_db import run_in_db
+from .db import get_db_connection
+from .metrics import instrumented
+
+logger = logging.getLogger(__name__)
+
+# Как часто python-telegram-bot отдает нам изменившиеся ключи
+PERSISTENCE_UPDATE_INTERVAL_SEC = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL_SEC", "5"))
+# Недоконченный диалог старше этого при старте не поднимаем и стираем
+PERSISTENCE_CONVERSATION_TTL_SEC = int(os.getenv("PERSISTENCE_CONVERSATION_TTL_SEC", str(24 * 3600)))
+# Сколько ждем, чтобы собрать все изменения одного прохода в одну транзакцию
+_FLUSH_DELAY_SEC = 0.05
+
+
+def _encode_key(key: tuple) -> str:
+    return json.dumps(list(key), separators=(",", ":"))
+
+
+def _decode_key(raw: str) -> tuple:
+    return tuple(json.loads(raw))
+
+
+@instrumented
+def load_conversations(name: str, ttl_sec: int = PERSISTENCE_CONVERSATION_TTL_SEC) -> dict[tuple, object]:
+    """Живые диалоги с именем name. Протухшие заодно стирает."""
+    cutoff = int(time.time()) - ttl_sec
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM bot_conversations WHERE name = ? AND updated_at < ?", (name, cutoff))
+        conn.commit()
+        rows = conn.execute("SELECT conv_key, state FROM bot_conversations WHERE name = ?", (name,)).fetchall()
+    return {_decode_key(conv_key): json.loads(state) for conv_key, state in rows}
+
+
+@instrumented
+def load_user_data() -> dict[int, dict]:
+    """Все непустые user_data."""
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT user_id, data FROM bot_user_data").fetchall()
+    return {user_id: json.loads(data) for user_id, data in rows}
+
+
+@instrumented
+def write_changes(conversations: dict[tuple[str, tuple], object], user_data: dict[int, dict | None]):
+    """
+    Пишет накопленные изменения одной транзакцией. Состояние None и пустой
+    (или удаленный, None) user_data - это удаление строки.
+    """
+    now = int(time.time())
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "DELETE FROM bot_conversations WHERE name = ? AND conv_key = ?",
+            [(name, _encode_key(key)) for (name, key), state in conversations.items() if state is None]
+        )
+        conn.executemany(
+            """
+            INSERT INTO bot_conversations (name, conv_key, state, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (name, conv_key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+            """,
+            [
+                (name, _encode_key(key), json.dumps(state), now)
+                for (name, key), state in conversations.items() if state is not None
+            ]
+        )
+        conn.executemany(
+            "DELETE FROM bot_user_data WHERE user_id = ?",
+            [(user_id,) for user_id, data in user_data.items() if not data]
+        )
+        conn.executemany(
+            """
+            INSERT INTO bot_user_data (user_id, data, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+            """,
+            [(user_id, json.dumps(data), now) for user_id, data in user_data.items() if data]
+        )
+        conn.commit()
+
+
+class SQLitePersistence(BasePersistence[dict, dict, dict]):
+    """Диалоги и user_data построчно в SQLite, запись пачками. chat_data, bot_data и callback_data не храним."""
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL_SEC):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        # Изменения, которые еще не ушли в базу: последнее значение на ключ
+        self._pending_conversations: dict[tuple[str, tuple], object] = {}
+        self._pending_user_data: dict[int, dict | None] = {}
+        self._flush_task: asyncio.Task | None = None
+        # У кого в базе есть строка user_data. Почти у всех user_data пустой, а приложение отдает его
+        # на каждого, кто хоть что-то написал, - без этого мы бы гоняли DELETE на каждого активного юзера.
+        self._stored_user_ids: set[int] = set()
+        self.flushes = 0
+
+    # --- ЧТЕНИЕ ПРИ СТАРТЕ ---
+
+    async def get_user_data(self) -> dict[int, dict]:
+        data = await run_in_db(load_user_data)
+        self._stored_user_ids = set(data)
+        logger.info(f"Поднято user_data из базы: {len(data)}")
+        return data
+
+    async def get_conversations(self, name: str) -> dict[tuple, object]:
+        conversations = await run_in_db(load_conversations, name)
+        if conversations:
+            logger.info(f"Поднято недоконченных диалогов '{name}': {len(conversations)}")
+        return conversations
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- ЗАПИСЬ: КОПИМ И СБРАСЫВАЕМ ПАЧКОЙ ---
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._pending_conversations[(name, tuple(key))] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # data - уже копия, приложение делает deepcopy само
+        if data:
+            self._stored_user_ids.add(user_id)
+        elif user_id in self._stored_user_ids:
+            self._stored_user_ids.discard(user_id)
+        else:
+            return
+        self._pending_user_data[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._stored_user_ids:
+            self._stored_user_ids.discard(user_id)
+            self._pending_user_data[user_id] = None
+            self._schedule_flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # Пишет в базу только этот процесс, так что освежать нечего
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    def _schedule_flush(self):
+        """Все update_* одного прохода приложения приходят разом - пишем их одной транзакцией чуть позже."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush(), name="persistence-flush")
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(_FLUSH_DELAY_SEC)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        if not self._pending_conversations and not self._pending_user_data:
+            return
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        try:
+            await run_in_db(write_changes, conversations, user_data)
+            self.flushes += 1
+        except Exception:
+            # Не теряем изменения: возвращаем их в очередь, если поверх не пришло что-то новее
+            for key, value in conversations.items():
+                self._pending_conversations.setdefault(key, value)
+            for key, value in user_data.items():
+                self._pending_user_data.setdefault(key, value)
+            logger.exception("Не удалось записать состояния диалогов, попробуем на следующем проходе.")
+
+    async def flush(self) -> None:
+        """Дописывает все, что накопилось. Вызывается приложением при остановке."""
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._write_pending()
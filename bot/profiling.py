@@ -0,0 +1,392 @@
+"""
+Профилирование на живом боте: на что уходит время, когда /status вдруг тупит.
+
+Метрики (bot/metrics.py) говорят, ЧТО медленно, но не ПОЧЕМУ: то ли запрос
+сканирует таблицу, то ли ждет чужую блокировку на файле базы, то ли event loop
+стоит, потому что кто-то в нем делает синхронную работу. Тут три инструмента,
+каждый включается своей переменной окружения, и ноль - это "выключено":
+  * PROFILE_SLOW_QUERY_MS - каждый запрос через соединения bot/db.py дольше порога
+    пишется в лог: откуда вызван, SQL, форма параметров (типы, без значений)
+    и EXPLAIN QUERY PLAN. SCAN вместо SEARCH - это про индексы, медленный
+    BEGIN IMMEDIATE или COMMIT без плана - это ожидание блокировки или fsync;
+  * PROFILE_HANDLERS_SAMPLE_RATE - такая доля вызовов хендлеров гоняется под cProfile,
+    раз в PROFILE_DUMP_INTERVAL_SEC в лог уходят PROFILE_TOP самых дорогих функций
+    по каждому хендлеру. С PROFILE_TRACEMALLOC_FRAMES еще и память: пик на вызов
+    и строки, где больше всего прибавилось с прошлого раза;
+  * PROFILE_LOOP_LAG_MS - сторож event loop'а. Если loop не отзывался дольше порога,
+    из соседнего потока снимаем стек того, что его держит, и пишем в лог.
+
+Выключенное не стоит ничего: соединения остаются обычными sqlite3.Connection,
+хендлеры не оборачиваются, задачи и потоки не запускаются.
+
+Ограничения, про которые надо помнить, читая вывод:
+  * cProfile видит только поток event loop'а: пока хендлер ждет await, в профиль
+    попадают и чужие корутины, а сами запросы идут в пуле базы и видны
+    только как ожидание. Запросы смотрим в логе медленных запросов;
+  * время запроса - это execute(): для SUM и вставок это весь запрос,
+    для SELECT со многими строками - только до первой строки.
+"""
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from .metrics import DB_SLOW_QUERIES, LOOP_LAG_SECONDS, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SLOW_QUERY_MS = float(os.getenv("PROFILE_SLOW_QUERY_MS", "0"))
+PROFILE_HANDLERS_SAMPLE_RATE = float(os.getenv("PROFILE_HANDLERS_SAMPLE_RATE", "0"))
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "0"))
+PROFILE_DUMP_INTERVAL_SEC = float(os.getenv("PROFILE_DUMP_INTERVAL_SEC", "300"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "15"))
+PROFILE_LOOP_LAG_MS = float(os.getenv("PROFILE_LOOP_LAG_MS", "0"))
+
+# Длинный SQL (миграции, пересчет) в логе обрезаем
+_SQL_LOG_LIMIT = 600
+# Для каких запросов вообще бывает план
+_EXPLAINABLE = ("select", "insert", "update", "delete", "with", "replace")
+# Планы кэшируем по тексту запроса: запросов в боте десятки, а медленный может повторяться часто
+_PLAN_CACHE_SIZE = 512
+
+
+# --- МЕДЛЕННЫЕ ЗАПРОСЫ ---
+
+def _params_shape(params, many: bool = False) -> str:
+    """Типы параметров без значений: '(int, int, NoneType)', '{user_id: int}', '1000 x (int, str)'."""
+    if many:
+        if isinstance(params, (list, tuple)):
+            first = _params_shape(params[0]) if params else "()"
+            return f"{len(params)} x {first}"
+        return f"? x (итератор {type(params).__name__})"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in params.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in params) + ")"
+
+
+def _caller() -> str:
+    """Первая функция за пределами этого файла, которая дернула запрос: 'db.py:get_spent_today'."""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+class _SlowQueryLog:
+    """Порог и кэш планов, общие для всех соединений."""
+
+    def __init__(self, threshold_ms: float):
+        self.threshold = threshold_ms / 1000
+        self._plans: dict[str, str] = {}
+
+    def _plan(self, conn: sqlite3.Connection, sql: str, params) -> str:
+        plan = self._plans.get(sql)
+        if plan is not None:
+            return plan
+        if not sql.lstrip().lower().startswith(_EXPLAINABLE):
+            return ""
+        try:
+            # Обычный курсор, чтобы сам EXPLAIN не попал в лог медленных
+            rows = sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        except sqlite3.Error as e:
+            return f"(план не снять: {e})"
+        # Строки плана - (id, parent, notused, detail), вложенность рисуем отступом
+        depth = {0: -1}
+        lines = []
+        for row in rows:
+            depth[row[0]] = depth.get(row[1], -1) + 1
+            lines.append("  " * depth[row[0]] + row[3])
+        plan = "\n".join(lines)
+        if len(self._plans) >= _PLAN_CACHE_SIZE:
+            self._plans.clear()
+        self._plans[sql] = plan
+        return plan
+
+    def report(self, conn: sqlite3.Connection, sql: str, params, many: bool, seconds: float):
+        caller = _caller()
+        DB_SLOW_QUERIES.inc(1, caller)
+        # Для executemany план снимаем по первому набору параметров, если он есть
+        plan_params = params
+        if many:
+            plan_params = params[0] if isinstance(params, (list, tuple)) and params else None
+        plan = self._plan(conn, sql, plan_params) if plan_params is not None else ""
+        text = " ".join(sql.split())
+        if len(text) > _SQL_LOG_LIMIT:
+            text = text[:_SQL_LOG_LIMIT] + "..."
+        logger.warning(
+            f"Медленный запрос {seconds * 1000:.1f} мс из {caller} "
+            f"({'в транзакции' if conn.in_transaction else 'вне транзакции'}, "
+            f"поток {threading.current_thread().name}): {text}\n"
+            f"  параметры: {_params_shape(params, many)}\n"
+            f"  план:\n    " + ("\n    ".join(plan.splitlines()) if plan else "(нет)")
+        )
+
+
+_slow_log = _SlowQueryLog(PROFILE_SLOW_QUERY_MS)
+
+
+class _SlowQueryCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=(), /):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed >= _slow_log.threshold:
+                _slow_log.report(self.connection, sql, parameters, False, elapsed)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        # Генератор после execute уже пуст, а форму параметров показать хочется
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed >= _slow_log.threshold:
+                _slow_log.report(self.connection, sql, seq_of_parameters, True, elapsed)
+
+
+class SlowQueryConnection(sqlite3.Connection):
+    """
+    Соединение, которое засекает каждый execute/executemany и commit(). Connection.execute
+    в C-шной реализации зовет execute курсора мимо питона, поэтому его тоже переопределяем.
+    commit() тоже идет мимо execute, а fsync и ожидание чекпойнта сидят как раз в нем.
+    `with conn:` зовет commit изнутри C и сюда не попадает - в bot/ так и не пишем.
+    """
+
+    def cursor(self, factory=_SlowQueryCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed >= _slow_log.threshold:
+                _slow_log.report(self, "COMMIT", (), False, elapsed)
+
+
+def connection_factory() -> type[sqlite3.Connection]:
+    """Класс соединения для sqlite3.connect(factory=...): с логом медленных запросов или обычный."""
+    return SlowQueryConnection if PROFILE_SLOW_QUERY_MS > 0 else sqlite3.Connection
+
+
+# --- ХЕНДЛЕРЫ ПОД cProfile ---
+
+class HandlerProfiler:
+    """
+    Гоняет долю вызовов хендлеров под cProfile (и tracemalloc) и периодически сбрасывает итоги в лог.
+    В потоке активен только один профайлер, так что в каждый момент профилируется один вызов:
+    остальные, пришедшие параллельно, просто пропускаем.
+    """
+
+    def __init__(self, sample_rate: float = PROFILE_HANDLERS_SAMPLE_RATE,
+                 tracemalloc_frames: int = PROFILE_TRACEMALLOC_FRAMES,
+                 dump_interval: float = PROFILE_DUMP_INTERVAL_SEC, top: int = PROFILE_TOP):
+        self.sample_rate = sample_rate
+        self.tracemalloc_frames = tracemalloc_frames
+        self.dump_interval = dump_interval
+        self.top = top
+        self._active = False
+        # handler -> (накопленный pstats, число вызовов)
+        self._stats: dict[str, tuple[pstats.Stats, int]] = {}
+        # handler -> [максимальный пик памяти за вызов, сумма пиков]
+        self._memory: dict[str, list[int]] = {}
+        self._snapshot: tracemalloc.Snapshot | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def wrap(self, callback):
+        """Оборачивает колбэк хендлера. Для _instrument в register_handlers."""
+        name = getattr(callback, "__name__", repr(callback))
+
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            if self._active or random.random() >= self.sample_rate:
+                return await callback(*args, **kwargs)
+            return await self._profiled(name, callback, args, kwargs)
+        wrapper.__profiled__ = True
+        return wrapper
+
+    async def _profiled(self, name: str, callback, args, kwargs):
+        self._active = True
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._active = False
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1] - base
+                memory = self._memory.setdefault(name, [0, 0])
+                memory[0] = max(memory[0], peak)
+                memory[1] += peak
+            stats, calls = self._stats.get(name, (None, 0))
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self._stats[name] = (stats, calls + 1)
+
+    def start(self):
+        """Включает tracemalloc и запускает периодический сброс в лог. Выключен - ничего не делает."""
+        if not self.enabled or self._task is not None:
+            return
+        if self.tracemalloc_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+            self._snapshot = tracemalloc.take_snapshot()
+        self._task = asyncio.create_task(self._run(), name="handler-profiler")
+        logger.info(
+            f"Профилируем {self.sample_rate:.1%} вызовов хендлеров, "
+            f"tracemalloc {'на ' + str(self.tracemalloc_frames) + ' кадров' if self.tracemalloc_frames > 0 else 'выключен'}, "
+            f"итоги раз в {self.dump_interval:.0f} сек."
+        )
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # Что накопилось с последнего сброса - тоже в лог
+        self.dump()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            try:
+                self.dump()
+            except Exception:
+                logger.exception("Не удалось сбросить профиль хендлеров.")
+
+    def dump(self):
+        """Пишет в лог топ функций по каждому хендлеру и забывает накопленное."""
+        stats, self._stats = self._stats, {}
+        memory, self._memory = self._memory, {}
+        for name, (handler_stats, calls) in sorted(stats.items()):
+            stream = io.StringIO()
+            handler_stats.stream = stream
+            handler_stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+            peak = ""
+            if name in memory:
+                peak = f", пик памяти {memory[name][0] / 1024:.0f} КБ (в среднем {memory[name][1] / calls / 1024:.0f} КБ)"
+            logger.info(f"Профиль {name}: {calls} вызовов{peak}\n{stream.getvalue().strip()}")
+        if self._snapshot is not None and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                # Свои же накладные расходы профилирования не показываем
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, pstats.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            top = snapshot.compare_to(self._snapshot, "lineno")[:self.top]
+            self._snapshot = snapshot
+            logger.info("Память, прибавка с прошлого раза:\n" + "\n".join(f"  {stat}" for stat in top))
+
+
+# --- СТОРОЖ EVENT LOOP'А ---
+
+class LoopLagMonitor:
+    """
+    Корутина в loop'е раз в interval отмечается и меряет, насколько позже проснулась (это и есть лаг).
+    Поток-сторож смотрит на отметку: если ее нет дольше threshold, loop что-то держит,
+    и сторож снимает стек потока loop'а - там и будет блокирующий вызов. На один затык - одна запись.
+    """
+
+    def __init__(self, threshold_ms: float = PROFILE_LOOP_LAG_MS):
+        self.threshold = threshold_ms / 1000
+        # Отмечаемся в несколько раз чаще порога, чтобы лаг меньше порога не выглядел затыком
+        self.interval = self.threshold / 4
+        self._beat = 0.0
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+        self.stalls = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def start(self):
+        """Запускает отметки и сторожа в текущем event loop. Выключен - ничего не делает."""
+        if not self.enabled or self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-lag-monitor")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"Сторож event loop'а запущен, порог {self.threshold * 1000:.0f} мс.")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._watchdog.join()
+        self._watchdog = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._beat = now
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.threshold:
+                logger.warning(f"Event loop опоздал на {lag * 1000:.0f} мс.")
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            stalled_for = time.monotonic() - beat - self.interval
+            if stalled_for < self.threshold or beat == reported_beat:
+                continue
+            reported_beat = beat
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(стек не снять)\n"
+            logger.warning(f"Event loop стоит уже {stalled_for * 1000:.0f} мс, сейчас в нем:\n{stack.rstrip()}")
+
+
+# По одному на процесс: main.py запускает их в on_startup, register_handlers оборачивает хендлеры
+handler_profiler = HandlerProfiler()
+loop_monitor = LoopLagMonitor()
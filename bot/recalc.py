@@ -0,0 +1,392 @@
+"""
+Пакетный пересчет накопленных балансов.
+
+Старый пересчет в recalc_job.py шел по юзерам по одному: на каждый
+пропущенный день отдельный запрос трат и на каждого юзера отдельный коммит.
+Тут все делается оптом:
+  * одним запросом берем всех активных юзеров, у кого наступил новый день;
+  * кладем их во временную таблицу и одним JOIN'ом вытаскиваем из daily_spend
+    траты по всем нужным дням сразу;
+  * дни без трат проматываем формулой (balance += k * daily_norm);
+  * все новые балансы пишем одним executemany в одной транзакции.
+
+Баланс - линейная цепочка: на конец каждого дня balance = (norm + balance) - spent.
+Поэтому считать можно только по дням, где были траты. Все в целых копейках,
+так что результат не зависит от порядка сложения и сверяется точным равенством.
+"""
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+
+from . import db, tzcalendar
+from .db import get_db_connection, _users_write
+from .metrics import observe_recalc
+from .periods import boundaries_between, write_boundaries
+
+logger = logging.getLogger(__name__)
+
+_UTC = ZoneInfo("UTC")
+
+
+class RecalcResult(NamedTuple):
+    # Все суммы - в копейках
+    user_id: int
+    old_balance: int
+    new_balance: int
+    # Дата последнего пересчета до и после (после - "сегодня" по таймзоне юзера)
+    last_recalc_date: str
+    new_recalc_date: str
+    # Траты из daily_spend за дни от last_recalc_date до сегодня включительно
+    spent_by_day: dict[str, int]
+    # Нужны, чтобы закрыть бюджетные периоды, через которые прошел пересчет
+    daily_norm: int
+    reset_day: int
+
+
+def roll_balance(balance: int, norm: int, from_day: date, today: date,
+                 spent_by_day: dict[date, int], spent_today: int = 0) -> int:
+    """
+    Прокручивает баланс с начала дня from_day до начала дня today.
+    spent_today докидывается к первому дню - ровно так, как это делает старый цикл
+    в recalc_job.py (траты, сделанные в день пересчета, учитываются сразу).
+    """
+    events = {day: spent for day, spent in spent_by_day.items() if from_day <= day < today}
+    if spent_today:
+        events[from_day] = events.get(from_day, 0) + spent_today
+
+    cursor_day = from_day
+    for spend_day in sorted(events):
+        # Дни без трат до этого дня - просто по норме за каждый
+        balance += (spend_day - cursor_day).days * norm
+        balance = (norm + balance) - events[spend_day]
+        cursor_day = spend_day + timedelta(days=1)
+    balance += (today - cursor_day).days * norm
+    return balance
+
+
+def _today_by_timezone(timezones, now_utc: datetime) -> dict[str, date | None]:
+    """Сегодняшняя дата для каждой таймзоны. None - таймзона кривая."""
+    return {
+        timezone: tzcalendar.today(timezone, now_utc) if tzcalendar.is_valid(timezone) else None
+        for timezone in timezones
+    }
+
+
+def compute_recalculations(now_utc: datetime | None = None, timezone: str | None = None,
+                           user_range: tuple[int, int] | None = None) -> list[RecalcResult]:
+    """
+    Считает новые балансы всех юзеров, у которых наступил новый день. Ничего не пишет.
+    С timezone - только юзеров этой таймзоны, выборка идет по индексу (timezone, last_recalc_date).
+    С user_range=(lo, hi) - только юзеров с user_id от lo до hi включительно (шард).
+    Файлы шардов базы (DB_SHARDS) считаются параллельно, каждый своим соединением.
+    """
+    now_utc = now_utc or datetime.now(_UTC)
+    return [
+        result
+        for shard_results in db.for_each_shard(
+            lambda shard: _compute_in_db_shard(shard, now_utc, timezone, user_range)
+        )
+        for result in shard_results
+    ]
+
+
+def _compute_in_db_shard(shard: int, now_utc: datetime, timezone: str | None,
+                         user_range: tuple[int, int] | None) -> list[RecalcResult]:
+    """compute_recalculations по одному файлу шарда."""
+    with get_db_connection(shard=shard) as conn:
+        if timezone is None:
+            lo, hi = user_range or (-(2 ** 63), 2 ** 63 - 1)
+            users = conn.execute(
+                """
+                SELECT user_id, timezone, daily_norm, reset_day, accumulated_balance, last_recalc_date
+                FROM users
+                WHERE is_active = 1 AND user_id BETWEEN ? AND ?
+                """,
+                (lo, hi)
+            ).fetchall()
+            today_by_tz = _today_by_timezone({user["timezone"] for user in users}, now_utc)
+        else:
+            today_by_tz = _today_by_timezone([timezone], now_utc)
+            if today_by_tz[timezone] is None:
+                logger.warning(f"Неверная таймзона '{timezone}', пересчитывать ее некому.")
+                return []
+            users = conn.execute(
+                """
+                SELECT user_id, timezone, daily_norm, reset_day, accumulated_balance, last_recalc_date
+                FROM users
+                WHERE timezone = ? AND last_recalc_date < ? AND is_active = 1
+                """,
+                (timezone, today_by_tz[timezone].isoformat())
+            ).fetchall()
+
+        due = []
+        for user in users:
+            today = today_by_tz[user["timezone"]]
+            if today is None:
+                logger.warning(f"Неверная таймзона '{user['timezone']}' для пользователя {user['user_id']}. Пропускаем.")
+                continue
+            if date.fromisoformat(user["last_recalc_date"]) < today:
+                due.append((user, today))
+        if not due:
+            return []
+
+        # Все траты за нужные окна дней - одним запросом через временную таблицу
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS recalc_due (user_id INTEGER PRIMARY KEY, from_date TEXT, today TEXT)"
+        )
+        conn.execute("DELETE FROM recalc_due")
+        conn.executemany(
+            "INSERT INTO recalc_due (user_id, from_date, today) VALUES (?, ?, ?)",
+            [(user["user_id"], user["last_recalc_date"], today.isoformat()) for user, today in due]
+        )
+        spent: dict[int, dict[str, int]] = {}
+        for user_id, local_date, total in conn.execute(
+            """
+            SELECT d.user_id, d.local_date, d.total
+            FROM recalc_due r
+            JOIN daily_spend d
+              ON d.user_id = r.user_id
+             AND d.local_date >= r.from_date
+             AND d.local_date <= r.today
+            """
+        ):
+            spent.setdefault(user_id, {})[local_date] = total
+        conn.execute("DELETE FROM recalc_due")
+        conn.commit()
+
+    return [_result_for(user, today, spent.get(user["user_id"], {})) for user, today in due]
+
+
+def _result_for(user, today: date, user_spent: dict[str, int]) -> RecalcResult:
+    """Новый баланс юзера (строка users) на утро today по его тратам за дни от last_recalc_date до today."""
+    from_day = date.fromisoformat(user["last_recalc_date"])
+    new_balance = roll_balance(
+        user["accumulated_balance"],
+        user["daily_norm"],
+        from_day,
+        today,
+        {date.fromisoformat(day): total for day, total in user_spent.items()},
+        spent_today=user_spent.get(today.isoformat(), 0),
+    )
+    return RecalcResult(
+        user_id=user["user_id"],
+        old_balance=user["accumulated_balance"],
+        new_balance=new_balance,
+        last_recalc_date=user["last_recalc_date"],
+        new_recalc_date=today.isoformat(),
+        spent_by_day=user_spent,
+        daily_norm=user["daily_norm"],
+        reset_day=user["reset_day"],
+    )
+
+
+def period_boundaries(result: RecalcResult) -> list[tuple[date, int]]:
+    """
+    Начала бюджетных периодов, через которые прошел пересчет, и баланс на утро каждого из них.
+    Баланс считается той же roll_balance, что и итоговый, так что на последней границе
+    (если она сегодня) он совпадает с new_balance.
+    """
+    from_day = date.fromisoformat(result.last_recalc_date)
+    today = date.fromisoformat(result.new_recalc_date)
+    boundaries = boundaries_between(from_day, today, result.reset_day)
+    if not boundaries:
+        return []
+    spent = {date.fromisoformat(day): total for day, total in result.spent_by_day.items()}
+    spent_today = result.spent_by_day.get(result.new_recalc_date, 0)
+    return [
+        (boundary, roll_balance(result.old_balance, result.daily_norm, from_day, boundary, spent, spent_today))
+        for boundary in boundaries
+    ]
+
+
+def apply_recalculations(results: list[RecalcResult]) -> int:
+    """
+    Пишет новые балансы одной транзакцией. Обновление условное: если юзера
+    уже пересчитал кто-то другой (дата пересчета сдвинулась), его не трогаем.
+    В той же транзакции закрываются бюджетные периоды, через которые прошел пересчет.
+    Возвращает число реально обновленных юзеров.
+    С шардами базы у каждого шарда своя транзакция, пишутся они параллельно.
+    """
+    if not results:
+        return 0
+    by_shard: dict[int, list[RecalcResult]] = {}
+    for r in results:
+        by_shard.setdefault(db.shard_of(r.user_id), []).append(r)
+    updated = sum(db.for_each_shard(lambda shard: _apply_in_db_shard(shard, by_shard[shard]), by_shard))
+    if updated < len(results):
+        logger.warning(f"Пропущено {len(results) - updated} юзеров: их уже пересчитали параллельно.")
+    return updated
+
+
+def _apply_in_db_shard(shard: int, results: list[RecalcResult]) -> int:
+    """apply_recalculations по юзерам одного файла шарда."""
+    update_sql = """
+        UPDATE users
+        SET accumulated_balance = ?, last_recalc_date = ?
+        WHERE user_id = ? AND last_recalc_date = ?
+    """
+    # Смена периода бывает раз в месяц на юзера, так что таких обычно нет или единицы
+    with_boundaries = [(r, boundaries) for r in results if (boundaries := period_boundaries(r))]
+    with _users_write([r.user_id for r in results], shard=shard) as conn:
+        bounded = {r.user_id for r, _boundaries in with_boundaries}
+        cursor = conn.executemany(
+            update_sql,
+            [(r.new_balance, r.new_recalc_date, r.user_id, r.last_recalc_date)
+             for r in results if r.user_id not in bounded]
+        )
+        updated = cursor.rowcount
+        # Периоды закрываем, только если баланс записали мы. Если юзера обогнал другой пересчет
+        # или правка задним числом (bot/edits.py), итоги периодов уже записаны, и, может быть, уже поправлены.
+        for r, boundaries in with_boundaries:
+            if conn.execute(update_sql, (r.new_balance, r.new_recalc_date, r.user_id, r.last_recalc_date)).rowcount:
+                updated += 1
+                write_boundaries(conn, r.user_id, r.reset_day, r.daily_norm, boundaries)
+    return updated
+
+
+def recalc_user(conn: sqlite3.Connection, user_id: int, now_utc: datetime | None = None) -> RecalcResult | None:
+    """
+    Пересчитывает одного юзера, если ему пора, внутри уже открытой транзакции на запись
+    (BEGIN IMMEDIATE) - для правок задним числом (bot/edits.py). Траты читаются под той же
+    блокировкой, так что они свежие. Пакетный пересчет, который успел прочитать юзера раньше,
+    потом не пройдет условие на last_recalc_date и юзера пропустит, а не перезапишет.
+    None - пересчитывать нечего.
+    """
+    user = conn.execute(
+        """
+        SELECT user_id, timezone, daily_norm, reset_day, accumulated_balance, last_recalc_date
+        FROM users
+        WHERE user_id = ? AND is_active = 1
+        """,
+        (user_id,)
+    ).fetchone()
+    if user is None or not tzcalendar.is_valid(user["timezone"]):
+        return None
+    today = tzcalendar.today(user["timezone"], now_utc or datetime.now(_UTC))
+    if date.fromisoformat(user["last_recalc_date"]) >= today:
+        return None
+    user_spent = {
+        local_date: total
+        for local_date, total in conn.execute(
+            "SELECT local_date, total FROM daily_spend WHERE user_id = ? AND local_date BETWEEN ? AND ?",
+            (user_id, user["last_recalc_date"], today.isoformat())
+        )
+    }
+    result = _result_for(user, today, user_spent)
+    conn.execute(
+        "UPDATE users SET accumulated_balance = ?, last_recalc_date = ? WHERE user_id = ? AND last_recalc_date = ?",
+        (result.new_balance, result.new_recalc_date, user_id, result.last_recalc_date)
+    )
+    boundaries = period_boundaries(result)
+    if boundaries:
+        write_boundaries(conn, user_id, result.reset_day, result.daily_norm, boundaries)
+    return result
+
+
+def caught_up_days(results: list[RecalcResult]) -> int:
+    """Сколько дней прокручено в сумме по всем юзерам."""
+    return sum((date.fromisoformat(r.new_recalc_date) - date.fromisoformat(r.last_recalc_date)).days for r in results)
+
+
+def run_bulk_recalculations(now_utc: datetime | None = None, timezone: str | None = None) -> list[RecalcResult]:
+    """Считает и сразу применяет пересчет всех (или одной таймзоны), у кого наступил новый день."""
+    started = time.monotonic()
+    results = compute_recalculations(now_utc, timezone=timezone)
+    updated = apply_recalculations(results)
+    days = caught_up_days(results)
+    observe_recalc("bulk", updated, days, time.monotonic() - started)
+    scope = f"таймзона {timezone}" if timezone else "все таймзоны"
+    logger.info(f"Пакетный пересчет ({scope}): обновлено юзеров {updated}, прокручено дней {days}.")
+    return results
+
+
+# --- ПАРАЛЛЕЛЬНЫЙ ПЕРЕСЧЕТ ПО ШАРДАМ ---
+# Когда юзеров сотни тысяч, даже пакетный расчет упирается в одно ядро.
+# Делим юзеров на диапазоны user_id, каждый диапазон считает отдельный процесс
+# со своим соединением на чтение, а пишет результаты один писатель пачками.
+# Считают воркеры той же compute_recalculations с тем же now_utc,
+# так что результат бит в бит совпадает с последовательным.
+RECALC_WORKERS = int(os.getenv("RECALC_WORKERS", str(os.cpu_count() or 1)))
+RECALC_WRITE_BATCH = int(os.getenv("RECALC_WRITE_BATCH", "5000"))
+
+
+def plan_shards(shards: int) -> list[tuple[int, int]]:
+    """
+    Делит активных юзеров на shards диапазонов user_id примерно поровну по числу юзеров.
+    Диапазоны сквозные по всем файлам шардов базы: воркер сам обойдет их все.
+    """
+    user_ids = sorted(user["user_id"] for user in db.get_all_active_users())
+    if not user_ids:
+        return []
+    shards = max(1, min(shards, len(user_ids)))
+    size = -(-len(user_ids) // shards)  # деление с округлением вверх
+    return [
+        (user_ids[start], user_ids[min(start + size, len(user_ids)) - 1])
+        for start in range(0, len(user_ids), size)
+    ]
+
+
+def _compute_shard(db_name: str, db_shards: int, now_utc: datetime, user_range: tuple[int, int]) -> list[RecalcResult]:
+    """Точка входа воркера: открывает свое соединение и считает один шард."""
+    db.DB_NAME, db.DB_SHARDS = db_name, db_shards
+    try:
+        return compute_recalculations(now_utc, user_range=user_range)
+    finally:
+        db.close_db_connections()
+
+
+def run_parallel_recalculations(workers: int | None = None, shards: int | None = None,
+                                now_utc: datetime | None = None, verify: bool = False) -> list[RecalcResult]:
+    """
+    Пересчет, разложенный по процессам. shards по умолчанию - по четыре на воркер,
+    чтобы быстрые шарды не ждали медленных. С verify=True перед записью сверяет
+    результат с последовательным compute_recalculations и падает при расхождении.
+    """
+    workers = workers or RECALC_WORKERS
+    shards = shards or workers * 4
+    now_utc = now_utc or datetime.now(_UTC)
+    plan = plan_shards(shards)
+    started = time.monotonic()
+
+    results: list[RecalcResult] = []
+    pending: list[RecalcResult] = []
+    updated = 0
+    # spawn, а не fork: дочерний процесс не должен наследовать открытые соединения SQLite
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(_compute_shard, db.DB_NAME, db.DB_SHARDS, now_utc, user_range) for user_range in plan]
+        for done, future in enumerate(as_completed(futures), start=1):
+            shard_results = future.result()
+            results.extend(shard_results)
+            pending.extend(shard_results)
+            # Пишем только из главного процесса и пачками, чтобы не держать блокировку долго
+            if not verify and len(pending) >= RECALC_WRITE_BATCH:
+                updated += apply_recalculations(pending)
+                pending = []
+            elapsed = time.monotonic() - started
+            logger.info(
+                f"  - Шардов готово {done}/{len(plan)}, посчитано юзеров {len(results)}, "
+                f"{len(results) / elapsed if elapsed else 0:.0f} юзеров/сек"
+            )
+
+    if verify:
+        serial = sorted(compute_recalculations(now_utc), key=lambda r: r.user_id)
+        if sorted(results, key=lambda r: r.user_id) != serial:
+            raise RuntimeError("Параллельный пересчет разошелся с последовательным, ничего не записано.")
+        logger.info("Сверка с последовательным пересчетом: результаты совпадают.")
+        pending = results
+
+    updated += apply_recalculations(pending)
+    elapsed = time.monotonic() - started
+    days = caught_up_days(results)
+    observe_recalc("parallel", updated, days, elapsed)
+    logger.info(
+        f"Параллельный пересчет: воркеров {workers}, шардов {len(plan)}, обновлено юзеров {updated}, "
+        f"прокручено дней {days}, за {elapsed:.2f} сек ({len(results) / elapsed if elapsed else 0:.0f} юзеров/сек)."
+    )
+    return results
@@ -0,0 +1,174 @@
+"""
+Офлайн-перекладка базы на другое число шардов (python db_tool.py reshard --shards N).
+
+Бот в это время должен стоять. Исходные файлы не трогаем: они открываются
+только на чтение (mode=ro), поэтому схема в них уже должна быть свежей -
+иначе сначала python db_tool.py migrate со старым DB_SHARDS. Новые шарды
+собираются рядом, в файлы с другим числом шардов в имени (см. db.shard_path),
+так что откатиться - просто вернуть старый DB_SHARDS. Каждый новый шард
+строится своим соединением: к нему по очереди цепляются старые файлы
+(и их архивы), и строки его юзеров переливаются INSERT ... SELECT с фильтром
+по shard_of(user_id), без подъема в питон. Шарды собираются параллельно.
+
+id трат уникальны только внутри файла. При перекладке из одного файла они
+сохраняются, а при слиянии нескольких старых шардов горячие траты получают
+новые id в прежнем порядке (архив ключуется по юзеру, там id не пересекаются).
+Строки, которые после упавшего переноса в архив лежат в обоих местах,
+забираем один раз - из архива.
+"""
+import logging
+import os
+import sqlite3
+from pathlib import Path
+
+from . import db
+from .migrations import run_migrations, get_schema_version, LATEST_VERSION
+
+logger = logging.getLogger(__name__)
+
+# Таблицы, где у каждой строки есть user_id: переезжают в шард своего юзера
+_USER_TABLES = ("users", "daily_spend", "period_rollup")
+# Общее для всего бота - только в шард 0 и только из старого шарда 0
+_GLOBAL_TABLES = ("bot_conversations", "bot_user_data")
+
+
+def _columns(conn: sqlite3.Connection, schema: str, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _count_rows(conn: sqlite3.Connection) -> dict[str, int]:
+    """Сколько строк в таблицах одного файла. Траты - горячие и архивные вместе, без дублей."""
+    counts = {
+        table: conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+        for table in _USER_TABLES + _GLOBAL_TABLES
+    }
+    counts["transactions"] = conn.execute(
+        f"SELECT COUNT(*) FROM ({db.all_transactions(('id',))})"
+    ).fetchone()[0]
+    return counts
+
+
+def _add_counts(totals: dict[str, int], counts: dict[str, int]):
+    for table, count in counts.items():
+        totals[table] = totals.get(table, 0) + count
+
+
+def _read_only(path: str) -> str:
+    """URI файла только на чтение: так в старые файлы не запишет даже случайный запрос."""
+    return f"{Path(path).resolve().as_uri()}?mode=ro"
+
+
+def _prepare_sources(sources: list[str]) -> dict[str, int]:
+    """Проверяет, что у старых файлов и их архивов свежая схема, и считает строки. Сами файлы не меняет."""
+    totals: dict[str, int] = {}
+    for path in sources:
+        conn = sqlite3.connect(_read_only(path), uri=True)
+        try:
+            conn.execute("ATTACH DATABASE ? AS archive", (_read_only(db.archive_path(path)),))
+            version = get_schema_version(conn)
+            has_archive = conn.execute(
+                "SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'archived_transactions'"
+            ).fetchone()
+            if version != LATEST_VERSION:
+                raise RuntimeError(
+                    f"{path}: схема версии {version}, а нужна {LATEST_VERSION}. "
+                    f"Сначала python db_tool.py migrate со старым DB_SHARDS."
+                )
+            if not has_archive:
+                raise RuntimeError(f"{db.archive_path(path)}: в архиве нет таблицы трат. Сначала python db_tool.py migrate.")
+            _add_counts(totals, _count_rows(conn))
+        finally:
+            conn.close()
+    return totals
+
+
+def _build_shard(shard: int, shards: int, sources: list[str]) -> dict[str, int]:
+    """Собирает новый шард shard из всех старых файлов. Возвращает, сколько строк в нем оказалось."""
+    path = db.shard_path(shard, shards)
+    conn = db._open_connection(path)
+    try:
+        run_migrations(conn, path)
+        conn.create_function("shard_of", 1, lambda user_id: db.shard_of(user_id, shards), deterministic=True)
+        keep_ids = len(sources) == 1
+        for index, source in enumerate(sources):
+            # ATTACH внутри транзакции нельзя, так что цепляем до BEGIN
+            conn.execute("ATTACH DATABASE ? AS src", (_read_only(source),))
+            conn.execute("ATTACH DATABASE ? AS src_archive", (_read_only(db.archive_path(source)),))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for table in _USER_TABLES:
+                    columns = ", ".join(_columns(conn, "main", table))
+                    conn.execute(
+                        f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} "
+                        f"WHERE shard_of(user_id) = ?",
+                        (shard,)
+                    )
+                columns = [c for c in _columns(conn, "main", "transactions") if keep_ids or c != "id"]
+                conn.execute(
+                    f"""
+                    INSERT INTO main.transactions ({", ".join(columns)})
+                    SELECT {", ".join(f"t.{c}" for c in columns)} FROM src.transactions t
+                    WHERE shard_of(t.user_id) = ? AND NOT EXISTS (
+                        SELECT 1 FROM src_archive.archived_transactions a
+                        WHERE a.id = t.id AND a.user_id = t.user_id AND a.created_at_epoch = t.created_at_epoch
+                    )
+                    ORDER BY t.id
+                    """,
+                    (shard,)
+                )
+                columns = ", ".join(_columns(conn, "archive", "archived_transactions"))
+                conn.execute(
+                    f"INSERT INTO archive.archived_transactions ({columns}) "
+                    f"SELECT {columns} FROM src_archive.archived_transactions WHERE shard_of(user_id) = ?",
+                    (shard,)
+                )
+                if shard == 0 and index == 0:
+                    for table in _GLOBAL_TABLES:
+                        columns = ", ".join(_columns(conn, "main", table))
+                        conn.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table}")
+                conn.commit()
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute("DETACH DATABASE src")
+                conn.execute("DETACH DATABASE src_archive")
+        return _count_rows(conn)
+    finally:
+        conn.close()
+
+
+def reshard(shards: int, source_shards: int | None = None) -> dict[str, int]:
+    """
+    Раскладывает базу из source_shards файлов (по умолчанию текущий DB_SHARDS) по shards новым.
+    Сверяет число строк по таблицам и возвращает его. Уже существующие файлы нового
+    расклада не перезаписывает - падает.
+    """
+    source_shards = source_shards or db.DB_SHARDS
+    if shards < 1:
+        raise ValueError("Шардов должно быть хотя бы 1.")
+    if shards == source_shards:
+        raise ValueError(f"База уже разложена на {shards}.")
+    sources = [db.shard_path(shard, source_shards) for shard in range(source_shards)]
+    targets = [db.shard_path(shard, shards) for shard in range(shards)]
+    missing = [path for source in sources for path in (source, db.archive_path(source)) if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Нет файлов старых шардов или их архивов: {', '.join(missing)}")
+    existing = [path for target in targets for path in (target, db.archive_path(target)) if os.path.exists(path)]
+    if existing:
+        raise FileExistsError(f"Файлы нового расклада уже есть, удалите их сами: {', '.join(existing)}")
+
+    # Свои соединения бота со старыми файлами закрываем: дальше работаем только отдельными
+    db.close_db_connections()
+    expected = _prepare_sources(sources)
+    logger.info(f"Перекладка {source_shards} -> {shards} шардов, строк в старых файлах: {expected}")
+
+    actual: dict[str, int] = {}
+    for counts in db.for_each_shard(lambda shard: _build_shard(shard, shards, sources), range(shards)):
+        _add_counts(actual, counts)
+    if actual != expected:
+        raise RuntimeError(
+            f"После перекладки не сошлось число строк: было {expected}, стало {actual}. "
+            f"Новые файлы ({', '.join(targets)}) надо удалить, старые не тронуты."
+        )
+    logger.info(f"Перекладка готова, все строки на месте: {', '.join(targets)}")
+    return actual
@@ -0,0 +1,126 @@
+"""
+Планировщик ночного пересчета внутри процесса бота.
+
+Раньше пересчет жил в отдельном cron-контейнере: каждый час новый процесс
+Python, импорт всего подряд и проход по всем юзерам, из которых почти никому
+еще не пора. Теперь бот сам знает, в каких таймзонах живут его юзеры, спит
+до ближайшей локальной полуночи и пересчитывает ровно одну таймзону.
+При старте догоняет все, что пропустил, пока лежал.
+
+После пересчета таймзоны тем, кто подписан (/summary), уходит сводка за
+прошедший день - одной пачкой на таймзону через bot/outbound.py.
+"""
+import asyncio
+import logging
+import os
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+from . import tzcalendar
+from .async_db import get_active_timezones, run_in_db
+from .logic import build_day_summaries
+from .outbound import OutboundMessage, OutboundSender
+from .recalc import RecalcResult, run_bulk_recalculations
+
+logger = logging.getLogger(__name__)
+
+_UTC = ZoneInfo("UTC")
+
+# Дольше этого не спим, даже если до ближайшей полуночи далеко:
+# за это время могла появиться новая таймзона или съехать системное время.
+SCHEDULER_MAX_SLEEP_SEC = float(os.getenv("SCHEDULER_MAX_SLEEP_SEC", "900"))
+
+
+class RecalcScheduler:
+    """Пересчитывает балансы группами по таймзонам ровно в их локальную полночь."""
+
+    def __init__(self, outbound: OutboundSender | None = None):
+        self._task: asyncio.Task | None = None
+        # Локальная дата, на которую таймзона уже пересчитана
+        self._done: dict[str, date] = {}
+        # Куда отдавать сводки после пересчета. None - не слать
+        self.outbound = outbound
+
+    def start(self):
+        """Запускает фоновую задачу в текущем event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="recalc-scheduler")
+
+    async def stop(self):
+        """Останавливает задачу. Пересчет, который уже идет в пуле базы, доработает сам."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def catch_up(self):
+        """Пересчитывает всех, у кого наступил новый день, пока бот не работал."""
+        results = await run_in_db(run_bulk_recalculations)
+        await self._push_summaries("догоняющий пересчет", results)
+        now_utc = datetime.now(_UTC)
+        for timezone in await get_active_timezones():
+            if tzcalendar.is_valid(timezone):
+                self._done[timezone] = tzcalendar.today(timezone, now_utc)
+
+    async def run_due(self) -> list[str]:
+        """Пересчитывает таймзоны, у которых сменилась дата с прошлого прохода. Возвращает их список."""
+        now_utc = datetime.now(_UTC)
+        processed = []
+        for timezone in await get_active_timezones():
+            if not tzcalendar.is_valid(timezone):
+                continue
+            today = tzcalendar.today(timezone, now_utc)
+            if self._done.get(timezone) == today:
+                continue
+            results = await run_in_db(run_bulk_recalculations, now_utc, timezone=timezone)
+            self._done[timezone] = today
+            processed.append(timezone)
+            await self._push_summaries(timezone, results)
+        return processed
+
+    async def _push_summaries(self, name: str, results: list[RecalcResult]):
+        """Отдает сводки подписчиков из results в рассылку и не ждет, пока они уйдут."""
+        if self.outbound is None or not results:
+            return
+        try:
+            # Выборка подписчиков и тексты на 100k юзеров - не для event loop'а
+            summaries = await run_in_db(build_day_summaries, results)
+            self.outbound.submit_batch(name, [OutboundMessage(chat_id, text) for chat_id, text in summaries])
+        except Exception:
+            # Пересчет уже записан, из-за сводок его не повторяем
+            logger.exception(f"Не удалось собрать сводки после пересчета ({name}).")
+
+    async def _seconds_until_next_midnight(self) -> float:
+        now_utc = datetime.now(_UTC)
+        midnights = [
+            tzcalendar.next_midnight(timezone, now_utc)
+            for timezone in await get_active_timezones()
+            if tzcalendar.is_valid(timezone)
+        ]
+        if not midnights:
+            return SCHEDULER_MAX_SLEEP_SEC
+        # Секунда запаса: таймер может сработать чуть раньше, а дата должна успеть смениться
+        delay = (min(midnights) - now_utc).total_seconds() + 1.0
+        return min(max(delay, 0.0), SCHEDULER_MAX_SLEEP_SEC)
+
+    async def _run(self):
+        try:
+            await self.catch_up()
+        except Exception:
+            logger.exception("Догоняющий пересчет при старте упал, попробуем по расписанию.")
+
+        while True:
+            delay = await self._seconds_until_next_midnight()
+            logger.debug(f"Планировщик пересчета спит {delay:.0f} сек.")
+            await asyncio.sleep(delay)
+            try:
+                processed = await self.run_due()
+                if processed:
+                    logger.info(f"Полночь наступила для таймзон: {', '.join(processed)}")
+            except Exception:
+                # Не даем планировщику умереть из-за одного неудачного прохода
+                logger.exception("Пересчет по расписанию упал, повторим на следующем проходе.")
+                await asyncio.sleep(60)
@@ -0,0 +1,237 @@
+"""
+Как бот получает апдейты: конкурентная обработка и режим вебхука.
+
+По умолчанию python-telegram-bot обрабатывает апдейты строго по одному,
+и один медленный юзер тормозит всех. PerChatUpdateProcessor пускает
+апдейты параллельно, но внутри одного чата сохраняет порядок (иначе
+диалог регистрации развалится). Очередь на чат ограничена, и ждущие в ней
+общих слотов не занимают.
+
+Вебхук - свой маленький HTTP-сервер на asyncio, без tornado. Он принимает
+POST с JSON апдейта и кладет его в application.update_queue. Поэтому режим
+можно гонять офлайн: поднять бота с WEBHOOK_URL пустым и постить в него
+записанные апдейты (см. replay_updates.py).
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+from http import HTTPStatus
+
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Сколько апдейтов одного чата может ждать своей очереди. Остальные выкидываем.
+UPDATES_MAX_PENDING_PER_CHAT = int(os.getenv("UPDATES_MAX_PENDING_PER_CHAT", "16"))
+# Сколько ждем недообработанные апдейты при остановке.
+UPDATES_DRAIN_TIMEOUT_SEC = float(os.getenv("UPDATES_DRAIN_TIMEOUT_SEC", "30"))
+
+# Максимальный размер тела запроса вебхука. Апдейты Телеграма сильно меньше.
+_MAX_BODY = 1024 * 1024
+
+
+def _chat_key(update: object):
+    """По какому ключу упорядочиваем апдейт: чат, а если его нет - юзер."""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    return None
+
+
+class _ChatSlot:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов с порядком внутри чата.
+    Всего одновременно - не больше max_concurrent_updates, на один чат
+    в очереди - не больше max_pending_per_chat.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_per_chat: int = UPDATES_MAX_PENDING_PER_CHAT):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_per_chat = max_pending_per_chat
+        self._chats: dict[int, _ChatSlot] = {}
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.dropped = 0
+
+    async def process_update(self, update, coroutine) -> None:
+        """
+        В базовом классе апдейт сначала берет общий слот, а потом уже ждет свой чат. Тогда чат,
+        заваливший нас апдейтами, держит слотами все, что ждет его же блокировки, и остальные чаты
+        стоят. Поэтому порядок обратный: сначала очередь своего чата, и только первый в ней
+        занимает слот из max_concurrent_updates.
+        """
+        key = _chat_key(update)
+        slot = None
+        if key is not None:
+            slot = self._chats.get(key)
+            if slot is None:
+                slot = self._chats[key] = _ChatSlot()
+            if slot.pending >= self.max_pending_per_chat:
+                self.dropped += 1
+                logger.warning(f"Чат {key} завалил нас апдейтами, лишний выкидываем.")
+                if asyncio.iscoroutine(coroutine):
+                    coroutine.close()
+                return
+            slot.pending += 1
+
+        self._active += 1
+        self._idle.clear()
+        try:
+            if slot is None:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+            else:
+                async with slot.lock, self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            self._active -= 1
+            if self._active == 0:
+                self._idle.set()
+            if slot is not None:
+                slot.pending -= 1
+                if slot.pending == 0:
+                    self._chats.pop(key, None)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        """Дожидается недообработанных апдейтов, но не дольше UPDATES_DRAIN_TIMEOUT_SEC."""
+        if self._active:
+            logger.info(f"Дожидаемся {self._active} апдейтов в обработке...")
+            try:
+                await asyncio.wait_for(self._idle.wait(), UPDATES_DRAIN_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не дождались {self._active} апдейтов, выходим как есть.")
+
+
+class WebhookServer:
+    """Минимальный HTTP-сервер: POST {path} с JSON апдейта -> application.update_queue."""
+
+    def __init__(self, application: Application, listen: str, port: int, path: str, secret_token: str | None):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path if path.startswith("/") else f"/{path}"
+        self.secret_token = secret_token
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logger.info(f"Вебхук слушает http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        """Перестает принимать новые соединения."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Держим keep-alive: Телеграм шлет апдейты по одному соединению
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, *_rest = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > _MAX_BODY:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status = await self._handle_request(method, target, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method: str, target: str, headers: dict, body: bytes) -> HTTPStatus:
+        if target.split("?", 1)[0] != self.path:
+            return HTTPStatus.NOT_FOUND
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED
+        if self.secret_token and headers.get("x-telegram-bot-api-secret-token") != self.secret_token:
+            return HTTPStatus.FORBIDDEN
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Вебхук получил кривой JSON, пропускаем.")
+            return HTTPStatus.BAD_REQUEST
+        await self.application.update_queue.put(update)
+        return HTTPStatus.OK
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: HTTPStatus, keep_alive: bool = False):
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+
+
+async def run_webhook(application: Application, listen: str, port: int, path: str,
+                      secret_token: str | None = None, webhook_url: str | None = None):
+    """
+    Запускает бота в режиме вебхука и работает до SIGINT/SIGTERM.
+    Если webhook_url не задан, в Телеграм ничего не регистрируем - удобно для офлайн-проверки.
+    При остановке сначала перестаем принимать апдейты, потом дорабатываем уже принятые.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    server = WebhookServer(application, listen, port, path, secret_token)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Вебхук зарегистрирован в Телеграме: {webhook_url}")
+        await application.start()
+        await stop_event.wait()
+    finally:
+        logger.info("Останавливаем вебхук...")
+        await server.stop()
+        if application.running:
+            # Дорабатывает очередь апдейтов и все задачи обработки
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
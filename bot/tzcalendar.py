@@ -0,0 +1,130 @@
+"""
+Календарь по таймзонам: ZoneInfo и границы локальных дней в UTC.
+
+Раньше get_spent_today, create_user, /settings, пересчет и прочие каждый раз
+сами строили ZoneInfo и переводили локальную полночь в UTC - на каждого
+юзера на каждый вызов. А у всех юзеров из Asia/Omsk границы дней одни и те же.
+Тут это считается один раз на (таймзона, дата) и дальше берется из словаря.
+
+Границы дня - это две локальные полуночи (сегодняшняя и завтрашняя), а не
+полночь плюс 24 часа, так что дни перехода на летнее/зимнее время честно
+длятся 23 или 25 часов. Если полночь попадает в дыру перевода часов, день
+начинается в момент перевода (fold=0 берет смещение до перевода).
+"""
+import functools
+import os
+import time as time_module
+from datetime import date, datetime, time, timedelta
+from typing import NamedTuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+
+# Кривую таймзону считаем московской, как и везде в боте
+DEFAULT_TIMEZONE = "Europe/Moscow"
+# Сколько окон (таймзона, дата) держим в памяти. Активных таймзон сотни, дней нужно два-три.
+DAY_WINDOW_CACHE_SIZE = int(os.getenv("DAY_WINDOW_CACHE_SIZE", "4096"))
+
+_UTC = ZoneInfo("UTC")
+_EPOCH = datetime(1970, 1, 1, tzinfo=_UTC)
+
+
+class DayWindow(NamedTuple):
+    """Локальный день таймзоны как полуинтервал [start, end) в UTC - во всех нужных базе видах."""
+    timezone: str
+    local_date: date
+    start: datetime
+    end: datetime
+    start_iso: str
+    end_iso: str
+    start_ms: int
+    end_ms: int
+
+
+def _epoch_ms(moment: datetime) -> int:
+    return (moment - _EPOCH) // timedelta(milliseconds=1)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_zone(timezone: str) -> ZoneInfo | None:
+    try:
+        return ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def is_valid(timezone: str) -> bool:
+    """Есть ли такая таймзона."""
+    return _load_zone(timezone) is not None
+
+
+def zone(timezone: str) -> ZoneInfo:
+    """ZoneInfo для таймзоны, кривая - московская."""
+    return _load_zone(timezone) or _load_zone(DEFAULT_TIMEZONE)
+
+
+@functools.lru_cache(maxsize=DAY_WINDOW_CACHE_SIZE)
+def day_window(timezone: str, local_date: date) -> DayWindow:
+    """Границы локального дня local_date в таймзоне."""
+    tz = zone(timezone)
+    start = datetime.combine(local_date, time.min, tzinfo=tz).astimezone(_UTC)
+    end = datetime.combine(local_date + timedelta(days=1), time.min, tzinfo=tz).astimezone(_UTC)
+    return DayWindow(timezone, local_date, start, end, start.isoformat(), end.isoformat(),
+                     _epoch_ms(start), _epoch_ms(end))
+
+
+# Текущий день по таймзонам: пока момент внутри окна, "сегодня" - одна проверка без astimezone.
+# Только настоящий сегодняшний день: окно чужого момента сюда не кладем, иначе следующий today()
+# промахнется и будет заново считать день, который только что знал
+_current: dict[str, DayWindow] = {}
+
+
+def today_window(timezone: str, now_utc: datetime | None = None) -> DayWindow:
+    """Окно сегодняшнего (на момент now_utc) локального дня таймзоны."""
+    # Сравниваем в float-миллисекундах: границы дней - целые секунды, а timestamp() и time.time()
+    # в разы дешевле вычитания datetime
+    now_ms = (time_module.time() if now_utc is None else now_utc.timestamp()) * 1000
+    window = _current.get(timezone)
+    if window is not None and window.start_ms <= now_ms < window.end_ms:
+        return window
+    # День сменился (или спросили про другой момент) - берем окно из кэша дней
+    asked_now = now_utc is None
+    now_utc = now_utc or datetime.now(_UTC)
+    window = day_window(timezone, now_utc.astimezone(zone(timezone)).date())
+    # Запоминаем, только если это и правда сегодня
+    if asked_now or window.start_ms <= time_module.time() * 1000 < window.end_ms:
+        _current[timezone] = window
+    return window
+
+
+def today(timezone: str, now_utc: datetime | None = None) -> date:
+    """Сегодняшняя локальная дата таймзоны."""
+    return today_window(timezone, now_utc).local_date
+
+
+def local_date_at(timezone: str, moment: datetime) -> date:
+    """Локальная дата таймзоны в момент moment. Для моментов из текущего дня - без astimezone."""
+    window = today_window(timezone)
+    if window.start_ms <= moment.timestamp() * 1000 < window.end_ms:
+        return window.local_date
+    # Момент из другого дня (старая трата из CSV, архив) - в лоб и мимо кэшей:
+    # история не должна вытеснять окна, по которым живет горячий путь
+    return moment.astimezone(zone(timezone)).date()
+
+
+def local_date_at_ms(timezone: str, epoch_ms: int) -> date:
+    """То же, что local_date_at, для момента в миллисекундах от эпохи (created_at_epoch в базе)."""
+    window = today_window(timezone)
+    if window.start_ms <= epoch_ms < window.end_ms:
+        return window.local_date
+    return (_EPOCH + timedelta(milliseconds=epoch_ms)).astimezone(zone(timezone)).date()
+
+
+def next_midnight(timezone: str, now_utc: datetime | None = None) -> datetime:
+    """Ближайшая локальная полночь таймзоны в UTC."""
+    return today_window(timezone, now_utc).end
+
+
+def cache_info() -> dict:
+    """Сколько окон посчитано и сколько раз взято из кэша."""
+    info = day_window.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "zones": _load_zone.cache_info().currsize}
@@ -0,0 +1,171 @@
+"""
+Групповой коммит для входящих трат.
+
+Каждая трата - отдельный INSERT и отдельный коммит. Когда в обед все разом
+вбивают чеки, упираемся не в SQL, а в число коммитов в секунду. Поэтому
+траты, пришедшие почти одновременно, копятся в очереди несколько миллисекунд
+и уходят в базу одним executemany и одним коммитом.
+
+Хендлер все равно ждет, пока ЕГО строка окажется в базе, и только потом
+отвечает статусом, так что для юзера ничего не меняется.
+
+Чужие ошибки юзеру не прилетают. Суммы проверяем еще до очереди, с шардами пачка
+пишется отдельным коммитом в каждый файл и каждый хендлер ждет только коммита своего
+шарда, а если коммит пачки все-таки упал - ее траты переписываются по одной,
+и ошибку получает только тот, чья запись не прошла и в одиночку.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from .async_db import add_transactions
+from .db import shard_of
+from . import money
+
+logger = logging.getLogger(__name__)
+
+_UTC = ZoneInfo("UTC")
+
+# Сколько ждем соседей по пачке после первой траты и сколько максимум кладем в одну пачку.
+WRITE_QUEUE_WINDOW_MS = float(os.getenv("WRITE_QUEUE_WINDOW_MS", "5"))
+WRITE_QUEUE_MAX_BATCH = int(os.getenv("WRITE_QUEUE_MAX_BATCH", "100"))
+
+_STOP = object()
+
+
+class TransactionWriteQueue:
+    """Очередь с отложенной записью: копит траты в окне и пишет их одним коммитом."""
+
+    def __init__(self, window_ms: float = WRITE_QUEUE_WINDOW_MS, max_batch: int = WRITE_QUEUE_MAX_BATCH):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self.batches = 0
+        self.rows = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        """Запускает писателя в текущем event loop."""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run(), name="transaction-writer")
+
+    async def stop(self):
+        """Дописывает все, что уже в очереди, и останавливает писателя."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        await self._queue.put(_STOP)
+        await task
+        logger.info(f"Очередь трат остановлена: пачек {self.batches}, строк {self.rows}.")
+
+    async def submit(self, user_id: int, amount: int, author_id: int | None = None):
+        """Ставит трату (в копейках) в очередь и ждет, пока пачка с ней закоммитится."""
+        await self.submit_many(user_id, [amount], author_id)
+
+    async def submit_many(self, user_id: int, amounts: list[int], author_id: int | None = None):
+        """
+        Ставит несколько трат одного бюджета в очередь одним куском и ждет коммита.
+        Кусок не разрывается между пачками, так что траты пишутся все вместе или никак.
+        author_id - кто из участников общего бюджета потратил (None - сам владелец).
+        Кривые суммы - ValueError сразу, до очереди: в пачке они уронили бы коммит соседям.
+        """
+        if not amounts or any(not 0 < amount <= money.MAX_AMOUNT for amount in amounts):
+            raise ValueError(f"суммы вне диапазона: {amounts!r}")
+        now = datetime.now(_UTC)
+        # Разносим траты на миллисекунду, чтобы у каждой было свое время (и порядок как в сообщении)
+        entries = [(user_id, amount, now + timedelta(milliseconds=i), author_id) for i, amount in enumerate(amounts)]
+        if self._task is None:
+            # Очередь не запущена (или уже остановлена) - пишем сами, без группировки
+            await add_transactions(entries)
+            return
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((entries, future))
+        await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            rows = len(item[0])
+            deadline = loop.time() + self.window
+            while rows < self.max_batch:
+                # Сначала забираем все, что уже лежит, и только потом ждем
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        # Один бюджет - один шард, так что кусок submit_many целиком лежит в одном файле
+        by_shard: dict[int, list] = {}
+        for item in batch:
+            by_shard.setdefault(shard_of(item[0][0][0]), []).append(item)
+        # У каждого шарда свой коммит: упавший файл не трогает тех, кто уже записан в соседний
+        await asyncio.gather(*(self._flush_shard(items) for items in by_shard.values()))
+
+    async def _flush_shard(self, batch):
+        entries = [entry for item_entries, _future in batch for entry in item_entries]
+        try:
+            await add_transactions(entries)
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(batch[0], e)
+                return
+            logger.warning(f"Не удалось записать пачку из {len(entries)} трат ({e}), пишем их по одной")
+            for item in batch:
+                await self._write_alone(item)
+            return
+        self.batches += 1
+        self.rows += len(entries)
+        logger.debug(f"Групповой коммит: {len(entries)} трат одной транзакцией")
+        for _entries, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def _write_alone(self, item):
+        """Пишет кусок одного хендлера отдельным коммитом - после того, как упала вся пачка."""
+        item_entries, future = item
+        try:
+            await add_transactions(item_entries)
+        except Exception as e:
+            self._fail(item, e)
+            return
+        self.batches += 1
+        self.rows += len(item_entries)
+        if not future.done():
+            future.set_result(None)
+
+    @staticmethod
+    def _fail(item, error: Exception):
+        item_entries, future = item
+        logger.error(f"Не удалось записать {len(item_entries)} трат бюджета {item_entries[0][0]}: {error}",
+                     exc_info=error)
+        if not future.done():
+            future.set_exception(error)
+
+
+# Одна очередь на процесс бота. Запускается и останавливается в main.py.
+transaction_queue = TransactionWriteQueue()
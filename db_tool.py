@@ -0,0 +1,103 @@
+"""
+Служебные команды для обслуживания базы. Запускать руками, когда бот работает или нет - не важно,
+кроме отмеченных ниже.
+
+    python db_tool.py migrate                  # накатить недостающие миграции (только при остановленном боте!)
+    python db_tool.py rebuild-daily-spend      # пересобрать дневные сводки из сырых транзакций
+    python db_tool.py rebuild-daily-spend --check   # только сверить, ничего не трогая
+    python db_tool.py archive                  # перенести старые траты в архив (ARCHIVE_AFTER_DAYS)
+    python db_tool.py archive --stats          # только показать, сколько где лежит
+    python db_tool.py vacuum                   # перевести базу на auto_vacuum=INCREMENTAL (один полный VACUUM)
+    python db_tool.py reshard --shards 4       # разложить базу по 4 файлам (только при остановленном боте!)
+"""
+import argparse
+import logging
+import sys
+
+from bot.db import init_db, rebuild_daily_spend, close_db_connections, get_db_connection, all_shards, DB_SHARDS
+from bot.archive import ARCHIVE_AFTER_DAYS, archive_old_transactions, archive_stats
+from bot.reshard import reshard
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def cmd_migrate(_args) -> int:
+    # Отсюда катятся и офлайновые миграции: бот в это время должен стоять
+    init_db(offline=True)
+    return 0
+
+
+def cmd_rebuild_daily_spend(args) -> int:
+    mismatches = rebuild_daily_spend(dry_run=args.check)
+    for user_id, local_date, stored, actual in mismatches[:50]:
+        logger.info(f"  - {user_id} {local_date}: в сводке {stored}, по транзакциям {actual}")
+    if len(mismatches) > 50:
+        logger.info(f"  ... и еще {len(mismatches) - 50}")
+    # При проверке ненулевой код выхода, если сводка разъехалась
+    return 1 if args.check and mismatches else 0
+
+
+def cmd_archive(args) -> int:
+    if not args.stats:
+        archive_old_transactions(after_days=args.days)
+    for name, value in archive_stats().items():
+        logger.info(f"  {name}: {value}")
+    return 0
+
+
+def cmd_vacuum(_args) -> int:
+    # Полный VACUUM переписывает файл целиком и держит блокировку все это время - бота лучше остановить
+    for shard in all_shards():
+        with get_db_connection(shard=shard) as conn:
+            conn.execute("PRAGMA main.auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM main")
+            mode = conn.execute("PRAGMA main.auto_vacuum").fetchone()[0]
+        logger.info(f"VACUUM шарда {shard} готов, auto_vacuum={mode} (2 - INCREMENTAL).")
+    return 0
+
+
+def cmd_reshard(args) -> int:
+    counts = reshard(args.shards, source_shards=args.source_shards)
+    for table, count in counts.items():
+        logger.info(f"  {table}: {count}")
+    logger.info(f"Теперь запускайте бота с DB_SHARDS={args.shards}. Старые файлы не тронуты, их можно удалить потом.")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Обслуживание базы бота")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("migrate", help="накатить миграции (только при остановленном боте!)").set_defaults(
+        func=cmd_migrate)
+
+    rebuild = subparsers.add_parser("rebuild-daily-spend", help="пересобрать daily_spend из transactions")
+    rebuild.add_argument("--check", action="store_true", help="только сверить, ничего не записывать")
+    rebuild.set_defaults(func=cmd_rebuild_daily_spend)
+
+    archive = subparsers.add_parser("archive", help="перенести старые траты в архив")
+    archive.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="старше скольких дней")
+    archive.add_argument("--stats", action="store_true", help="ничего не переносить, только показать размеры")
+    archive.set_defaults(func=cmd_archive)
+
+    subparsers.add_parser("vacuum", help="полный VACUUM с переходом на auto_vacuum=INCREMENTAL").set_defaults(
+        func=cmd_vacuum)
+
+    resharding = subparsers.add_parser("reshard", help="разложить базу по другому числу файлов-шардов")
+    resharding.add_argument("--shards", type=int, required=True, help="сколько шардов сделать")
+    resharding.add_argument("--from", dest="source_shards", type=int, default=DB_SHARDS,
+                            help="на сколько шардов база разложена сейчас (по умолчанию DB_SHARDS)")
+    resharding.set_defaults(func=cmd_reshard)
+
+    args = parser.parse_args()
+    try:
+        return args.func(args)
+    finally:
+        close_db_connections()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,23 @@
+import asyncio
 import os
 import logging
 from dotenv import load_dotenv
 
+# Загружаем .env ДО импорта пакета bot: настройки базы читаются из окружения при импорте.
+load_dotenv()
+
 from telegram.ext import Application
 from bot.handlers import register_handlers
-from bot.db import init_db
+from bot.db import init_db, close_db_connections, get_user_cache_stats
+from bot.async_db import shutdown_executor, set_daily_summary
+from bot.scheduler import RecalcScheduler
+from bot.write_queue import transaction_queue
+from bot.serving import PerChatUpdateProcessor, run_webhook
+from bot.metrics import METRICS_PORT, MetricsServer
+from bot.archive import ArchiveJob
+from bot.persistence import SQLitePersistence
+from bot.outbound import OutboundSender
+from bot.profiling import handler_profiler, loop_monitor
 
 # Включаем логирование, чтобы видеть, что происходит и где что отвалилось.
 # Без логов ты как слепой котенок в машинном отделении.
@@ -13,16 +26,84 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Ночной пересчет теперь крутится прямо в боте. RECALC_SCHEDULER=0 - выключить
+# (например, если пересчет запускается снаружи через recalc_job.py).
+RECALC_SCHEDULER = os.getenv("RECALC_SCHEDULER", "1") == "1"
+# Сводки после пересчета тем, кто подписался через /summary. DAILY_SUMMARIES=0 - не слать никому.
+DAILY_SUMMARIES = os.getenv("DAILY_SUMMARIES", "1") == "1"
+
+
+async def unsubscribe_blocked(chat_id: int) -> None:
+    """Заблокировал бота - больше сводок не шлем, чтобы не тратить на него лимиты."""
+    await set_daily_summary(chat_id, False)
+
+
+outbound_sender = OutboundSender(on_blocked=unsubscribe_blocked)
+recalc_scheduler = RecalcScheduler(outbound=outbound_sender if DAILY_SUMMARIES else None)
+# Prometheus забирает метрики с http://<бот>:METRICS_PORT/metrics. METRICS_PORT=0 - не поднимать.
+metrics_server = MetricsServer() if METRICS_PORT else None
+# Раз в сутки уносит траты старше ARCHIVE_AFTER_DAYS в архив. ARCHIVE_AFTER_DAYS=0 - не уносить.
+archive_job = ArchiveJob()
+
+# Состояния диалогов и user_data в базе, чтобы рестарт не выкидывал юзера посреди регистрации.
+# PERSISTENCE=0 - держать только в памяти, как раньше.
+PERSISTENCE = os.getenv("PERSISTENCE", "1") == "1"
+
+# Как получаем апдейты: polling - сами ходим в Телеграм, webhook - Телеграм стучится к нам.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Сколько апдейтов обрабатываем одновременно (внутри одного чата все равно по порядку).
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Настройки вебхука. WEBHOOK_URL пустой - в Телеграме ничего не регистрируем,
+# просто слушаем порт (так удобно гонять записанные апдейты через replay_updates.py).
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or None
+
+
+async def on_startup(application: Application) -> None:
+    """Запускает фоновые задачи, которым нужен работающий event loop."""
+    transaction_queue.start()
+    outbound_sender.start(application.bot)
+    if metrics_server is not None:
+        await metrics_server.start()
+    if RECALC_SCHEDULER:
+        recalc_scheduler.start()
+        logger.info("Планировщик ночного пересчета запущен.")
+    archive_job.start()
+    # Профилирование: PROFILE_HANDLERS_SAMPLE_RATE и PROFILE_LOOP_LAG_MS, без них оба ничего не делают
+    handler_profiler.start()
+    loop_monitor.start()
+
+
+async def on_shutdown(_application: Application) -> None:
+    """Гасит фоновые задачи, дожидается пула потоков базы и закрывает соединения."""
+    await loop_monitor.stop()
+    await handler_profiler.stop()
+    await recalc_scheduler.stop()
+    await outbound_sender.stop()
+    await archive_job.stop()
+    # Дописываем траты, которые еще сидят в очереди группового коммита
+    await transaction_queue.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    shutdown_executor(wait=True)
+    logger.info(f"Кэш юзеров за время работы: {get_user_cache_stats()}")
+    close_db_connections()
+
+
 def main() -> None:
     """Запускает всю нашу шарманку."""
-    # Загружаем переменные окружения из файла .env
-    # Первым делом, блядь! Чтобы токен был доступен.
-    load_dotenv()
-
     # Инициализируем базу данных. Создаем таблицы, если их нет.
     # Это создаст файл базы данных, если его еще нет, и подготовит структуру
     # Важно вызвать перед стартом бота, чтобы избежать ошибок при первом запуске
-    init_db()
+    try:
+        init_db()
+    except RuntimeError as e:
+        # Офлайновую миграцию на живой базе сами не катим - пусть человек остановит все и накатит руками
+        logger.critical(f"Бот не стартует: {e}")
+        return
 
     TOKEN = os.getenv("BOT_TOKEN")
     if not TOKEN:
@@ -30,15 +111,34 @@ def main() -> None:
         return
 
     # Создаем объект приложения
-    application = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if PERSISTENCE:
+        builder = builder.persistence(SQLitePersistence())
+    application = builder.build()
 
     # Регистрируем все наши хендлеры (обработчики команд)
     # Сама функция будет жить в handlers.py
     register_handlers(application)
 
     # Запускаем бота. Он начинает слушать телегу.
-    logger.info("Бот запущен и готов разъебывать...")
-    application.run_polling()
+    logger.info(f"Бот запущен в режиме {BOT_MODE} и готов разъебывать...")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(
+            application,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=WEBHOOK_URL,
+        ))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
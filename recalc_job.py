@@ -1,87 +1,161 @@
-import logging
-from datetime import datetime, date, timedelta
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-
-# Мы импортируем функции из нашего модуля bot
-from bot.db import get_all_active_users, get_spent_for_period, update_user_balance, get_spent_today
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-
-def run_recalculations():
-    """
-    Главная функция. Проходит по всем пользователям и выполняет пересчет
-    для КАЖДОГО пропущенного дня.
-    """
-    logger.info("Запуск задачи пересчета балансов...")
-    active_users = get_all_active_users()
-
-    for user in active_users:
-        user_id = user["user_id"]
-
-        try:
-            user_tz = ZoneInfo(user["timezone"])
-        except ZoneInfoNotFoundError:
-            logger.warning(f"Неверная таймзона '{user['timezone']}' для пользователя {user_id}. Пропускаем.")
-            continue
-
-        # --- НОВАЯ, НАДЕЖНАЯ ЛОГИКА С ЦИКЛОМ ---
-
-        # Берем дату последнего пересчета из базы
-        last_recalc_date = date.fromisoformat(user["last_recalc_date"])
-        # Определяем сегодняшний день в таймзоне пользователя
-        today_local_date = datetime.now(user_tz).date()
-
-        # Если последний пересчет уже был сегодня, пропускаем
-        if last_recalc_date >= today_local_date:
-            continue
-
-        logger.info(f"Для пользователя {user_id} найдены пропущенные дни. Начинаем пересчет с {last_recalc_date}...")
-
-        # Начинаем цикл с дня, следующего за последним пересчетом
-        day_to_process = last_recalc_date
-        current_balance = user["accumulated_balance"]
-
-        # Цикл работает, пока мы не дойдем до сегодняшнего дня
-        while day_to_process < today_local_date:
-            # Определяем начало и конец дня, который мы обрабатываем
-            start_of_day_local = datetime.combine(day_to_process, datetime.min.time(), tzinfo=user_tz)
-            end_of_day_local = start_of_day_local + timedelta(days=1)
-
-            start_utc = start_of_day_local.astimezone(ZoneInfo("UTC")).isoformat()
-            end_utc = end_of_day_local.astimezone(ZoneInfo("UTC")).isoformat()
-
-            # Считаем траты за этот конкретный день
-            spent_on_day = get_spent_for_period(user_id, start_utc, end_utc)
-
-            # --- ИСПРАВЛЕНИЕ ---
-            # Раньше траты за день не учитывались, если они были сделаны
-            # в тот же день, что и пересчет. Теперь мы добавляем их к балансу.
-            if day_to_process == last_recalc_date:
-                spent_on_day += get_spent_today(user_id)
-
-            base_norm = user["daily_norm"]
-
-            # Вычисляем новый баланс на КОНЕЦ обрабатываемого дня
-            current_balance = (base_norm + current_balance) - spent_on_day
-
-            logger.info(
-                f"  - День {day_to_process}: потрачено {spent_on_day}, "
-                f"новый баланс на конец дня: {current_balance}"
-            )
-
-            # Переходим к следующему дню
-            day_to_process += timedelta(days=1)
-
-        # После того, как все пропущенные дни обработаны,
-        # обновляем баланс в базе и ставим дату последнего пересчета на СЕГОДНЯ.
-        update_user_balance(user_id, current_balance, today_local_date.isoformat())
-
-    logger.info("Задача пересчета балансов завершена.")
-
-
-if __name__ == "__main__":
-    run_recalculations()
\ No newline at end of file
+import argparse
+import logging
+import time
+from datetime import date, timedelta
+
+# Мы импортируем функции из нашего модуля bot
+from bot.db import (
+    get_all_active_users, get_spent_on_day, update_user_balance, get_spent_today, close_db_connections,
+    write_period_boundaries,
+)
+from bot.recalc import compute_recalculations, run_bulk_recalculations, run_parallel_recalculations
+from bot.metrics import observe_recalc
+from bot.periods import boundaries_between
+from bot import tzcalendar
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def _recalc_user_loop(user):
+    """
+    Старый поденный пересчет одного юзера. Ничего не пишет в базу.
+    Возвращает (новый баланс, сегодняшняя дата юзера, [(начало периода, баланс на его утро)])
+    или None, если пересчитывать нечего.
+    """
+    user_id = user["user_id"]
+
+    if not tzcalendar.is_valid(user["timezone"]):
+        logger.warning(f"Неверная таймзона '{user['timezone']}' для пользователя {user_id}. Пропускаем.")
+        return None
+
+    # --- НОВАЯ, НАДЕЖНАЯ ЛОГИКА С ЦИКЛОМ ---
+
+    # Берем дату последнего пересчета из базы
+    last_recalc_date = date.fromisoformat(user["last_recalc_date"])
+    # Определяем сегодняшний день в таймзоне пользователя
+    today_local_date = tzcalendar.today(user["timezone"])
+
+    # Если последний пересчет уже был сегодня, пропускаем
+    if last_recalc_date >= today_local_date:
+        return None
+
+    logger.debug("Для пользователя %s найдены пропущенные дни. Начинаем пересчет с %s...", user_id, last_recalc_date)
+
+    # Начинаем цикл с дня, следующего за последним пересчетом
+    day_to_process = last_recalc_date
+    current_balance = user["accumulated_balance"]
+    period_starts = set(boundaries_between(last_recalc_date, today_local_date, user["reset_day"]))
+    boundaries = []
+
+    # Цикл работает, пока мы не дойдем до сегодняшнего дня
+    while day_to_process < today_local_date:
+        # Берем траты за этот конкретный день из дневной сводки - одна строка по ключу
+        spent_on_day = get_spent_on_day(user_id, day_to_process.isoformat())
+
+        # --- ИСПРАВЛЕНИЕ ---
+        # Раньше траты за день не учитывались, если они были сделаны
+        # в тот же день, что и пересчет. Теперь мы добавляем их к балансу.
+        if day_to_process == last_recalc_date:
+            spent_on_day += get_spent_today(user_id)
+
+        base_norm = user["daily_norm"]
+
+        # Вычисляем новый баланс на КОНЕЦ обрабатываемого дня
+        current_balance = (base_norm + current_balance) - spent_on_day
+
+        logger.debug(
+            "  - День %s: потрачено %s, новый баланс на конец дня: %s",
+            day_to_process, spent_on_day, current_balance
+        )
+
+        # Переходим к следующему дню
+        day_to_process += timedelta(days=1)
+        if day_to_process in period_starts:
+            boundaries.append((day_to_process, current_balance))
+
+    return current_balance, today_local_date, boundaries
+
+
+def run_loop_recalculations():
+    """Старый путь: юзеры по одному, каждый со своим коммитом."""
+    started = time.monotonic()
+    users = days = 0
+    for user in get_all_active_users():
+        result = _recalc_user_loop(user)
+        if result is None:
+            continue
+        # После того, как все пропущенные дни обработаны,
+        # обновляем баланс в базе и ставим дату последнего пересчета на СЕГОДНЯ.
+        current_balance, today_local_date, boundaries = result
+        update_user_balance(user["user_id"], current_balance, today_local_date.isoformat())
+        if boundaries:
+            write_period_boundaries(user["user_id"], user["reset_day"], user["daily_norm"], boundaries)
+        users += 1
+        days += (today_local_date - date.fromisoformat(user["last_recalc_date"])).days
+    observe_recalc("loop", users, days, time.monotonic() - started)
+
+
+def diff_engines() -> list[tuple]:
+    """
+    Прогоняет пакетный движок и старый цикл вхолостую и сравнивает результаты.
+    Возвращает расхождения (user_id, баланс по циклу, баланс по пакету).
+    """
+    bulk = {r.user_id: r for r in compute_recalculations()}
+    mismatches = []
+    for user in get_all_active_users():
+        result = _recalc_user_loop(user)
+        loop_balance = result[0] if result else None
+        bulk_result = bulk.get(user["user_id"])
+        bulk_balance = bulk_result.new_balance if bulk_result else None
+        # Балансы в копейках, так что сверка точная
+        if loop_balance != bulk_balance:
+            mismatches.append((user["user_id"], loop_balance, bulk_balance))
+    return mismatches
+
+
+def run_recalculations(engine: str = "bulk", dry_run: bool = False, workers: int | None = None,
+                       verify: bool = False):
+    """
+    Главная функция. Пересчитывает баланс за КАЖДЫЙ пропущенный день у всех пользователей.
+    engine="bulk" - пакетный движок из bot/recalc.py, engine="loop" - старый поюзерный цикл,
+    engine="parallel" - пакетный движок, разложенный по процессам (workers штук).
+    dry_run=True ничего не пишет, а сверяет пакетный движок со старым циклом.
+    verify=True для parallel сверяет результат с последовательным расчетом перед записью.
+    """
+    logger.info("Запуск задачи пересчета балансов...")
+
+    if dry_run:
+        mismatches = diff_engines()
+        for user_id, loop_balance, bulk_balance in mismatches:
+            logger.warning(f"  - Юзер {user_id}: цикл дает {loop_balance}, пакет дает {bulk_balance}")
+        logger.info(f"Холостой прогон: расхождений между движками {len(mismatches)}.")
+        return mismatches
+
+    if engine == "loop":
+        run_loop_recalculations()
+    elif engine == "parallel":
+        run_parallel_recalculations(workers=workers, verify=verify)
+    else:
+        run_bulk_recalculations()
+
+    logger.info("Задача пересчета балансов завершена.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пересчет накопленных балансов")
+    parser.add_argument("--engine", choices=["bulk", "loop", "parallel"], default="bulk",
+                        help="bulk - пакетный пересчет, loop - старый поюзерный цикл, parallel - пакетный по процессам")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="число процессов для parallel (по умолчанию RECALC_WORKERS или число ядер)")
+    parser.add_argument("--verify", action="store_true",
+                        help="для parallel: перед записью сверить с последовательным расчетом")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="ничего не писать, только сверить пакетный движок со старым циклом")
+    args = parser.parse_args()
+    try:
+        run_recalculations(engine=args.engine, dry_run=args.dry_run, workers=args.workers, verify=args.verify)
+    finally:
+        close_db_connections()
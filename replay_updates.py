@@ -0,0 +1,67 @@
+"""
+Прогоняет записанные апдейты Телеграма через локальный вебхук бота.
+
+Бот поднимаем с BOT_MODE=webhook и пустым WEBHOOK_URL - тогда он просто слушает
+порт и в Телеграме ничего не регистрирует. Дальше:
+
+    python replay_updates.py updates.jsonl --url http://127.0.0.1:8080/telegram
+
+В файле - по одному JSON апдейта на строку (как их отдает getUpdates).
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+
+def read_updates(path: str):
+    """Отдает апдейты из .jsonl по одному, пустые строки пропускает."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def replay(path: str, url: str, secret_token: str | None = None, delay: float = 0.0) -> dict:
+    """Постит апдейты по одному keep-alive соединению. Возвращает счетчики по HTTP-статусам."""
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    headers = {"Content-Type": "application/json"}
+    if secret_token:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret_token
+
+    statuses: dict[int, int] = {}
+    started = time.monotonic()
+    try:
+        for update in read_updates(path):
+            conn.request("POST", parts.path or "/", body=json.dumps(update).encode("utf-8"), headers=headers)
+            response = conn.getresponse()
+            response.read()
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+            if delay:
+                time.sleep(delay)
+    finally:
+        conn.close()
+
+    sent = sum(statuses.values())
+    elapsed = time.monotonic() - started
+    print(f"Отправлено апдейтов: {sent} за {elapsed:.2f} сек, статусы: {statuses}")
+    return statuses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Прогон записанных апдейтов через локальный вебхук")
+    parser.add_argument("path", help="файл .jsonl с апдейтами, по одному на строку")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8080')}"
+                                         f"{os.getenv('WEBHOOK_PATH', '/telegram')}",
+                        help="адрес вебхука бота")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET"),
+                        help="секрет X-Telegram-Bot-Api-Secret-Token (по умолчанию WEBHOOK_SECRET)")
+    parser.add_argument("--delay", type=float, default=0.0, help="пауза между апдейтами, сек")
+    args = parser.parse_args()
+    result = replay(args.path, args.url, args.secret, args.delay)
+    sys.exit(0 if set(result) <= {200} else 1)
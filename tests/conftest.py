@@ -0,0 +1,40 @@
+"""
+Общие фикстуры: каждый тест получает свою пустую базу во временной папке.
+bot/db.py читает DB_NAME при каждом открытии соединения, так что подменить его
+и закрыть уже открытые соединения - достаточно.
+"""
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+from bot import db, tzcalendar
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Пустая база на свежей схеме, без шардов и со своим архивом рядом."""
+    db.close_db_connections()
+    db.clear_user_cache()
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "budget_bot.db"))
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    monkeypatch.setattr(db, "ARCHIVE_DB_NAME", "")
+    db.init_db()
+    yield db
+    db.close_db_connections()
+    db.clear_user_cache()
+
+
+def local_moment(timezone: str, day: date, hour: int = 12) -> datetime:
+    """Момент в UTC: day, hour часов по часам таймзоны."""
+    return datetime.combine(day, time(hour), tzinfo=tzcalendar.zone(timezone)).astimezone(db._UTC)
+
+
+def set_user(user_id: int, **columns):
+    """Правит колонки users в обход логики бота - чтобы поставить юзера в нужное состояние."""
+    assignments = ", ".join(f"{column} = ?" for column in columns)
+    with db._users_write([user_id]) as conn:
+        conn.execute(f"UPDATE users SET {assignments} WHERE user_id = ?", (*columns.values(), user_id))
+
+
+def days_ago(timezone: str, days: int) -> date:
+    return tzcalendar.today(timezone) - timedelta(days=days)
@@ -0,0 +1,112 @@
+"""/edit и /undo (bot/edits.py): правка должна оставить баланс таким, как будто трата сразу была с новой суммой."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from bot import db, edits, money, recalc, tzcalendar
+
+from .conftest import days_ago, local_moment, set_user
+
+USER = 601
+TWIN = 602
+TZ = "Asia/Omsk"
+NORM = money.parse("1000")
+
+
+def _periods(user_id: int) -> list[tuple]:
+    with db.get_db_connection(user_id) as conn:
+        rows = conn.execute(
+            """
+            SELECT period_start, period_end, total, days_over, start_balance, end_balance, finalized
+            FROM period_rollup WHERE user_id = ? ORDER BY period_start
+            """,
+            (user_id,)
+        ).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def _due_user(user_id: int):
+    """Юзер, которого со вчерашнего дня не пересчитывали, и сегодня у него начинается период."""
+    db.create_user(user_id, NORM, TZ)
+    set_user(user_id, last_recalc_date=days_ago(TZ, 1).isoformat(), reset_day=tzcalendar.today(TZ).day)
+
+
+def test_edit_today_after_forced_recalc_matches_spending_new_amount(database):
+    _due_user(USER)
+    _due_user(TWIN)
+    db.add_transaction(USER, 10000)
+    db.add_transaction(TWIN, 30000)
+    [transaction] = edits.recent_transactions(USER)
+
+    # Правка сама пересчитывает юзера, которому пора; двойник пересчитывается уже с новой суммой
+    result = edits.change_transaction(USER, transaction.transaction_id, 30000)
+    with db._users_write([TWIN]) as conn:
+        assert recalc.recalc_user(conn, TWIN) is not None
+
+    assert result.balance_delta == -20000
+    assert db.get_user(USER)["accumulated_balance"] == db.get_user(TWIN)["accumulated_balance"]
+    recalc.run_bulk_recalculations(datetime.now(db._UTC) + timedelta(days=1))
+    assert db.get_user(USER)["accumulated_balance"] == db.get_user(TWIN)["accumulated_balance"]
+    assert _periods(USER) == _periods(TWIN)
+    assert db.get_spent_today(USER) == 30000
+
+
+def test_edit_today_without_recalc_is_left_to_next_recalc(database):
+    db.create_user(USER, NORM, TZ)
+    db.add_transaction(USER, 10000)
+    [transaction] = edits.recent_transactions(USER)
+
+    result = edits.change_transaction(USER, transaction.transaction_id, 25000)
+
+    assert result.balance_delta == 0
+    assert db.get_user(USER)["accumulated_balance"] == 0
+    assert db.get_spent_today(USER) == 25000
+
+
+def test_edit_and_undo_in_recalculated_day(database):
+    db.create_user(USER, NORM, TZ)
+    day = days_ago(TZ, 2)
+    db.add_transactions([(USER, 10000, local_moment(TZ, day), None)])
+    [transaction] = edits.recent_transactions(USER)
+
+    edited = edits.change_transaction(USER, transaction.transaction_id, 15000)
+    undone = edits.change_transaction(USER, transaction.transaction_id, None)
+
+    assert (edited.old_amount, edited.balance_delta) == (10000, -5000)
+    assert (undone.old_amount, undone.new_amount, undone.balance_delta) == (15000, None, 15000)
+    assert db.get_user(USER)["accumulated_balance"] == 10000
+    assert edits.recent_transactions(USER) == []
+    with db.get_db_connection(USER) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM daily_spend WHERE user_id = ?", (USER,)).fetchone()[0] == 0
+
+
+def test_edit_refuses_transactions_outside_recent_list(database, monkeypatch):
+    monkeypatch.setattr(edits, "EDIT_RECENT_LIMIT", 2)
+    db.create_user(USER, NORM, TZ)
+    db.add_transactions([
+        (USER, amount, local_moment(TZ, days_ago(TZ, 1), hour), author)
+        for amount, hour, author in ((100, 9, 1), (200, 10, 1), (300, 11, 2))
+    ])
+    oldest = edits.recent_transactions(USER, limit=3)[-1]
+    neighbour = edits.recent_transactions(USER, author_id=2)[0]
+
+    assert edits.change_transaction(USER, oldest.transaction_id, 500) is None
+    assert edits.change_transaction(USER, neighbour.transaction_id, 500, author_id=1) is None
+    assert edits.change_transaction(USER + 1, oldest.transaction_id, 500) is None
+    assert db.get_spent_on_day(USER, days_ago(TZ, 1).isoformat()) == 600
+
+
+@pytest.mark.parametrize("new_amount", [10000, None])
+def test_edit_keeps_daily_spend_consistent(database, new_amount):
+    db.create_user(USER, NORM, TZ)
+    day = days_ago(TZ, 3)
+    db.add_transactions([(USER, 4000, local_moment(TZ, day, 9), None), (USER, 6000, local_moment(TZ, day, 10), None)])
+    latest = edits.recent_transactions(USER)[0]
+
+    edits.change_transaction(USER, latest.transaction_id, new_amount)
+
+    with db.get_db_connection(USER) as conn:
+        row = conn.execute(
+            "SELECT total, count FROM daily_spend WHERE user_id = ? AND local_date = ?", (USER, day.isoformat())
+        ).fetchone()
+    assert tuple(row) == (4000 + (new_amount or 0), 2 if new_amount else 1)
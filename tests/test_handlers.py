@@ -0,0 +1,39 @@
+"""Шаги диалога /start, которые поднимаются из persistence с уже пустым user_data."""
+import asyncio
+from types import SimpleNamespace
+
+from bot import db, handlers
+
+
+def _timezone_click(user_data: dict) -> tuple:
+    answers = []
+
+    async def edit_message_text(text=None, **kwargs):
+        answers.append(text)
+
+    async def answer():
+        pass
+
+    query = SimpleNamespace(data="tz:Asia/Omsk", answer=answer, edit_message_text=edit_message_text)
+    update = SimpleNamespace(
+        callback_query=query,
+        effective_user=SimpleNamespace(id=777),
+        effective_chat=SimpleNamespace(id=777, type="private"),
+    )
+    state = asyncio.run(handlers.get_timezone(update, SimpleNamespace(user_data=user_data)))
+    return state, answers
+
+
+def test_get_timezone_asks_norm_again_when_user_data_is_empty(database):
+    state, answers = _timezone_click({})
+
+    assert state == handlers.GET_NORM
+    assert "Норму я уже забыл" in answers[0]
+    assert db.get_user(777) is None
+
+
+def test_get_timezone_accepts_legacy_float_norm(database):
+    state, _ = _timezone_click({"daily_norm": 500.5})
+
+    assert state == handlers.ConversationHandler.END
+    assert db.get_user(777)["daily_norm"] == 50050
@@ -0,0 +1,77 @@
+"""Загрузка CSV (bot/history.py): дубли и поправка баланса за уже пересчитанные дни."""
+import io
+
+from bot import db, history, migrations, money
+
+from .conftest import days_ago, local_moment, set_user
+
+USER = 501
+TZ = "Asia/Omsk"
+NORM = money.parse("1000")
+
+
+def _csv(*rows: tuple) -> io.BytesIO:
+    lines = ["created_at_utc,amount"]
+    lines.extend(f"{moment.isoformat()},{amount}" for moment, amount in rows)
+    return io.BytesIO("\n".join(lines).encode())
+
+
+def _balance() -> int:
+    return db.get_user(USER)["accumulated_balance"]
+
+
+def test_import_skips_duplicates_in_file_and_in_database(database):
+    db.create_user(USER, NORM, TZ)
+    moment = local_moment(TZ, days_ago(TZ, 1))
+    source = _csv((moment, "150.00"), (moment, "150"), (moment, "99.90"))
+
+    first = history.import_transactions_csv(USER, source)
+    source.seek(0)
+    second = history.import_transactions_csv(USER, source)
+
+    assert (first.imported, first.duplicates) == (2, 1)
+    assert (second.imported, second.duplicates) == (0, 3)
+    assert db.get_spent_on_day(USER, days_ago(TZ, 1).isoformat()) == 24990
+
+
+def test_import_corrects_balance_only_for_recalculated_days_since_registration(database):
+    db.create_user(USER, NORM, TZ)
+    set_user(USER, balance_since=days_ago(TZ, 5).isoformat())
+
+    result = history.import_transactions_csv(USER, _csv(
+        (local_moment(TZ, days_ago(TZ, 30)), "500"),  # до регистрации - только история
+        (local_moment(TZ, days_ago(TZ, 2)), "120.50"),  # уже в балансе - поправка
+        (local_moment(TZ, days_ago(TZ, 0), 1), "70"),  # сегодня - подхватит пересчет
+    ))
+
+    assert result.imported == 3
+    assert result.before_balance == 1
+    assert result.balance_delta == -12050
+    assert _balance() == -12050
+    assert db.get_spent_on_day(USER, days_ago(TZ, 30).isoformat()) == 50000
+
+
+def test_legacy_user_without_period_rows_gets_balance_since_from_first_spend(database):
+    """Юзер старше period_rollup: строк периодов нет, дату начала баланса проставляет миграция 13."""
+    db.create_user(USER, NORM, TZ)
+    first_day = days_ago(TZ, 40)
+    db.add_transactions([(USER, 300, local_moment(TZ, first_day), None)])
+    with db._users_write([USER]) as conn:
+        conn.execute("DELETE FROM period_rollup WHERE user_id = ?", (USER,))
+        conn.execute("UPDATE users SET balance_since = NULL WHERE user_id = ?", (USER,))
+        migrations._m013_balance_since(conn)
+    assert db.get_user(USER)["balance_since"] == first_day.isoformat()
+
+    result = history.import_transactions_csv(USER, _csv((local_moment(TZ, days_ago(TZ, 10)), "25")))
+
+    assert (result.before_balance, result.balance_delta) == (0, -2500)
+    assert _balance() == -2500
+
+
+def test_unknown_balance_start_counts_every_recalculated_day(database):
+    db.create_user(USER, NORM, TZ)
+    set_user(USER, balance_since=None)
+
+    result = history.import_transactions_csv(USER, _csv((local_moment(TZ, days_ago(TZ, 400)), "10")))
+
+    assert (result.before_balance, result.balance_delta) == (0, -1000)
@@ -0,0 +1,110 @@
+"""Миграция 12 (рубли REAL -> целые копейки в STRICT-таблицах) на базе, живущей на версии 11."""
+import sqlite3
+
+import pytest
+
+from bot import db, migrations
+
+
+def _legacy_database(path: str):
+    """Файл на схеме версии 11: суммы в рублях во float, архив тоже старый."""
+    conn = sqlite3.connect(path)
+    conn.execute("ATTACH DATABASE ? AS archive", (db.archive_path(path),))
+    conn.execute("""
+        CREATE TABLE archive.archived_transactions (
+            user_id INTEGER NOT NULL,
+            created_at_epoch INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            author_id INTEGER,
+            PRIMARY KEY (user_id, created_at_epoch, id)
+        ) WITHOUT ROWID
+    """)
+    for migration in migrations.MIGRATIONS:
+        if migration.version > 11:
+            break
+        migration.apply(conn)
+        conn.commit()
+    conn.execute("PRAGMA user_version = 11")
+    conn.execute(
+        "INSERT INTO users (user_id, daily_norm, reset_day, timezone, accumulated_balance, last_recalc_date) "
+        "VALUES (1, 500.5, 3, 'UTC', ?, '2026-10-10')",
+        (0.1 + 0.2 - 1000.29,)
+    )
+    conn.executemany(
+        "INSERT INTO transactions (id, user_id, amount, created_at_utc, created_at_epoch) VALUES (?, 1, ?, ?, ?)",
+        [(7, 0.29, "2026-10-05T10:00:00+00:00", 1791194400000), (9, 123.45, "2026-10-06T10:00:00+00:00", 1791280800000)]
+    )
+    # Последнюю трату удалили: AUTOINCREMENT не должен выдать ее id повторно
+    conn.execute("INSERT INTO transactions (id, user_id, amount, created_at_utc) VALUES (12, 1, 1, '2026-10-07')")
+    conn.execute("DELETE FROM transactions WHERE id = 12")
+    conn.execute("INSERT INTO archive.archived_transactions VALUES (1, 1780000000000, 3, 99.99, NULL)")
+    conn.execute("INSERT INTO daily_spend VALUES (1, '2026-10-05', 0.29, 1), (1, '2026-10-06', 123.45, 1)")
+    conn.execute(
+        "INSERT INTO period_rollup VALUES (1, '2026-10-03', '2026-11-02', 123.74, 0, 0.1, NULL, 0)"
+    )
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def legacy(tmp_path, monkeypatch):
+    db.close_db_connections()
+    db.clear_user_cache()
+    path = str(tmp_path / "budget_bot.db")
+    _legacy_database(path)
+    monkeypatch.setattr(db, "DB_NAME", path)
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    monkeypatch.setattr(db, "ARCHIVE_DB_NAME", "")
+    monkeypatch.setattr(migrations, "DB_BACKUP_BEFORE_MIGRATE", False)
+    yield path
+    db.close_db_connections()
+    db.clear_user_cache()
+
+
+def test_bot_refuses_offline_migration_on_live_database(legacy):
+    with pytest.raises(RuntimeError, match="db_tool.py migrate"):
+        db.init_db()
+    with db.get_db_connection() as conn:
+        assert migrations.get_schema_version(conn) == 11
+        assert conn.execute("SELECT amount FROM transactions WHERE id = 9").fetchone()[0] == 123.45
+
+
+def test_money_becomes_integer_kopecks(legacy):
+    db.init_db(offline=True)
+
+    with db.get_db_connection() as conn:
+        assert migrations.get_schema_version(conn) == migrations.LATEST_VERSION
+        user = conn.execute("SELECT daily_norm, accumulated_balance, balance_since FROM users").fetchone()
+        # balance_since - по самой ранней трате, а она в архиве (1780000000000 - 28.05.2026 в UTC)
+        assert tuple(user) == (50050, -99999, "2026-05-28")
+        transactions = conn.execute("SELECT id, amount FROM transactions ORDER BY id").fetchall()
+        assert [tuple(row) for row in transactions] == [(7, 29), (9, 12345)]
+        assert conn.execute("SELECT amount FROM archive.archived_transactions").fetchone()[0] == 9999
+        assert [row[0] for row in conn.execute("SELECT total FROM daily_spend ORDER BY local_date")] == [29, 12345]
+        rollup = conn.execute("SELECT total, start_balance, end_balance FROM period_rollup").fetchone()
+        assert tuple(rollup) == (12374, 10, None)
+        for schema, table in (("main", "users"), ("main", "transactions"), ("main", "daily_spend"),
+                              ("main", "period_rollup"), ("archive", "archived_transactions")):
+            assert migrations._is_strict(conn, schema, table), table
+        assert conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'").fetchone()[0] == 12
+
+    db.add_transaction(1, 100)
+    with db.get_db_connection() as conn:
+        assert conn.execute("SELECT MAX(id) FROM transactions").fetchone()[0] == 13
+
+
+def test_rerun_does_not_multiply_converted_tables(legacy):
+    """Коммит архива не атомарен с основным файлом: повтор после сбоя не должен умножить копейки еще раз."""
+    conn = db._open_connection(legacy)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        migrations._m012_money_in_kopecks(conn)
+        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        migrations._m012_money_in_kopecks(conn)
+        conn.commit()
+        assert conn.execute("SELECT amount FROM archive.archived_transactions").fetchone()[0] == 9999
+        assert conn.execute("SELECT daily_norm FROM users").fetchone()[0] == 50050
+    finally:
+        conn.close()
@@ -0,0 +1,63 @@
+"""Копейки на границе с юзером (bot/money.py) и разбор сумм из сообщения (bot/logic.py)."""
+import pytest
+
+from bot import logic, money
+
+
+@pytest.mark.parametrize("text, kopecks", [
+    ("150", 15000),
+    ("123,45", 12345),
+    ("123.4", 12340),
+    ("0.29", 29),
+    (" 7 ", 700),
+    ("0010", 1000),
+    ("10000000", money.MAX_AMOUNT),
+])
+def test_parse(text, kopecks):
+    assert money.parse(text) == kopecks
+
+
+@pytest.mark.parametrize("text", [
+    "", "-5", "1.234", "1,2,3", "12a", "١٢", "1e3", "10000000.01", "99999999999999999999", "1" * 5000,
+])
+def test_parse_rejects(text):
+    with pytest.raises(ValueError):
+        money.parse(text)
+
+
+@pytest.mark.parametrize("kopecks, text, csv_text", [
+    (15000, "150", "150.00"),
+    (12345, "123,45", "123.45"),
+    (-1230, "-12,30", "-12.30"),
+    (5, "0,05", "0.05"),
+    (0, "0", "0.00"),
+])
+def test_to_text(kopecks, text, csv_text):
+    assert money.to_text(kopecks) == text
+    assert money.to_text(kopecks, sep=".", always_fraction=True) == csv_text
+
+
+@pytest.mark.parametrize("rubles, kopecks", [
+    (0.1 + 0.2, 30),
+    (0.29, 29),
+    (123.45, 12345),
+    (0.005, 1),
+    (-0.005, -1),
+    (-12.344, -1234),
+])
+def test_from_float_rounds_half_away_from_zero(rubles, kopecks):
+    assert money.from_float(rubles) == kopecks
+
+
+def test_text_round_trip():
+    for kopecks in (1, 9, 10, 99, 100, 101, 12345, money.MAX_AMOUNT):
+        assert money.parse(money.to_text(kopecks)) == kopecks
+
+
+def test_parse_amounts():
+    assert logic.parse_amounts("150 200,50\n35") == [15000, 20050, 3500]
+    assert logic.parse_amounts("0") is None
+    assert logic.parse_amounts("10000001") is None
+    assert logic.parse_amounts("123456789") is None
+    assert logic.parse_amounts(" ".join(["1"] * (logic.MAX_AMOUNTS_PER_MESSAGE + 1))) is None
+    assert logic.parse_amounts("купил хлеб 50") is None
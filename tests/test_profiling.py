@@ -0,0 +1,21 @@
+"""Лог медленных запросов (bot/profiling.py): что в него вообще попадает."""
+import logging
+import sqlite3
+
+from bot import profiling
+
+
+def test_slow_query_log_times_commit(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(profiling._slow_log, "threshold", 0)
+    conn = sqlite3.connect(tmp_path / "slow.db", factory=profiling.SlowQueryConnection)
+    try:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.execute("INSERT INTO t VALUES (1)")
+        caplog.clear()
+        with caplog.at_level(logging.WARNING, logger=profiling.logger.name):
+            conn.commit()
+    finally:
+        conn.close()
+
+    assert any("Медленный запрос" in record.message and "COMMIT" in record.message for record in caplog.records)
+    assert "test_profiling.py:test_slow_query_log_times_commit" in caplog.text